@@ -1,7 +1,46 @@
 import os
 import json
-import requests
+import asyncio
 import datetime
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from datacity_ckan_dgp import utils
+
+
+# session settings, can be overridden per instance using CKAN_INSTANCE_<NAME>_<SETTING> env vars
+# e.g. CKAN_INSTANCE_LOCAL_DEVELOPMENT_POOL_MAXSIZE=20
+SESSION_DEFAULTS = {
+    # number of keep-alive connections to keep open per instance
+    'POOL_MAXSIZE': os.getenv('CKAN_POOL_MAXSIZE', '10'),
+    'CONNECT_TIMEOUT_SECONDS': os.getenv('CKAN_CONNECT_TIMEOUT_SECONDS', '30'),
+    # time to wait between bytes received, not the total request time, so large uploads are not affected
+    'READ_TIMEOUT_SECONDS': os.getenv('CKAN_READ_TIMEOUT_SECONDS', '600'),
+    'RETRY_TOTAL': os.getenv('CKAN_RETRY_TOTAL', '5'),
+    'RETRY_BACKOFF_FACTOR': os.getenv('CKAN_RETRY_BACKOFF_FACTOR', '0.5'),
+    # only idempotent methods are retried by default, POST actions like resource_create may not be safe to repeat
+    'RETRY_METHODS': os.getenv('CKAN_RETRY_METHODS', 'GET,HEAD'),
+    # max number of concurrent requests to the instance from the async_* functions
+    'ASYNC_MAX_CONCURRENCY': os.getenv('CKAN_ASYNC_MAX_CONCURRENCY', '10'),
+    # max number of concurrent requests / downloads from all threads of the process to the instance, 0 = unlimited
+    'MAX_CONCURRENCY': os.getenv('CKAN_MAX_CONCURRENCY', '0'),
+}
+RETRY_STATUS_FORCELIST = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_async_executors = {}
+_concurrency_semaphores = {}
+_sessions_lock = threading.Lock()
+
+
+def get_instance_env_prefix(instance_name):
+    return 'CKAN_INSTANCE_' + instance_name.upper().replace(' ', '_') + '_'
 
 
 def get_instance_api_key_url(instance_name):
@@ -9,11 +48,96 @@ def get_instance_api_key_url(instance_name):
         return None, instance_name
     else:
         return (
-            os.environ.get('CKAN_INSTANCE_' + instance_name.upper().replace(' ', '_') + '_API_KEY'),
-            os.environ['CKAN_INSTANCE_' + instance_name.upper().replace(' ', '_') + '_URL']
+            os.environ.get(get_instance_env_prefix(instance_name) + 'API_KEY'),
+            os.environ[get_instance_env_prefix(instance_name) + 'URL']
         )
 
 
+def get_instance_session_setting(instance_name, setting):
+    if instance_name.startswith('http'):
+        return SESSION_DEFAULTS[setting]
+    else:
+        return os.environ.get(get_instance_env_prefix(instance_name) + setting, SESSION_DEFAULTS[setting])
+
+
+def get_instance_timeout(instance_name):
+    return (
+        float(get_instance_session_setting(instance_name, 'CONNECT_TIMEOUT_SECONDS')),
+        float(get_instance_session_setting(instance_name, 'READ_TIMEOUT_SECONDS')),
+    )
+
+
+def create_session(instance_name):
+    pool_maxsize = int(get_instance_session_setting(instance_name, 'POOL_MAXSIZE'))
+    retry = Retry(
+        total=int(get_instance_session_setting(instance_name, 'RETRY_TOTAL')),
+        backoff_factor=float(get_instance_session_setting(instance_name, 'RETRY_BACKOFF_FACTOR')),
+        status_forcelist=RETRY_STATUS_FORCELIST,
+        allowed_methods=[m.strip().upper() for m in get_instance_session_setting(instance_name, 'RETRY_METHODS').split(',') if m.strip()],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # pool_connections is the number of hosts to keep pools for, resource urls may point to other hosts than the instance
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(instance_name):
+    # sessions are shared by all operators in the process and keyed by the instance url
+    # so that instance names and urls which point to the same instance share the connection pool
+    _, url = get_instance_api_key_url(instance_name)
+    with _sessions_lock:
+        session = _sessions.get(url)
+        if session is None:
+            session = _sessions[url] = create_session(instance_name)
+    return session
+
+
+def get_async_executor(instance_name):
+    # the async_* functions run the sync api functions on a bounded thread pool per instance
+    # this limits the concurrency against each instance and reuses the instance session connection pool
+    _, url = get_instance_api_key_url(instance_name)
+    with _sessions_lock:
+        executor = _async_executors.get(url)
+        if executor is None:
+            executor = _async_executors[url] = ThreadPoolExecutor(
+                max_workers=int(get_instance_session_setting(instance_name, 'ASYNC_MAX_CONCURRENCY')),
+                thread_name_prefix='ckan-async'
+            )
+    return executor
+
+
+@contextmanager
+def instance_concurrency_limit(instance_name):
+    # limits the number of concurrent requests to the instance, used by api_request and can be used for other requests, e.g. downloads
+    # must not be nested for the same instance, otherwise it might deadlock
+    _, url = get_instance_api_key_url(instance_name)
+    with _sessions_lock:
+        if url not in _concurrency_semaphores:
+            max_concurrency = int(get_instance_session_setting(instance_name, 'MAX_CONCURRENCY'))
+            _concurrency_semaphores[url] = threading.BoundedSemaphore(max_concurrency) if max_concurrency > 0 else None
+        semaphore = _concurrency_semaphores[url]
+    if semaphore:
+        with semaphore:
+            yield
+    else:
+        yield
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        for executor in _async_executors.values():
+            executor.shutdown(wait=False)
+        _async_executors.clear()
+        _concurrency_semaphores.clear()
+
+
 def api_request(method, instance_name, action_name, auth=True, **kwargs):
     api_key, url = get_instance_api_key_url(instance_name)
     url = os.path.join(url, 'api', '3', 'action', action_name)
@@ -22,7 +146,15 @@ def api_request(method, instance_name, action_name, auth=True, **kwargs):
         headers['user-agent'] = 'datagov-external-client'
     if 'verify' not in kwargs:
         kwargs['verify'] = os.getenv("CKAN_VERIFY_SSL") != "no"
-    res = getattr(requests, method.lower())(url, headers=headers, **kwargs)
+    if 'timeout' not in kwargs:
+        kwargs['timeout'] = get_instance_timeout(instance_name)
+    if kwargs.get('files') and utils.MultipartFileStream.is_streamable(kwargs.get('data'), kwargs['files']):
+        # uploaded files are streamed from disk instead of loading the whole request body in memory
+        data = utils.MultipartFileStream(kwargs.pop('data', None), kwargs.pop('files'))
+        headers['Content-Type'] = data.content_type
+        kwargs['data'] = data
+    with instance_concurrency_limit(instance_name):
+        res = get_session(instance_name).request(method.upper(), url, headers=headers, **kwargs)
     try:
         return res.json()
     except Exception:
@@ -86,6 +218,40 @@ def package_search(instance_name, params):
     return res['result']
 
 
+def _get_package_search_iterate_params(start, rows, include_private, include_drafts, fq, params):
+    return {
+        'rows': rows,
+        'start': start,
+        # stable sort order, so that pages don't shift if packages are modified while iterating
+        'sort': 'name asc',
+        'include_private': 'true' if include_private else 'false',
+        'include_drafts': 'true' if include_drafts else 'false',
+        **({'fq': fq} if fq else {}),
+        **params
+    }
+
+
+def package_search_iterate(instance_name, rows=1000, include_private=False, include_drafts=False, fq=None, auth=True, **params):
+    # yields full package dicts, same as package_show, using a handful of paginated package_search requests
+    # rows is limited by the instance ckan.search.rows_max setting (default 1000)
+    start = 0
+    while True:
+        res = api_get(instance_name, 'package_search', auth=auth, params=_get_package_search_iterate_params(
+            start, rows, include_private, include_drafts, fq, params
+        ))
+        assert res['success'], res
+        results = res['result']['results']
+        for result in results:
+            yield result
+        start += len(results)
+        if len(results) == 0 or start >= res['result']['count']:
+            break
+
+
+def package_search_iterate_public(instance_name, rows=1000, fq=None, **params):
+    yield from package_search_iterate(instance_name, rows=rows, fq=fq, auth=False, **params)
+
+
 def resource_search(instance_name, params):
     res = api_get(instance_name, 'resource_search', params=params)
     assert res['success'], res
@@ -112,6 +278,18 @@ def resource_update(instance_name, data, files=None):
     return api_post(instance_name, 'resource_update', data=data, files=files)
 
 
+def resource_patch(instance_name, data, files=None):
+    return api_post(instance_name, 'resource_patch', data=data, files=files)
+
+
+def resource_delete(instance_name, resource_id):
+    return api_post(instance_name, 'resource_delete', json={'id': resource_id})
+
+
+def package_resource_reorder(instance_name, package_id, resource_ids):
+    return api_post(instance_name, 'package_resource_reorder', json={'id': package_id, 'order': resource_ids})
+
+
 def group_list(instance_name, **params):
     yield from api_get_list(instance_name, 'group_list', auth=True, **params)
 
@@ -171,3 +349,92 @@ def datastore_info(instance_name, resource_id):
     res = api_post(instance_name, 'datastore_info', json={'id': resource_id})
     assert res['success'], res
     return res['result']
+
+
+# asyncio counterparts of the functions above, they keep the same arguments and return values
+# e.g. await asyncio.gather(*[async_package_show(instance_name, name) for name in names])
+
+
+async def _run_async(instance_name, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        get_async_executor(instance_name), functools.partial(func, *args, **kwargs)
+    )
+
+
+def _async(func):
+
+    @functools.wraps(func)
+    async def async_func(instance_name, *args, **kwargs):
+        return await _run_async(instance_name, func, instance_name, *args, **kwargs)
+
+    async_func.__name__ = async_func.__qualname__ = 'async_{}'.format(func.__name__)
+    return async_func
+
+
+async def async_api_request(method, instance_name, action_name, auth=True, **kwargs):
+    return await _run_async(instance_name, api_request, method, instance_name, action_name, auth=auth, **kwargs)
+
+
+async_api_get = _async(api_get)
+async_api_post = _async(api_post)
+async_package_show_public = _async(package_show_public)
+async_package_show = _async(package_show)
+async_resource_show = _async(resource_show)
+async_package_search = _async(package_search)
+async_resource_search = _async(resource_search)
+async_package_create = _async(package_create)
+async_resource_create = _async(resource_create)
+async_package_update = _async(package_update)
+async_resource_update = _async(resource_update)
+async_resource_patch = _async(resource_patch)
+async_resource_delete = _async(resource_delete)
+async_package_resource_reorder = _async(package_resource_reorder)
+async_group_show = _async(group_show)
+async_group_create = _async(group_create)
+async_organization_show = _async(organization_show)
+async_organization_create = _async(organization_create)
+async_group_update = _async(group_update)
+async_automation_group_get = _async(automation_group_get)
+async_automation_group_set = _async(automation_group_set)
+async_datastore_info = _async(datastore_info)
+
+
+async def async_api_get_list(instance_name, action_name, auth=True, **params):
+    limit, offset = 100, 0
+    while True:
+        results = (await async_api_get(instance_name, action_name, auth=auth, params={'limit': limit, 'offset': offset, **params}))['result']
+        for result in results:
+            yield result
+        if len(results) == 0:
+            break
+        offset += limit
+
+
+async def async_package_list_public(instance_name):
+    async for result in async_api_get_list(instance_name, 'package_list', auth=False):
+        yield result
+
+
+async def async_package_list(instance_name):
+    async for result in async_api_get_list(instance_name, 'package_list', auth=True):
+        yield result
+
+
+async def async_package_search_iterate(instance_name, rows=1000, include_private=False, include_drafts=False, fq=None, auth=True, **params):
+    start = 0
+    while True:
+        res = await async_api_get(instance_name, 'package_search', auth=auth, params=_get_package_search_iterate_params(
+            start, rows, include_private, include_drafts, fq, params
+        ))
+        assert res['success'], res
+        results = res['result']['results']
+        for result in results:
+            yield result
+        start += len(results)
+        if len(results) == 0 or start >= res['result']['count']:
+            break
+
+
+async def async_group_list(instance_name, **params):
+    async for result in async_api_get_list(instance_name, 'group_list', auth=True, **params):
+        yield result
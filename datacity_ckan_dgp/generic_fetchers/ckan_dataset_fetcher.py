@@ -2,11 +2,18 @@ import os
 import json
 import shutil
 import datetime
+import functools
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
+import ijson
+import pandas as pd
 import requests
 import dataflows as DF
 
 from .. import ckan
+from .. import utils
 from ..utils import http_stream_download
 from ..utils.locking import instance_package_lock
 from ..operators import packages_processing
@@ -35,20 +42,29 @@ Local development examples:
 """
 
 DEVEL_SKIP_DOWNLOAD = os.getenv('DEVEL_SKIP_DOWNLOAD', 'false').lower() == 'true'
+# number of source resources downloaded concurrently, 1 = serial
+DOWNLOAD_WORKERS = int(os.getenv('CKAN_DATASET_FETCHER_DOWNLOAD_WORKERS', '4'))
+# max number of concurrent downloads from each host (from all threads of the process), to prevent throttling by the source
+MAX_CONNECTIONS_PER_HOST = int(os.getenv('CKAN_DATASET_FETCHER_MAX_CONNECTIONS_PER_HOST', '2'))
+# CSV sources of at least this size are filtered column-wise using pandas, 0 = disabled
+COLUMNAR_FILTER_MIN_BYTES = int(os.getenv('CKAN_DATASET_FETCHER_COLUMNAR_FILTER_MIN_BYTES', str(100 * 1024 * 1024)))
+COLUMNAR_FILTER_CHUNK_ROWS = int(os.getenv('CKAN_DATASET_FETCHER_COLUMNAR_FILTER_CHUNK_ROWS', '100000'))
 
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
 
-def run_packages_processing(instance_name, package_id):
+
+def run_packages_processing(instance_name, package_id, local_files=None):
+    # local_files is a dict of resource id to the local path of the uploaded data, so that it's not downloaded again
     for task in ['geojson', 'xlsx']:
         assert packages_processing.operator('_', {
             'instance_name': instance_name,
             'task': task
-        }, only_package_id=package_id, with_lock=False)
+        }, only_package_id=package_id, with_lock=False, local_files=local_files)
 
 
-def check_row_kv(row, key, val):
-    rowval = str(row.get(key) or '').strip()
-    val = str(val or '').strip()
-    return rowval == val
+def normalize_filter_value(value):
+    return str(value or '').strip()
 
 
 def get_resource_last_modified(resource):
@@ -101,34 +117,98 @@ def post_processing_resource(
                 assert res['success'], str(res)
 
 
+def compile_source_filter(source_filter):
+    # compiles the source filter to a list of conditions, a row matches if any of the conditions match
+    # each condition is a list of (keys, vals) clauses, a condition matches if for all of its clauses
+    # the normalized value of any of the keys is in the set of normalized vals
+    if isinstance(source_filter, list):
+        filters = source_filter
+    elif isinstance(source_filter, dict):
+        filter_type = source_filter.get('..filtertype')
+        if filter_type == 'multi_key_vals':
+            return [[(tuple(source_filter['keys']), frozenset(normalize_filter_value(val) for val in source_filter['vals']))]]
+        elif filter_type is None:
+            filters = [source_filter]
+        else:
+            raise ValueError(f'unsupported filter type: {filter_type}')
+    else:
+        raise ValueError('source_filter must be a list of dictionaries or a dictionary')
+    conditions, single_key_vals = [], {}
+    for filter_ in filters:
+        condition = [((key,), frozenset([normalize_filter_value(val)])) for key, val in filter_.items()]
+        if len(condition) == 1:
+            # single key conditions on the same key are merged to a single set lookup, e.g. list of cities
+            (key,), vals = condition[0]
+            single_key_vals.setdefault(key, set()).update(vals)
+        else:
+            conditions.append(condition)
+    return [[((key,), frozenset(vals))] for key, vals in single_key_vals.items()] + conditions
+
+
 def filter_rows(source_filter):
+    conditions = compile_source_filter(source_filter)
 
     def filter_row(row):
-        if isinstance(source_filter, list):
-            for filter_ in source_filter:
-                if all(check_row_kv(row, k, v) for k, v in filter_.items()):
-                    return True
-        elif isinstance(source_filter, dict):
-            filter_type = source_filter.pop('..filtertype', None)
-            if filter_type == 'multi_key_vals':
-                for key in source_filter['keys']:
-                    for val in source_filter['vals']:
-                        if check_row_kv(row, key, val):
-                            return True
-            elif filter_type is None:
-                return all(check_row_kv(row, k, v) for k, v in source_filter.items())
-            else:
-                raise ValueError(f'unsupported filter type: {filter_type}')
-        else:
-            raise ValueError('source_filter must be a list of dictionaries or a dictionary')
-        return False
+        return any(
+            all(any(normalize_filter_value(row.get(key)) in vals for key in keys) for keys, vals in condition)
+            for condition in conditions
+        )
 
     return filter_row
 
 
-def get_filtered_tabular_resources_to_update(tmpdir, source_filter, id_, name, format_, hash_, description, filename):
-    print(f'filtering tabular data from {filename} with format {format_}...')
-    resources_to_update = []
+def get_filter_mask(df, source_filter):
+    # vectorized equivalent of filter_rows for a pandas dataframe of strings
+    conditions = compile_source_filter(source_filter)
+    columns = {}
+
+    def get_column(key):
+        if key not in columns:
+            columns[key] = df[key].fillna('').str.strip() if key in df.columns else None
+        return columns[key]
+
+    mask = None
+    for condition in conditions:
+        condition_mask = None
+        for keys, vals in condition:
+            clause_mask = None
+            for key in keys:
+                column = get_column(key)
+                key_mask = column.isin(vals) if column is not None else ('' in vals)
+                clause_mask = key_mask if clause_mask is None else clause_mask | key_mask
+            condition_mask = clause_mask if condition_mask is None else condition_mask & clause_mask
+        if condition_mask is None:
+            condition_mask = True
+        mask = condition_mask if mask is None else mask | condition_mask
+    if mask is None:
+        mask = False
+    if isinstance(mask, bool):
+        mask = [mask] * len(df)
+    return mask
+
+
+def filter_csv_columnar(source_filename, target_filename, source_filter):
+    # returns the number of filtered rows, or None if the file can't be filtered column-wise
+    # the csv is read in chunks of COLUMNAR_FILTER_CHUNK_ROWS rows, so memory usage does not depend on the file size
+    num_rows = 0
+    try:
+        with open(target_filename, 'w', newline='', encoding='utf-8') as f:
+            for i, df in enumerate(pd.read_csv(
+                source_filename, dtype=str, keep_default_na=False, encoding='utf-8-sig', skipinitialspace=True,
+                chunksize=COLUMNAR_FILTER_CHUNK_ROWS
+            )):
+                # values are stripped, the same as the dataflows path
+                df = df[get_filter_mask(df, source_filter)].apply(lambda column: column.str.strip())
+                df.to_csv(f, index=False, header=(i == 0), lineterminator='\r\n')
+                num_rows += len(df)
+    except (UnicodeDecodeError, pd.errors.ParserError) as e:
+        print(f'failed to read csv with pandas, filtering row by row: {e}')
+        return None
+    return num_rows
+
+
+def filter_tabular_dataflows(tmpdir, source_filter, id_, format_):
+    # returns the number of filtered rows, the filtered data is saved to {id_}-filtered/filtered.csv
     DF.Flow(
         DF.load(f'{tmpdir}/{id_}', name='filtered', format=format_.lower(), infer_strategy=DF.load.INFER_STRINGS, cast_strategy=DF.load.CAST_TO_STRINGS),
         DF.filter_rows(filter_rows(source_filter)),
@@ -137,8 +217,26 @@ def get_filtered_tabular_resources_to_update(tmpdir, source_filter, id_, name, f
     ).process()
     with open(f'{tmpdir}/{id_}-filtered/datapackage.json', 'r') as f:
         dp = json.load(f)
-        hash_ = dp['hash']
-        count_of_rows = dp['count_of_rows']
+    return dp['count_of_rows']
+
+
+def filter_tabular(tmpdir, source_filter, id_, format_):
+    # returns tuple of (hash, count_of_rows), large csv files are filtered column-wise
+    # the hash is the md5 of the filtered csv on both paths, so it doesn't change if the source crosses the size threshold
+    count_of_rows = None
+    if format_.lower() == 'csv' and COLUMNAR_FILTER_MIN_BYTES and os.path.getsize(f'{tmpdir}/{id_}') >= COLUMNAR_FILTER_MIN_BYTES:
+        os.makedirs(f'{tmpdir}/{id_}-filtered', exist_ok=True)
+        count_of_rows = filter_csv_columnar(f'{tmpdir}/{id_}', f'{tmpdir}/{id_}-filtered/filtered.csv', source_filter)
+    if count_of_rows is None:
+        count_of_rows = filter_tabular_dataflows(tmpdir, source_filter, id_, format_)
+    return utils.hash_file(f'{tmpdir}/{id_}-filtered/filtered.csv')['md5'], count_of_rows
+
+
+def get_filtered_tabular_resources_to_update(tmpdir, source_filter, id_, name, format_, hash_, description, filename):
+    print(f'filtering tabular data from {filename} with format {format_}...')
+    resources_to_update = []
+    hash_, count_of_rows = filter_tabular(tmpdir, source_filter, id_, format_)
+    print(f'{count_of_rows} rows matched the filter')
     if count_of_rows == 0:
         print('no rows found, skipping resource')
     else:
@@ -151,42 +249,123 @@ def get_filtered_tabular_resources_to_update(tmpdir, source_filter, id_, name, f
     return resources_to_update
 
 
+def build_json_value(event, value, events):
+    # builds the json value which starts with the given ijson event, consuming its events
+    if event not in ('start_map', 'start_array'):
+        return value
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    depth = 1
+    while depth:
+        _, event, value = next(events)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        builder.event(event, value)
+    return builder.value
+
+
+def filter_geojson(source_filename, target_filename, source_filter):
+    # streams the geojson features through the source filter and writes the matching features directly to the target
+    # only a single feature is held in memory, the other top-level members (e.g. crs) are copied as-is
+    # the output is the same as json.dump of the filtered feature collection, returns the number of matching features
+    filter_row = filter_rows(source_filter)
+    num_features = 0
+    with open(source_filename, 'rb') as source_f, open(target_filename, 'w') as target_f:
+        events = ijson.parse(source_f, use_float=True)
+        target_f.write('{')
+        num_members = 0
+        for prefix, event, value in events:
+            if prefix != '' or event != 'map_key':
+                continue
+            if num_members:
+                target_f.write(', ')
+            num_members += 1
+            target_f.write(json.dumps(value) + ': ')
+            _, event, member_value = next(events)
+            if value == 'features' and event == 'start_array':
+                target_f.write('[')
+                for _, event, feature_value in events:
+                    if event == 'end_array':
+                        break
+                    feature = build_json_value(event, feature_value, events)
+                    if filter_row((feature or {}).get('properties') or {}):
+                        target_f.write((', ' if num_features else '') + json.dumps(feature))
+                        num_features += 1
+                target_f.write(']')
+            else:
+                target_f.write(json.dumps(build_json_value(event, member_value, events)))
+        target_f.write('}')
+    return num_features
+
+
 def get_filtered_geojson_resources_to_update(tmpdir, source_filter, id_, name, format_, hash_, description, filename):
     print(f'filtering geojson data from {filename} with format {format_}...')
     resources_to_update = []
-    with open(f'{tmpdir}/{id_}', 'r') as f:
-        data = json.load(f)
-    features = data.get('features') or []
-    features = [feature for feature in features if all(feature['properties'].get(k) == v for k, v in source_filter.items())]
-    if not features:
+    num_features = filter_geojson(f'{tmpdir}/{id_}', f'{tmpdir}/{id_}-filtered.geojson', source_filter)
+    print(f'{num_features} features matched the filter')
+    if not num_features:
         print('no features found, skipping resource')
+        os.unlink(f'{tmpdir}/{id_}-filtered.geojson')
     else:
-        data['features'] = features
-        with open(f'{tmpdir}/{id_}', 'w') as f:
-            json.dump(data, f)
+        os.replace(f'{tmpdir}/{id_}-filtered.geojson', f'{tmpdir}/{id_}')
         resources_to_update.append((id_, name, 'GEOJSON', hash_, description, filename))
     return resources_to_update
 
 
-def get_resources_to_update(resources, tmpdir, headers, existing_target_resources, source_filter):
+def get_host_semaphore(url):
+    host = urlparse(url).netloc.lower()
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = _host_semaphores[host] = threading.BoundedSemaphore(max(MAX_CONNECTIONS_PER_HOST, 1))
+    return semaphore
+
+
+def get_resource_download_url(resource):
+    url = resource.get('url') or ''
+    if 'e.data.gov.il' in url:
+        url = url.replace('e.data.gov.il', 'data.gov.il')
+    return url
+
+
+def download_resource(resource, tmpdir, headers, session=None):
+    # returns the hash of the downloaded resource, limited to MAX_CONNECTIONS_PER_HOST concurrent downloads per host
+    id_ = resource.get('id') or ''
+    url = get_resource_download_url(resource)
+    filename = url.split('/')[-1]
+    if DEVEL_SKIP_DOWNLOAD:
+        print(f'skipping download of {filename} from {url}')
+        return ''
+    with get_host_semaphore(url):
+        print(f'downloading {filename} from {url}')
+        return http_stream_download(f'{tmpdir}/{id_}', {'url': url, 'headers': headers}, session=session, use_cache=True)
+
+
+def download_resources(resources, tmpdir, headers, session=None, download_workers=None):
+    # downloads the resources concurrently, returns the hashes in the same order as the resources
+    download_workers = download_workers or DOWNLOAD_WORKERS
+    func = functools.partial(download_resource, tmpdir=tmpdir, headers=headers, session=session)
+    if download_workers > 1 and len(resources) > 1:
+        with ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='ckan-dataset-download') as executor:
+            return list(utils.iterate_executor_results(executor, func, resources, max_pending=download_workers))
+    else:
+        return list(utils.iterate_executor_results(None, func, resources, max_pending=1))
+
+
+def get_resources_to_update(resources, tmpdir, headers, existing_target_resources, source_filter, session=None, download_workers=None):
     resources_to_update = []
-    for resource in resources:
-        id_ = resource.get('id') or ''
-        url = resource.get('url') or ''
-        if url and id_:
-            if 'e.data.gov.il' in url:
-                url = url.replace('e.data.gov.il', 'data.gov.il')
-            filename = url.split('/')[-1]
-            if DEVEL_SKIP_DOWNLOAD:
-                print(f'skipping download of {filename} from {url}')
-                source_hash = ''
-            else:
-                source_hash = http_stream_download(f'{tmpdir}/{id_}', {'url': url, 'headers': headers})
-            source_format = resource.get('format') or ''
-            source_name = resource.get('name') or ''
-            description = resource.get('description') or ''
-            if source_filter or existing_target_resources.get(f'{source_name}.{source_format}'.lower(), {}).get('hash') != source_hash:
-                resources_to_update.append((id_, source_name, source_format, source_hash, description, filename))
+    resources = [resource for resource in resources if resource.get('id') and resource.get('url')]
+    source_hashes = download_resources(resources, tmpdir, headers, session=session, download_workers=download_workers)
+    for resource, source_hash in zip(resources, source_hashes):
+        id_ = resource['id']
+        filename = get_resource_download_url(resource).split('/')[-1]
+        source_format = resource.get('format') or ''
+        source_name = resource.get('name') or ''
+        description = resource.get('description') or ''
+        if source_filter or existing_target_resources.get(f'{source_name}.{source_format}'.lower(), {}).get('hash') != source_hash:
+            resources_to_update.append((id_, source_name, source_format, source_hash, description, filename))
     if source_filter:
         prefiltered_resources = resources_to_update
         resources_to_update = []
@@ -248,11 +427,13 @@ def fetch(source_url, target_instance_name, target_package_id, target_organizati
         resource['id']: resource for resource in res['result']['resources']
     }
     resources_to_update = get_resources_to_update(
-        res['result']['resources'], tmpdir, headers, existing_target_resources, source_filter
+        res['result']['resources'], tmpdir, headers, existing_target_resources, source_filter,
+        session=ckan.get_session(source_instance_baseurl)
     )
     if resources_to_update:
         with instance_package_lock(target_instance_name, target_package_id):
             print(f'updating {len(resources_to_update)} resources')
+            local_files = {}
             if not target_package_exists:
                 print('creating target package')
                 res = ckan.package_create(target_instance_name, {
@@ -280,6 +461,7 @@ def fetch(source_url, target_instance_name, target_package_id, target_organizati
                         upload_filename = f'{tmpdir}/{filename}'
                         res = ckan.resource_update(target_instance_name, data, files=[('upload', open(upload_filename, 'rb'))])
                         assert res['success'], str(res)
+                        local_files[data['id']] = upload_filename
                         post_processing_resource(
                             source_resources, existing_target_resources, post_processing, target_package_id,
                             format_, name, hash_, description, upload_filename, target_instance_name
@@ -296,11 +478,12 @@ def fetch(source_url, target_instance_name, target_package_id, target_organizati
                     upload_filename = f'{tmpdir}/{filename}'
                     res = ckan.resource_create(target_instance_name, data, files=[('upload', open(upload_filename, 'rb'))])
                     assert res['success'], str(res)
+                    local_files[res['result']['id']] = upload_filename
                     post_processing_resource(
                         source_resources, existing_target_resources, post_processing, target_package_id,
                         format_, name, hash_, description, upload_filename, target_instance_name
                     )
-            run_packages_processing(target_instance_name, target_package_id)
+            run_packages_processing(target_instance_name, target_package_id, local_files)
             print('done, all resources created/updated')
     else:
         print('no resources to create/update')
@@ -27,12 +27,13 @@ Local development example:
 DEVEL_SKIP_DOWNLOAD = os.getenv('DEVEL_SKIP_DOWNLOAD', 'false').lower() == 'true'
 
 
-def run_packages_processing(instance_name, package_id):
+def run_packages_processing(instance_name, package_id, local_files=None):
+    # local_files is a dict of resource id to the local path of the uploaded data, so that it's not downloaded again
     for task in ['geojson', 'xlsx']:
         assert packages_processing.operator('_', {
             'instance_name': instance_name,
             'task': task
-        }, only_package_id=package_id, with_lock=False)
+        }, only_package_id=package_id, with_lock=False, local_files=local_files)
 
 
 def fetch(
@@ -54,11 +55,12 @@ def fetch(
         print(f'skipping download of {filename} from {source_url}')
         source_hash = ''
     else:
-        source_hash = http_stream_download(f'{tmpdir}/{filename}', {'url': source_url})
+        source_hash = http_stream_download(f'{tmpdir}/{filename}', {'url': source_url}, use_cache=True)
     if not existing_resource or existing_resource.get('hash') != source_hash:
         description = 'מקור המידע: ' + source_url
         with instance_package_lock(target_instance_name, target_package_id):
             print(f'updating resource')
+            local_files = {}
             if not target_package_exists:
                 print('creating target package')
                 res = ckan.package_create(target_instance_name, {
@@ -82,6 +84,7 @@ def fetch(
                     upload_filename = f'{tmpdir}/{filename}'
                     res = ckan.resource_update(target_instance_name, data, files=[('upload', open(upload_filename, 'rb'))])
                     assert res['success'], str(res)
+                    local_files[existing_resource['id']] = upload_filename
             else:
                 print('no existing resource found, creating new resource')
                 data = {
@@ -94,7 +97,8 @@ def fetch(
                 upload_filename = f'{tmpdir}/{filename}'
                 res = ckan.resource_create(target_instance_name, data, files=[('upload', open(upload_filename, 'rb'))])
                 assert res['success'], str(res)
-            run_packages_processing(target_instance_name, target_package_id)
+                local_files[res['result']['id']] = upload_filename
+            run_packages_processing(target_instance_name, target_package_id, local_files)
             print('done, all resources created/updated')
     else:
         print('no resources to create/update')
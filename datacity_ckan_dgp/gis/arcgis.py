@@ -0,0 +1,238 @@
+import os
+import re
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from datacity_ckan_dgp import utils
+
+
+DEFAULT_PAGE_SIZE = 1000
+# number of concurrent page requests to the gis server
+MAX_WORKERS = int(os.getenv('GIS_FETCHER_MAX_WORKERS', '4'))
+# number of layers which are fetched concurrently when fetching all layers of a MapServer / FeatureServer
+MAX_LAYER_WORKERS = int(os.getenv('GIS_FETCHER_MAX_LAYER_WORKERS', '4'))
+# optional geometry compaction: number of decimal places of the coordinates, and generalization offset
+# the offset is in the units of outSR, which is set to WGS84 with it, so it's in degrees (e.g. 0.00001 is ~1 meter)
+GEOMETRY_PRECISION = os.getenv('GIS_FETCHER_GEOMETRY_PRECISION')
+MAX_ALLOWABLE_OFFSET = os.getenv('GIS_FETCHER_MAX_ALLOWABLE_OFFSET')
+# print the number of features and bytes of each page
+DEBUG = os.getenv('GIS_FETCHER_DEBUG', 'false').lower() == 'true'
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # shared by all the layers and page requests of the process
+            adapter = HTTPAdapter(pool_maxsize=MAX_WORKERS * MAX_LAYER_WORKERS * 2)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def fetch_gis_json(gis_url):
+    gis_json_url = f'{gis_url}?f=pjson'
+    print(f'fetching gis json from {gis_json_url}')
+    res = get_session().get(gis_json_url)
+    res.raise_for_status()
+    return res.json()
+
+
+def is_service_url(gis_url):
+    # MapServer / FeatureServer root url, as opposed to a layer url (e.g. .../MapServer/13)
+    return re.search(r'/(MapServer|FeatureServer)/?$', gis_url) is not None
+
+
+def get_service_name(gis_url, service_json):
+    return (service_json.get('documentInfo') or {}).get('Title') or service_json.get('mapName') or gis_url.rstrip('/').split('/')[-2]
+
+
+def get_service_layers(service_json):
+    # feature layers from the service ?f=pjson metadata, group layers and raster layers are skipped
+    return [
+        layer for layer in service_json.get('layers') or []
+        if not layer.get('subLayerIds') and layer.get('type', 'Feature Layer') == 'Feature Layer'
+    ]
+
+
+def get_layer_url(gis_url, layer):
+    return f'{gis_url.rstrip("/")}/{layer["id"]}'
+
+
+def query(gis_url, params, stats=None):
+    # if stats dict is set, the response sizes are added to it
+    url = gis_url.rstrip('/') + '/query'
+    # object ids lists can be too long for a GET url
+    if 'objectIds' in params:
+        res = get_session().post(url, data=params)
+    else:
+        res = get_session().get(url, params=params)
+    try:
+        assert res.status_code == 200
+        data = res.json()
+        assert 'error' not in data, data['error']
+    except Exception as e:
+        raise Exception(f'failed to fetch geojson from {url} with params {params}\n{res.content}') from e
+    if stats is not None:
+        # requests sends Accept-Encoding: gzip, deflate - raw.tell() is the compressed size read from the connection
+        stats['bytes_on_wire'] = stats.get('bytes_on_wire', 0) + res.raw.tell()
+        stats['bytes'] = stats.get('bytes', 0) + len(res.content)
+    return data
+
+
+def get_geometry_params():
+    params = {}
+    if GEOMETRY_PRECISION:
+        params['geometryPrecision'] = GEOMETRY_PRECISION
+    if MAX_ALLOWABLE_OFFSET:
+        # without outSR the offset is in the units of the layer spatial reference (e.g. meters for ITM layers)
+        params['maxAllowableOffset'] = MAX_ALLOWABLE_OFFSET
+        params['outSR'] = 4326
+    return params
+
+
+def query_geojson_features(gis_url, params, stats=None):
+    # if stats dict is set, the number of features and response sizes are added to it
+    page_stats = {}
+    data = query(gis_url, {'outFields': '*', 'f': 'geojson', **get_geometry_params(), **params}, stats=page_stats)
+    try:
+        assert data['type'] == 'FeatureCollection'
+    except Exception as e:
+        raise Exception(f'failed to fetch geojson from {gis_url} with params {params}\n{data}') from e
+    if stats is not None:
+        add_stats(stats, {'features': len(data['features']), **page_stats})
+    return data['features']
+
+
+def add_stats(stats, other_stats):
+    for k, v in other_stats.items():
+        stats[k] = stats.get(k, 0) + v
+
+
+def format_stats(stats):
+    return f'{stats.get("features", 0)} features: {stats.get("bytes_on_wire", 0)} bytes on wire, {stats.get("bytes", 0)} bytes decoded'
+
+
+def get_page_size(gis_json):
+    return gis_json.get('maxRecordCount') or DEFAULT_PAGE_SIZE
+
+
+def get_object_id_field(gis_json):
+    if gis_json.get('objectIdField'):
+        return gis_json['objectIdField']
+    for field in gis_json.get('fields') or []:
+        if field.get('type') == 'esriFieldTypeOID':
+            return field['name']
+    return None
+
+
+def get_feature_object_id(feature, object_id_field):
+    object_id = feature['properties'].get(object_id_field)
+    if object_id is None:
+        object_id = feature.get('id')
+    assert object_id is not None, f'feature has no object id: {feature}'
+    return object_id
+
+
+def get_query_capabilities(gis_json):
+    return gis_json.get('advancedQueryCapabilities') or {}
+
+
+def query_count(gis_url, where='1=1'):
+    return query(gis_url, {'where': where, 'returnCountOnly': 'true', 'f': 'json'})['count']
+
+
+def query_object_ids(gis_url, where='1=1'):
+    data = query(gis_url, {'where': where, 'returnIdsOnly': 'true', 'f': 'json'})
+    return sorted(data.get('objectIds') or [])
+
+
+def fetch_offset_page(gis_url, page, stats=None):
+    # servers may return less features than requested (e.g. if the transfer limit is exceeded)
+    # so we keep requesting until we get the full page or no more features are returned
+    features = []
+    while len(features) < page['resultRecordCount']:
+        page_features = query_geojson_features(gis_url, {
+            **page,
+            'resultOffset': page['resultOffset'] + len(features),
+            'resultRecordCount': page['resultRecordCount'] - len(features),
+        }, stats=stats)
+        if not page_features:
+            break
+        features += page_features
+    return features
+
+
+def fetch_object_ids_page(gis_url, object_ids, stats=None):
+    return query_geojson_features(gis_url, {'objectIds': ','.join(map(str, object_ids))}, stats=stats)
+
+
+def fetch_page_with_stats(fetch_page, *args):
+    # returns tuple of (features, page_stats), page_stats is of all the requests of the page
+    page_stats = {}
+    return fetch_page(*args, stats=page_stats), page_stats
+
+
+def iterate_offset_pages(gis_url, params, offset=0, page_size=DEFAULT_PAGE_SIZE):
+    # sequential paging until an empty page is returned, yields tuples of (features, page_stats)
+    while True:
+        page_stats = {}
+        features = query_geojson_features(gis_url, {**params, 'resultOffset': offset, 'resultRecordCount': page_size}, stats=page_stats)
+        if not features:
+            break
+        yield features, page_stats
+        offset += len(features)
+
+
+def iterate_pages(gis_url, gis_json, where='1=1', max_workers=MAX_WORKERS, with_stats=False):
+    # yields lists of features, pages are fetched concurrently and yielded in order
+    # if with_stats, yields tuples of (features, page_stats) with the number of features and bytes of the page
+    # the stats of each page are printed if GIS_FETCHER_DEBUG is set, and the layer totals are printed at the end
+    layer_stats = {}
+    page_size = get_page_size(gis_json)
+    capabilities = get_query_capabilities(gis_json)
+    object_id_field = get_object_id_field(gis_json)
+    params = {'where': where}
+    if object_id_field and capabilities.get('supportsOrderBy', True):
+        # stable order is required for concurrent offset paging
+        params['orderByFields'] = object_id_field
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if capabilities.get('supportsPagination', True):
+            count = query_count(gis_url, where)
+            print(f'fetching {count} features in pages of {page_size}')
+            # features might have been added since the count was fetched, so the offset pages are followed by sequential paging
+            pages = itertools.chain(utils.iterate_executor_results(
+                executor, lambda page: fetch_page_with_stats(fetch_offset_page, gis_url, page), (
+                    {**params, 'resultOffset': offset, 'resultRecordCount': min(page_size, count - offset)}
+                    for offset in range(0, count, page_size)
+                ), max_pending=max_workers * 2
+            ), iterate_offset_pages(gis_url, params, offset=count, page_size=page_size))
+        else:
+            object_ids = query_object_ids(gis_url, where)
+            print(f'fetching {len(object_ids)} features by object ids in pages of {page_size}')
+            pages = utils.iterate_executor_results(
+                executor, lambda page_object_ids: fetch_page_with_stats(fetch_object_ids_page, gis_url, page_object_ids), (
+                    object_ids[i:i + page_size] for i in range(0, len(object_ids), page_size)
+                ), max_pending=max_workers * 2
+            )
+        for page_num, (features, page_stats) in enumerate(pages):
+            if DEBUG:
+                print(f'page {page_num}: fetched {format_stats(page_stats)}')
+            add_stats(layer_stats, page_stats)
+            yield (features, page_stats) if with_stats else features
+    print(f'fetched from {gis_url}: {format_stats(layer_stats)}')
+
+
+def iterate_features(gis_url, gis_json=None, where='1=1', max_workers=MAX_WORKERS):
+    if gis_json is None:
+        gis_json = fetch_gis_json(gis_url)
+    for features in iterate_pages(gis_url, gis_json, where=where, max_workers=max_workers):
+        yield from features
@@ -0,0 +1,113 @@
+import os
+import json
+
+from datacity_ckan_dgp.gis import arcgis
+from datacity_ckan_dgp.gis.writers import get_features_schema
+
+
+def get_checkpoint_path(file_path):
+    return f'{file_path}.checkpoint.json'
+
+
+def load_checkpoint(file_path):
+    checkpoint_path = get_checkpoint_path(file_path)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            return json.load(f)
+    else:
+        return None
+
+
+def save_checkpoint(file_path, checkpoint):
+    # written to a temporary file and replaced, so the checkpoint is never partially written
+    checkpoint_path = get_checkpoint_path(file_path)
+    with open(f'{checkpoint_path}.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
+
+
+def get_schema_path(file_path):
+    # gis.jsonlines -> gis.schema.json
+    return f'{os.path.splitext(file_path)[0]}.schema.json'
+
+
+def load_schema(file_path):
+    with open(get_schema_path(file_path)) as f:
+        return json.load(f)
+
+
+def save_schema(file_path, schema):
+    with open(get_schema_path(file_path), 'w') as f:
+        json.dump(schema, f, ensure_ascii=False, indent=2)
+
+
+def write_features_jsonlines(features, file_path):
+    # writes the features to a jsonlines file and saves the schema discovered while writing
+    schema = get_features_schema([])
+    with open(file_path, 'w') as f:
+        for feature in features:
+            f.write(json.dumps(feature, ensure_ascii=False) + '\n')
+            get_features_schema([feature], schema)
+    save_schema(file_path, schema)
+    return schema
+
+
+def can_resume(gis_json):
+    # resuming is done by querying features with object id greater than the last downloaded object id
+    # so the pages must be ordered by object id
+    capabilities = arcgis.get_query_capabilities(gis_json)
+    return bool(arcgis.get_object_id_field(gis_json)) and (
+        capabilities.get('supportsOrderBy', True) or not capabilities.get('supportsPagination', True)
+    )
+
+
+def download_features_jsonlines(gis_url, gis_json, file_path, where='1=1'):
+    # downloads the layer features to a jsonlines file, with a checkpoint sidecar file which is updated after each page
+    # the checkpoint records the file size of the completed pages, so an interrupted download is truncated to the
+    # last completed page and resumed from there, and the file is used as-is only if the checkpoint marks it complete
+    # the features schema is discovered during the download and saved to gis.schema.json
+    # each page in the checkpoint records its number of features, and the bytes on wire / decoded of its requests
+    checkpoint = load_checkpoint(file_path)
+    file_size = os.path.getsize(file_path) if os.path.exists(file_path) else None
+    if checkpoint and (checkpoint['gis_url'] != gis_url or checkpoint['where'] != where or file_size is None or file_size < checkpoint['num_bytes']):
+        print('WARNING: existing gis.jsonlines checkpoint does not match, downloading from start')
+        checkpoint = None
+    if checkpoint and checkpoint['complete']:
+        print(f'using existing complete gis.jsonlines ({checkpoint["num_features"]} features)')
+        save_schema(file_path, checkpoint['schema'])
+        return checkpoint
+    object_id_field = arcgis.get_object_id_field(gis_json)
+    if checkpoint and checkpoint['last_object_id'] is not None and can_resume(gis_json):
+        print(f'resuming download after {checkpoint["num_features"]} features (last object id {checkpoint["last_object_id"]})')
+        page_where = f'({where}) AND {object_id_field} > {checkpoint["last_object_id"]}'
+    else:
+        if file_size is not None:
+            print('WARNING: existing gis.jsonlines is not complete and cannot be resumed, downloading from start')
+        checkpoint = {'gis_url': gis_url, 'where': where, 'complete': False, 'num_bytes': 0, 'num_features': 0, 'last_object_id': None, 'pages': [], 'schema': get_features_schema([])}
+        page_where = where
+    with open(file_path, 'ab') as f:
+        f.truncate(checkpoint['num_bytes'])
+        for features, page_stats in arcgis.iterate_pages(gis_url, gis_json, where=page_where, with_stats=True):
+            if not features:
+                continue
+            data = ''.join(json.dumps(feature, ensure_ascii=False) + '\n' for feature in features).encode()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            page = {'num_features': len(features), 'bytes_on_wire': page_stats.get('bytes_on_wire', 0), 'bytes': page_stats.get('bytes', 0)}
+            if object_id_field:
+                object_ids = [arcgis.get_feature_object_id(feature, object_id_field) for feature in features]
+                page.update(first_object_id=min(object_ids), last_object_id=max(object_ids))
+                checkpoint['last_object_id'] = page['last_object_id']
+            checkpoint['pages'].append(page)
+            checkpoint['num_bytes'] += len(data)
+            checkpoint['num_features'] += len(features)
+            get_features_schema(features, checkpoint['schema'])
+            save_checkpoint(file_path, checkpoint)
+    checkpoint['complete'] = True
+    save_checkpoint(file_path, checkpoint)
+    save_schema(file_path, checkpoint['schema'])
+    print(f'downloaded {checkpoint["num_features"]} features')
+    return checkpoint
@@ -0,0 +1,137 @@
+import os
+import json
+import sqlite3
+import hashlib
+import contextlib
+import datetime
+
+from datacity_ckan_dgp.gis import arcgis
+
+
+# directory where the feature stores are persisted between runs, required for incremental mode
+STATE_DIR = os.getenv('GIS_FETCHER_STATE_DIR')
+
+
+class FeatureStore:
+    # persists the features of a gis layer in sqlite, keyed by the layer object id
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        self.conn = sqlite3.connect(file_path)
+        with self.conn:
+            self.conn.execute('create table if not exists features (object_id integer primary key, edit_date integer, feature text not null)')
+            self.conn.execute('create table if not exists metadata (key text primary key, value text)')
+
+    def close(self):
+        self.conn.close()
+
+    def get_metadata(self, key):
+        row = self.conn.execute('select value from metadata where key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_metadata(self, key, value):
+        with self.conn:
+            self.conn.execute('insert or replace into metadata (key, value) values (?, ?)', (key, json.dumps(value)))
+
+    def count(self):
+        return self.conn.execute('select count(*) from features').fetchone()[0]
+
+    def get_object_ids(self):
+        return {row[0] for row in self.conn.execute('select object_id from features')}
+
+    def get_max_edit_date(self):
+        return self.conn.execute('select max(edit_date) from features').fetchone()[0]
+
+    def upsert(self, features, object_id_field, edit_date_field=None):
+        # returns the object ids of the features which were added or modified
+        changed_object_ids = set()
+        with self.conn:
+            for feature in features:
+                object_id = arcgis.get_feature_object_id(feature, object_id_field)
+                feature_json = json.dumps(feature, ensure_ascii=False)
+                row = self.conn.execute('select feature from features where object_id = ?', (object_id,)).fetchone()
+                if not row or row[0] != feature_json:
+                    edit_date = feature['properties'].get(edit_date_field) if edit_date_field else None
+                    self.conn.execute('insert or replace into features (object_id, edit_date, feature) values (?, ?, ?)', (object_id, edit_date, feature_json))
+                    changed_object_ids.add(object_id)
+        return changed_object_ids
+
+    def delete(self, object_ids):
+        with self.conn:
+            self.conn.executemany('delete from features where object_id = ?', ((object_id,) for object_id in object_ids))
+
+    def iterate_features(self):
+        for row in self.conn.execute('select feature from features order by object_id'):
+            yield json.loads(row[0])
+
+
+def get_feature_store_path(gis_url, state_dir=None):
+    state_dir = state_dir or STATE_DIR
+    assert state_dir, 'GIS_FETCHER_STATE_DIR is required for incremental mode'
+    return os.path.join(state_dir, hashlib.md5(gis_url.encode()).hexdigest() + '.sqlite')
+
+
+def get_edit_date_field(gis_json):
+    return (gis_json.get('editFieldsInfo') or {}).get('editDateField')
+
+
+def get_last_edit_date(gis_json):
+    return (gis_json.get('editingInfo') or {}).get('lastEditDate')
+
+
+def get_edited_since_where(edit_date_field, edit_date):
+    # edit_date is epoch milliseconds, as returned by the gis server
+    timestamp = datetime.datetime.fromtimestamp(edit_date / 1000, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return f"{edit_date_field} >= TIMESTAMP '{timestamp}'"
+
+
+def update_feature_store(store, gis_url, gis_json):
+    # updates the store with the current layer features, returns True if any feature was added, modified or deleted
+    object_id_field = arcgis.get_object_id_field(gis_json)
+    assert object_id_field, 'incremental mode requires a layer with an object id field'
+    edit_date_field = get_edit_date_field(gis_json)
+    last_edit_date = get_last_edit_date(gis_json)
+    is_initialized = store.get_metadata('initialized')
+    if is_initialized and last_edit_date and store.get_metadata('last_edit_date') == last_edit_date and arcgis.query_count(gis_url) == store.count():
+        print(f'layer was not edited since last run (lastEditDate={last_edit_date})')
+        return False
+    max_edit_date = store.get_max_edit_date() if is_initialized and edit_date_field else None
+    if max_edit_date:
+        where = get_edited_since_where(edit_date_field, max_edit_date)
+        print(f'fetching features edited since last run: {where}')
+        changed_object_ids = store.upsert(arcgis.iterate_features(gis_url, gis_json, where=where), object_id_field, edit_date_field)
+        # deleted features are detected by diffing the object ids, features without edit date are fetched by id
+        object_ids = set(arcgis.query_object_ids(gis_url))
+        store_object_ids = store.get_object_ids()
+        deleted_object_ids = store_object_ids - object_ids
+        new_object_ids = sorted(object_ids - store_object_ids)
+        page_size = arcgis.get_page_size(gis_json)
+        for i in range(0, len(new_object_ids), page_size):
+            changed_object_ids |= store.upsert(arcgis.fetch_object_ids_page(gis_url, new_object_ids[i:i + page_size]), object_id_field, edit_date_field)
+    else:
+        print('fetching all features')
+        store_object_ids = store.get_object_ids()
+        changed_object_ids, object_ids = set(), set()
+        for features in arcgis.iterate_pages(gis_url, gis_json):
+            changed_object_ids |= store.upsert(features, object_id_field, edit_date_field)
+            object_ids.update(arcgis.get_feature_object_id(feature, object_id_field) for feature in features)
+        deleted_object_ids = store_object_ids - object_ids
+    store.delete(deleted_object_ids)
+    store.set_metadata('last_edit_date', last_edit_date)
+    store.set_metadata('initialized', True)
+    print(f'{len(changed_object_ids)} features added or modified, {len(deleted_object_ids)} features deleted')
+    return not is_initialized or bool(changed_object_ids or deleted_object_ids)
+
+
+@contextlib.contextmanager
+def open_feature_store(gis_url, state_dir=None, incremental=True):
+    # yields None if not incremental, so it can be used unconditionally
+    if not incremental:
+        yield None
+    else:
+        store = FeatureStore(get_feature_store_path(gis_url, state_dir))
+        try:
+            yield store
+        finally:
+            store.close()
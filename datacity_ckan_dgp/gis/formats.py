@@ -0,0 +1,188 @@
+import os
+import json
+import queue
+import shutil
+import functools
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import dataflows as DF
+
+from datacity_ckan_dgp import utils
+from datacity_ckan_dgp.gis.writers import features_to_csv, get_writers_md5, write_features, GeojsonWriter, GeoxmlWriter, XmlWriter
+
+
+# formats with a spatial index, which allow bbox / range reads without downloading the whole file
+# name: (OGR driver name, file extension, resource format, layer creation options)
+INDEXED_FORMATS = {
+    'flatgeobuf': ('FlatGeobuf', 'fgb', 'FlatGeobuf', ['SPATIAL_INDEX=YES']),
+    'geoparquet': ('Parquet', 'parquet', 'GeoParquet', []),
+    'geopackage': ('GPKG', 'gpkg', 'GeoPackage', ['SPATIAL_INDEX=YES']),
+}
+
+# format groups and their output files, a failure of a writer only deletes its own files
+FORMAT_GROUP_FILES = {
+    'geojson_geoxml': ['gis.geojson', 'gis.itm.geojson', 'gis.geoxml', 'gis.itm.geoxml'],
+    'shapefile': ['shapefile.zip'],
+    'csv_xlsx_xml': ['gis.csv', 'gis.xlsx', 'gis.xml'],
+    'kml': ['gis.kml'],
+    **{format_name: [f'gis.{extension}'] for format_name, (_, extension, _, _) in INDEXED_FORMATS.items()},
+}
+
+# max number of rows waiting to be dumped by the csv / xlsx dataflows thread
+CSV_XLSX_QUEUE_SIZE = 1000
+
+
+def iterate_gis_jsonlines(tmpdir):
+    with open(os.path.join(tmpdir, 'gis.jsonlines'), 'r') as f:
+        for line in f:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except Exception as e:
+                    raise Exception(f'failed to parse json line: {line}') from e
+
+
+class CsvXlsxXmlWriter:
+    # writes gis.xml directly, and gis.csv / gis.xlsx using dataflows which runs in a thread fed through a bounded queue
+    # so that it can be one of the writers of write_features, the md5 is of gis.xml, csv / xlsx are hashed on upload
+    itm = False
+
+    def __init__(self, tmpdir, fields):
+        # the fields are from the schema discovered during download, in first-seen order
+        self.tmpdir = tmpdir
+        self.fields = fields
+        self.failed = False
+        self.hashes = None
+        self.error = None
+        self.xml_writer = XmlWriter(os.path.join(tmpdir, 'gis.xml'))
+        self.file_path = self.xml_writer.file_path
+        self.rows = queue.Queue(maxsize=CSV_XLSX_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.dump_rows, daemon=True)
+        self.thread.start()
+
+    def iterate_rows(self):
+        while True:
+            row = self.rows.get()
+            if row is None:
+                break
+            yield row
+
+    def dump_rows(self):
+        try:
+            DF.Flow(
+                self.iterate_rows(),
+                DF.dump_to_path(os.path.join(self.tmpdir, 'csv')),
+                DF.dump_to_path(os.path.join(self.tmpdir, 'xlsx'), format='xlsx')
+            ).process()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+
+    def put(self, row):
+        # blocks while the queue is full, unless the dataflows thread stopped
+        while self.thread.is_alive():
+            try:
+                self.rows.put(row, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def write(self, feature):
+        row = next(features_to_csv([feature], fields=self.fields))
+        self.xml_writer.write(row)
+        if not self.put(row):
+            raise Exception('failed to dump gis.csv / gis.xlsx') from self.error
+
+    def stop(self):
+        self.put(None)
+        self.thread.join()
+
+    def fail(self, error):
+        print(str(error))
+        print('failed to write gis.csv / gis.xlsx / gis.xml')
+        self.failed = True
+        self.stop()
+        self.xml_writer.fail(error)
+        for file_name in ['gis.csv', 'gis.xlsx']:
+            if os.path.exists(os.path.join(self.tmpdir, file_name)):
+                os.unlink(os.path.join(self.tmpdir, file_name))
+
+    def close(self):
+        if not self.failed:
+            self.stop()
+            if self.error:
+                raise Exception('failed to dump gis.csv / gis.xlsx') from self.error
+            self.xml_writer.close()
+            shutil.copyfile(os.path.join(self.tmpdir, 'csv', 'res_1.csv'), os.path.join(self.tmpdir, 'gis.csv'))
+            shutil.copyfile(os.path.join(self.tmpdir, 'xlsx', 'res_1.xlsx'), os.path.join(self.tmpdir, 'gis.xlsx'))
+            self.hashes = self.xml_writer.hashes
+
+
+def create_format_group_writers(format_group, schema, tmpdir):
+    # returns the list of writers of the format group, which may be empty if the format is not supported
+    # ogr_writers is imported only when needed, so that GDAL is not required for the other formats
+    print(f'Create {", ".join(FORMAT_GROUP_FILES[format_group])}')
+    if format_group == 'geojson_geoxml':
+        return [
+            GeojsonWriter(os.path.join(tmpdir, 'gis.geojson')),
+            GeojsonWriter(os.path.join(tmpdir, 'gis.itm.geojson'), itm=True),
+            GeoxmlWriter(os.path.join(tmpdir, 'gis.geoxml')),
+            GeoxmlWriter(os.path.join(tmpdir, 'gis.itm.geoxml'), itm=True),
+        ]
+    elif format_group == 'csv_xlsx_xml':
+        return [CsvXlsxXmlWriter(tmpdir, list(schema['fields']))]
+    elif format_group == 'shapefile':
+        from datacity_ckan_dgp.gis import ogr_writers
+        return [ogr_writers.ShapefileZipWriter(tmpdir, schema)]
+    elif format_group == 'kml':
+        from datacity_ckan_dgp.gis import ogr_writers
+        return [ogr_writers.OgrLayerWriter(os.path.join(tmpdir, 'gis.kml'), 'KML', schema)]
+    elif format_group in INDEXED_FORMATS:
+        from datacity_ckan_dgp.gis import ogr_writers
+        writer = ogr_writers.create_indexed_format_writer(tmpdir, 'gis', format_group, schema)
+        return [writer] if writer else []
+    else:
+        raise Exception(f'unknown format group: {format_group}')
+
+
+def delete_format_group_files(format_group, tmpdir):
+    for file_name in FORMAT_GROUP_FILES.get(format_group, []):
+        if os.path.exists(os.path.join(tmpdir, file_name)):
+            os.unlink(os.path.join(tmpdir, file_name))
+
+
+def write_format_groups(format_groups, schema, tmpdir):
+    # writes the files of all the format groups in a single pass over gis.jsonlines, may run in a worker process
+    # returns dict of file name: md5 for the files which were hashed while generated
+    writers = []
+    for format_group in format_groups:
+        try:
+            writers += create_format_group_writers(format_group, schema, tmpdir)
+        except Exception:
+            traceback.print_exc()
+            print(f'failed to create {format_group} formats, skipping')
+            delete_format_group_files(format_group, tmpdir)
+    if writers:
+        write_features(iterate_gis_jsonlines(tmpdir), writers)
+    return get_writers_md5(writers)
+
+
+def create_formats(tmpdir, schema, format_groups, format_workers=1):
+    # creates the files of the format groups from <tmpdir>/gis.jsonlines
+    # with a single worker all the formats are written in a single pass, otherwise each format group is written by a
+    # worker process with its own pass over gis.jsonlines, returns dict of file name: md5 as returned by write_format_groups
+    if format_workers <= 1 or len(format_groups) <= 1:
+        return write_format_groups(format_groups, schema, tmpdir)
+    file_hashes = {}
+    # spawn, so that workers don't inherit the parent open connections
+    with ProcessPoolExecutor(max_workers=format_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for format_group_file_hashes in utils.iterate_executor_results(
+            executor, functools.partial(write_format_groups, schema=schema, tmpdir=tmpdir),
+            [[format_group] for format_group in format_groups], max_pending=len(format_groups)
+        ):
+            file_hashes.update(format_group_file_hashes)
+    return file_hashes
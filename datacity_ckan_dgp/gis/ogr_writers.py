@@ -0,0 +1,185 @@
+import os
+import json
+import shutil
+
+from osgeo import ogr, osr
+
+from datacity_ckan_dgp import utils
+from datacity_ckan_dgp.gis.writers import get_feature_property_string
+from datacity_ckan_dgp.gis.formats import INDEXED_FORMATS
+
+
+OGR_FIELD_TYPES = {
+    'integer': ogr.OFTInteger64,
+    'real': ogr.OFTReal,
+    'string': ogr.OFTString,
+}
+# number of features written in each transaction, for drivers which support transactions (e.g. GPKG)
+TRANSACTION_SIZE = 10000
+OGR_GEOMETRY_TYPES = {
+    'Point': ogr.wkbPoint,
+    'MultiPoint': ogr.wkbMultiPoint,
+    'LineString': ogr.wkbLineString,
+    'MultiLineString': ogr.wkbMultiLineString,
+    'Polygon': ogr.wkbPolygon,
+    'MultiPolygon': ogr.wkbMultiPolygon,
+}
+# single geometries written to a multi geometry layer are converted, some drivers (e.g. FlatGeobuf, GPKG) reject
+# or mis-type geometries which don't match the layer geometry type
+OGR_FORCE_TO_MULTI = {
+    ogr.wkbMultiPoint: ogr.ForceToMultiPoint,
+    ogr.wkbMultiLineString: ogr.ForceToMultiLineString,
+    ogr.wkbMultiPolygon: ogr.ForceToMultiPolygon,
+}
+
+
+def get_wgs84_srs():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def is_driver_available(driver_name):
+    return ogr.GetDriverByName(driver_name) is not None
+
+
+def create_indexed_format_writer(tmpdir, file_name_prefix, format_name, schema):
+    # returns None if the OGR driver is not available in the installed GDAL
+    driver_name, extension, _, layer_options = INDEXED_FORMATS[format_name]
+    if not is_driver_available(driver_name):
+        print(f'OGR driver {driver_name} is not available, skipping {format_name}')
+        return None
+    file_path = os.path.join(tmpdir, f'{file_name_prefix}.{extension}')
+    return OgrLayerWriter(file_path, driver_name, schema, srs=get_wgs84_srs(), layer_options=layer_options)
+
+
+def write_indexed_format(features, tmpdir, file_name_prefix, format_name, schema):
+    # returns the file path, or None if the OGR driver is not available in the installed GDAL
+    writer = create_indexed_format_writer(tmpdir, file_name_prefix, format_name, schema)
+    if writer is None:
+        return None
+    for feature in features:
+        writer.write(feature)
+    writer.close()
+    return writer.file_path
+
+
+def get_layer_geometry_type(geometry_types):
+    # mixed single / multi geometries of the same kind are written as the multi type
+    if len(geometry_types) == 1:
+        return OGR_GEOMETRY_TYPES.get(list(geometry_types)[0], ogr.wkbUnknown)
+    base_geometry_types = {geometry_type.replace('Multi', '') for geometry_type in geometry_types}
+    if len(base_geometry_types) == 1:
+        return OGR_GEOMETRY_TYPES.get(f'Multi{list(base_geometry_types)[0]}', ogr.wkbUnknown)
+    return ogr.wkbUnknown
+
+
+class OgrLayerWriter:
+    # streams features to a new OGR layer, the schema is from writers.get_features_schema
+    # only the current feature is held in memory, so memory usage does not depend on the number of features
+    # can be used as one of the writers of writers.write_features, so it is fed in the same pass as the other formats
+    itm = False
+
+    def __init__(self, file_path, driver_name, schema, layer_name='gis', srs=None,
+                 dataset_options=None, layer_options=None, max_string_width=None):
+        self.file_path = file_path
+        self.failed = False
+        self.hashes = None
+        self.num_features = 0
+        self.driver = ogr.GetDriverByName(driver_name)
+        assert self.driver, f'OGR driver is not available: {driver_name}'
+        if os.path.exists(file_path):
+            self.driver.DeleteDataSource(file_path)
+        self.ds = self.driver.CreateDataSource(file_path, options=dataset_options or [])
+        assert self.ds, f'failed to create OGR data source: {file_path}'
+        geometry_type = get_layer_geometry_type(schema['geometry_types'])
+        self.force_to_multi = OGR_FORCE_TO_MULTI.get(geometry_type)
+        self.layer = self.ds.CreateLayer(layer_name, srs=srs, geom_type=geometry_type, options=layer_options or [])
+        assert self.layer, f'failed to create OGR layer: {file_path}'
+        self.fields = list(schema['fields'].items())
+        for name, field in self.fields:
+            # fields with only None values are created as string fields
+            field_defn = ogr.FieldDefn(name, OGR_FIELD_TYPES[field['type'] or 'string'])
+            if field['type'] in (None, 'string') and max_string_width:
+                field_defn.SetWidth(min(max(field['width'], 1), max_string_width))
+            assert self.layer.CreateField(field_defn) == ogr.OGRERR_NONE, f'failed to create field: {name}'
+        # fields are referenced by index because some drivers modify the field names (e.g. shapefile 10 characters limit)
+        self.layer_defn = self.layer.GetLayerDefn()
+        self.use_transactions = self.ds.TestCapability(ogr.ODsCTransactions)
+        if self.use_transactions:
+            self.ds.StartTransaction()
+
+    def write(self, feature):
+        if self.use_transactions and self.num_features > 0 and self.num_features % TRANSACTION_SIZE == 0:
+            self.ds.CommitTransaction()
+            self.ds.StartTransaction()
+        ogr_feature = ogr.Feature(self.layer_defn)
+        if feature.get('geometry'):
+            geometry = ogr.CreateGeometryFromJson(json.dumps(feature['geometry']))
+            if self.force_to_multi:
+                geometry = self.force_to_multi(geometry)
+            ogr_feature.SetGeometry(geometry)
+        for field_index, (name, field) in enumerate(self.fields):
+            value = feature['properties'].get(name)
+            if value is None:
+                continue
+            elif field['type'] == 'integer':
+                ogr_feature.SetFieldInteger64(field_index, value)
+            elif field['type'] == 'real':
+                ogr_feature.SetFieldDouble(field_index, float(value))
+            else:
+                ogr_feature.SetFieldString(field_index, get_feature_property_string(value))
+        assert self.layer.CreateFeature(ogr_feature) == ogr.OGRERR_NONE, f'failed to write feature to {self.file_path}'
+        self.num_features += 1
+
+    def fail(self, error):
+        print(str(error))
+        print(f'failed to write feature to {os.path.basename(self.file_path)}')
+        self.failed = True
+        self.layer = None
+        self.ds = None
+        if os.path.exists(self.file_path):
+            self.driver.DeleteDataSource(self.file_path)
+
+    def close(self):
+        if not self.failed:
+            if self.use_transactions:
+                self.ds.CommitTransaction()
+            # dereferencing the data source closes it and flushes it to disk
+            self.layer = None
+            self.ds = None
+
+
+class ShapefileZipWriter(OgrLayerWriter):
+    # writes the shapefile files to <tmpdir>/shapefile and zips them to <tmpdir>/shapefile.zip on close
+
+    def __init__(self, tmpdir, schema):
+        self.shapefile_path = os.path.join(tmpdir, 'shapefile')
+        self.zip_path = os.path.join(tmpdir, 'shapefile.zip')
+        shutil.rmtree(self.shapefile_path, ignore_errors=True)
+        os.makedirs(self.shapefile_path)
+        super().__init__(
+            os.path.join(self.shapefile_path, 'gis.shp'), 'ESRI Shapefile', schema,
+            srs=get_wgs84_srs(), layer_options=['ENCODING=UTF-8'], max_string_width=254
+        )
+
+    def fail(self, error):
+        super().fail(error)
+        shutil.rmtree(self.shapefile_path, ignore_errors=True)
+        if os.path.exists(self.zip_path):
+            os.unlink(self.zip_path)
+
+    def close(self):
+        super().close()
+        if not self.failed:
+            utils.zip_directory(self.shapefile_path, self.zip_path)
+
+
+def write_ogr_layer(features, file_path, driver_name, schema, layer_name='gis', srs=None,
+                    dataset_options=None, layer_options=None, max_string_width=None):
+    writer = OgrLayerWriter(file_path, driver_name, schema, layer_name=layer_name, srs=srs, dataset_options=dataset_options,
+                            layer_options=layer_options, max_string_width=max_string_width)
+    for feature in features:
+        writer.write(feature)
+    writer.close()
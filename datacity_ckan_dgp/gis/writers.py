@@ -0,0 +1,233 @@
+import os
+import json
+import traceback
+from abc import ABC, abstractmethod
+
+from datacity_ckan_dgp import utils
+from datacity_ckan_dgp.utils import reprojection
+
+
+class FailedToConvertFeature(Exception):
+    pass
+
+
+def geojson_feature_to_itm(feature):
+    # returns a new feature, all the geometry vertices are projected in a single call
+    if feature['type'] != 'Feature':
+        raise FailedToConvertFeature(f'feature is not a Feature: {feature}')
+    try:
+        return {**feature, 'geometry': reprojection.transform_geometry(feature.get('geometry'))}
+    except reprojection.UnsupportedGeometry as e:
+        raise FailedToConvertFeature(str(e))
+
+
+def features_to_csv(features, fields=None):
+    for feature in features:
+        if not fields:
+            yield feature['properties']
+        else:
+            yield {k: str(feature['properties'].get(k) or '') for k in fields}
+
+
+def get_features_schema(features, schema=None):
+    # returns the field types and geometry types of the features, in first-seen order, so the columns order is
+    # deterministic and OGR layers can be created before streaming the features
+    # field type is one of: integer, real, string (or None if all values are None) - string fields also get the max length in bytes
+    # pass an existing schema to update it with more features, the schema is json serializable
+    if schema is None:
+        schema = {'fields': {}, 'geometry_types': []}
+    fields, geometry_types = schema['fields'], schema['geometry_types']
+    for feature in features:
+        geometry_type = (feature.get('geometry') or {}).get('type')
+        if geometry_type and geometry_type not in geometry_types:
+            geometry_types.append(geometry_type)
+        for k, v in feature['properties'].items():
+            field = fields.setdefault(k, {'type': None, 'width': 0})
+            if v is None:
+                continue
+            if isinstance(v, int) and not isinstance(v, bool):
+                field_type = 'integer'
+            elif isinstance(v, float):
+                field_type = 'real'
+            else:
+                field_type = 'string'
+            if field['type'] is None or field['type'] == field_type:
+                field['type'] = field_type
+            elif {field['type'], field_type} == {'integer', 'real'}:
+                field['type'] = 'real'
+            else:
+                field['type'] = 'string'
+            field['width'] = max(field['width'], len(get_feature_property_string(v).encode()))
+    return schema
+
+
+def get_feature_property_string(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    else:
+        return str(value)
+
+
+def append_geoxml_coordinates_item(parts, root_item):
+    # appends the xml parts of the coordinates to the parts list, which is joined once per feature
+    parts.append('<item type="list">')
+    for item in root_item:
+        if isinstance(item, list):
+            append_geoxml_coordinates_item(parts, item)
+        else:
+            parts.append('<item type="float">')
+            parts.append(str(item))
+            parts.append('</item>')
+    parts.append('</item>')
+
+
+XML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', '\'': '&apos;'})
+# large write buffer, each feature is written with a single write call
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class FeaturesFileWriter(ABC):
+    # writes features to a file as part of a single pass over gis.jsonlines
+    # if a feature fails to convert, the writer is closed and its file is deleted, without affecting the other writers
+
+    def __init__(self, file_path, itm=False):
+        self.file_path = file_path
+        self.itm = itm
+        self.failed = False
+        self.hashes = None
+        # the md5 is calculated while writing, so it's ready for upload without reading the file again
+        self.f = utils.HashingWriter(open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE), encoding='utf-8')
+        self.write_header()
+
+    def write_header(self):
+        pass
+
+    def write_footer(self):
+        pass
+
+    @abstractmethod
+    def write(self, feature):
+        pass
+
+    def fail(self, error):
+        print(str(error))
+        print(f'failed to convert feature for {os.path.basename(self.file_path)}')
+        self.failed = True
+        self.f.close()
+        if os.path.exists(self.file_path):
+            os.unlink(self.file_path)
+
+    def close(self):
+        if not self.failed:
+            self.write_footer()
+            self.f.close()
+            self.hashes = self.f.hexdigests()
+
+
+class GeojsonWriter(FeaturesFileWriter):
+
+    def write_header(self):
+        self.num_features = 0
+        self.f.write('{"type": "FeatureCollection","features": [\n')
+
+    def write(self, feature):
+        if self.num_features > 0:
+            self.f.write(',\n')
+        self.f.write('  ' + json.dumps(feature, ensure_ascii=False))
+        self.num_features += 1
+
+    def write_footer(self):
+        self.f.write(']}')
+
+
+class GeoxmlWriter(FeaturesFileWriter):
+
+    def write_header(self):
+        self.f.write('<?xml version="1.0" ?>\n')
+        self.f.write('<root>\n')
+        self.f.write('  <type type="str">FeatureCollection</type>\n')
+        self.f.write('  <features type="list">\n')
+
+    def write(self, feature):
+        if feature['type'] != 'Feature':
+            raise FailedToConvertFeature(f'feature is not a Feature: {feature}')
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') not in ['Polygon', 'MultiPolygon']:
+            raise FailedToConvertFeature(f'unsupported geometry type: {geometry.get("type")}')
+        parts = [
+            '    <item type="dict">\n',
+            '      <type type="str">Feature</type>\n',
+            '      <geometry type="dict">\n',
+            f'        <type type="str">{geometry.get("type")}</type>\n',
+            '        <coordinates type="list">\n',
+        ]
+        for item in geometry.get('coordinates', []):
+            parts.append('          ')
+            append_geoxml_coordinates_item(parts, item)
+            parts.append('\n')
+        parts += [
+            '        </coordinates>\n',
+            '      </geometry>\n',
+            '    </item>\n',
+        ]
+        self.f.write(''.join(parts))
+
+    def write_footer(self):
+        self.f.write('</root>\n')
+
+
+class XmlWriter(FeaturesFileWriter):
+    # writes the feature properties as rows, expects the rows from features_to_csv
+
+    def write_header(self):
+        self.f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+        self.f.write('<root>\n')
+
+    def write(self, properties):
+        parts = ['  <item>\n']
+        for k, v in properties.items():
+            parts.append(f'    <{k} type="str">{v.translate(XML_ESCAPE_TABLE)}</{k}>\n')
+        parts.append('  </item>\n')
+        self.f.write(''.join(parts))
+
+    def write_footer(self):
+        self.f.write('</root>\n')
+
+
+def get_writers_md5(writers):
+    # returns dict of file name: md5 of the files which were written successfully
+    return {os.path.basename(writer.file_path): writer.hashes['md5'] for writer in writers if writer.hashes}
+
+
+def write_features(features, writers):
+    # fan-out each feature to all writers, the ITM projection is done once per feature for all the ITM writers
+    # a writer which fails is closed and its files are deleted, without affecting the other writers
+    for feature in features:
+        itm_feature, itm_error = None, None
+        for writer in writers:
+            if writer.failed:
+                continue
+            try:
+                if writer.itm:
+                    if itm_feature is None and itm_error is None:
+                        try:
+                            itm_feature = geojson_feature_to_itm(feature)
+                        except FailedToConvertFeature as e:
+                            itm_error = e
+                    if itm_error:
+                        raise itm_error
+                    writer.write(itm_feature)
+                else:
+                    writer.write(feature)
+            except FailedToConvertFeature as e:
+                writer.fail(e)
+            except Exception as e:
+                # any other error also only affects this writer
+                traceback.print_exc()
+                writer.fail(e)
+    for writer in writers:
+        try:
+            writer.close()
+        except Exception as e:
+            traceback.print_exc()
+            writer.fail(e)
@@ -1,6 +1,11 @@
 import os
+import json
+import datetime
+import functools
 import traceback
+import multiprocessing
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 
@@ -8,51 +13,210 @@ from datacity_ckan_dgp import ckan
 from datacity_ckan_dgp import utils
 
 
+AUTOMATION_GROUP_NAME = 'ckan_sync'
+DEFAULT_FULL_SYNC_INTERVAL_HOURS = 24
+
+
+def _download_resource(source_instance_name, tmpdir, i, resource):
+    # returns the hash of the downloaded resource, or None if the resource has no url
+    if resource['url']:
+        with ckan.instance_concurrency_limit(source_instance_name):
+            return utils.http_stream_download(os.path.join(tmpdir, 'resource{}'.format(i)), requests_kwargs={'url': resource['url']},
+                                              session=ckan.get_session(source_instance_name))
+    else:
+        return None
+
+
 @contextmanager
-def _download_active_resources(package):
+def _download_active_resources(source_instance_name, package):
     with TemporaryDirectory() as tmpdir:
         source_resource_hashes = {}
         for i, resource in enumerate(package['resources']):
             if resource['state'] != 'active':
                 continue
-            if resource['url']:
-                source_resource_hashes[i] = utils.http_stream_download(os.path.join(tmpdir, 'resource{}'.format(i)), requests_kwargs={'url': resource['url']})
-            else:
-                source_resource_hashes[i] = None
+            source_resource_hashes[i] = _download_resource(source_instance_name, tmpdir, i, resource)
         yield tmpdir, source_resource_hashes
 
 
-def _create_resources(source_package, tmpdir, target_instance_name, target_package_id, resource_hashes):
+def _get_source_resource_signature(session, timeout, resource):
+    # cheap change detection signals of a source resource which don't require downloading it
+    # returns None if there are no reliable signals, in which case the resource has to be downloaded to compare hashes
+    signature = {
+        'hash': resource.get('hash') or '',
+        'size': str(resource.get('size') or ''),
+        'last_modified': resource.get('last_modified') or '',
+        'etag': '',
+        'http_last_modified': '',
+        'content_length': '',
+    }
+    if resource.get('url'):
+        try:
+            res = session.head(resource['url'], allow_redirects=True, timeout=timeout)
+            if res.status_code == 200:
+                signature['etag'] = res.headers.get('ETag') or ''
+                signature['http_last_modified'] = res.headers.get('Last-Modified') or ''
+                signature['content_length'] = res.headers.get('Content-Length') or ''
+        except Exception as e:
+            print('failed to get resource headers ({}): {}'.format(resource['url'], e))
+    # the ckan hash / last_modified fields are updated only when an uploaded file is replaced, for link resources they
+    # don't change when the remote file changes, so link resources require the http validators
+    if resource.get('url_type') == 'upload':
+        is_reliable = signature['hash'] or signature['last_modified'] or signature['etag'] or signature['http_last_modified']
+    else:
+        is_reliable = signature['etag'] or signature['http_last_modified']
+    if is_reliable:
+        return json.dumps(signature, sort_keys=True)
+    else:
+        return None
+
+
+def _get_source_resource_signatures(source_instance_name, source_package):
+    session = ckan.get_session(source_instance_name)
+    timeout = ckan.get_instance_timeout(source_instance_name)
+    signatures = {}
+    for i, resource in enumerate(source_package['resources']):
+        if resource['state'] == 'active':
+            with ckan.instance_concurrency_limit(source_instance_name):
+                signatures[i] = _get_source_resource_signature(session, timeout, resource)
+    return signatures
+
+
+def _get_target_resource_data(source_resource, resource_signature):
+    # the fields which are synced from the source resource to the target resource
+    # if there is no signature, the signature is cleared, so that a stale signature on the target is not matched later
+    return {
+        'description': source_resource['description'],
+        'format': source_resource['format'],
+        'name': source_resource['name'],
+        'sync_source_resource_id': source_resource['id'],
+        'sync_source_signature': resource_signature or '',
+    }
+
+
+def _upload_resource(action, target_instance_name, data, tmpdir, i, resource, resource_hash):
+    # action is ckan.resource_create or ckan.resource_patch, returns the created / patched resource
+    resource_filename = resource['url'].split('/')[-1] if resource_hash else None
+    if resource_filename:
+        with open(os.path.join(tmpdir, 'resource{}'.format(i)), 'rb') as f:
+            res = action(target_instance_name, {
+                **data,
+                'url': resource_filename,
+                'hash': resource_hash
+            }, files={
+                'upload': (resource_filename, f)
+            })
+    else:
+        res = action(target_instance_name, data)
+    assert res['success'], 'upload resource {} failed: {}'.format(i, res)
+    return res['result']
+
+
+def _create_resources(source_package, tmpdir, target_instance_name, target_package_id, resource_hashes, resource_signatures=None):
     for i, resource in enumerate(source_package['resources']):
         if resource['state'] != 'active':
             continue
         try:
-            resource_filename = resource['url'].split('/')[-1] if resource_hashes[i] else None
-            resource_kwargs = {
+            _upload_resource(ckan.resource_create, target_instance_name, {
                 'package_id': target_package_id,
-                'description': resource['description'],
-                'format': resource['format'],
-                'name': resource['name'],
-            }
-            if resource_filename:
-                with open(os.path.join(tmpdir, 'resource{}'.format(i)), 'rb') as f:
-                    res = ckan.resource_create(target_instance_name, {
-                        **resource_kwargs,
-                        'url': resource_filename,
-                        'hash': resource_hashes[i]
-                    }, files={
-                        'upload': (resource_filename, f)
-                    })
-            else:
-                res = ckan.resource_create(target_instance_name, resource_kwargs)
-            assert res['success'], 'create resource {} failed: {}'.format(i, res)
+                **_get_target_resource_data(resource, (resource_signatures or {}).get(i)),
+            }, tmpdir, i, resource, resource_hashes[i])
         except Exception as e:
             print('Failed to process resource {}: {}'.format(i, resource))
             raise
 
 
+def _match_target_resources(source_package, target_package):
+    # returns a dict of source resource index -> target resource
+    # resources are matched by the source resource id recorded on the target resource,
+    # falling back to the same position for resources which were synced before the source resource id was recorded
+    target_resources_by_source_id = {
+        resource['sync_source_resource_id']: resource for resource in target_package['resources']
+        if resource['state'] == 'active' and resource.get('sync_source_resource_id')
+    }
+    matched_target_resources = {}
+    for i, resource in enumerate(source_package['resources']):
+        if resource['state'] == 'active' and resource['id'] in target_resources_by_source_id:
+            matched_target_resources[i] = target_resources_by_source_id[resource['id']]
+    matched_target_resource_ids = set(resource['id'] for resource in matched_target_resources.values())
+    for i, resource in enumerate(source_package['resources']):
+        if resource['state'] == 'active' and i not in matched_target_resources and i < len(target_package['resources']):
+            target_resource = target_package['resources'][i]
+            if (
+                target_resource['state'] == 'active' and not target_resource.get('sync_source_resource_id')
+                and target_resource['id'] not in matched_target_resource_ids
+            ):
+                matched_target_resources[i] = target_resource
+                matched_target_resource_ids.add(target_resource['id'])
+    return matched_target_resources
+
+
+def _sync_resources(source_instance_name, source_package, target_instance_name, target_package, stats, use_resource_signatures=True):
+    # updates only the changed target resources, creates new ones and deletes removed ones, keeping target resource ids stable
+    # returns True if there were any resource changes
+    source_resource_signatures = _get_source_resource_signatures(source_instance_name, source_package) if use_resource_signatures else {}
+    matched_target_resources = _match_target_resources(source_package, target_package)
+    has_resource_changes = False
+    target_resource_ids, created_target_resource_ids = [], []
+    with TemporaryDirectory() as tmpdir:
+        for i, source_resource in enumerate(source_package['resources']):
+            if source_resource['state'] != 'active':
+                continue
+            try:
+                target_resource = matched_target_resources.get(i)
+                resource_signature = source_resource_signatures.get(i)
+                data = _get_target_resource_data(source_resource, resource_signature)
+                if target_resource and resource_signature and resource_signature == target_resource.get('sync_source_signature'):
+                    stats['resources_unchanged_signatures'] += 1
+                    is_content_changed = False
+                else:
+                    resource_hash = _download_resource(source_instance_name, tmpdir, i, source_resource)
+                    is_content_changed = not target_resource or (resource_hash or '') != (target_resource.get('hash') or '')
+                if not target_resource:
+                    target_resource = _upload_resource(ckan.resource_create, target_instance_name, {
+                        'package_id': target_package['id'],
+                        **data
+                    }, tmpdir, i, source_resource, resource_hash)
+                    created_target_resource_ids.append(target_resource['id'])
+                    stats['resources_created'] += 1
+                    has_resource_changes = True
+                elif is_content_changed:
+                    _upload_resource(ckan.resource_patch, target_instance_name, {
+                        'id': target_resource['id'],
+                        **data
+                    }, tmpdir, i, source_resource, resource_hash)
+                    stats['resources_updated'] += 1
+                    has_resource_changes = True
+                elif any((target_resource.get(k) or '') != (v or '') for k, v in data.items()):
+                    res = ckan.resource_patch(target_instance_name, {'id': target_resource['id'], **data})
+                    assert res['success'], 'patch resource {} failed: {}'.format(i, res)
+                    stats['resources_patched'] += 1
+                    if any(target_resource.get(attr) != data[attr] for attr in ['description', 'format', 'name']):
+                        has_resource_changes = True
+                else:
+                    stats['resources_unchanged'] += 1
+                target_resource_ids.append(target_resource['id'])
+                if os.path.exists(os.path.join(tmpdir, 'resource{}'.format(i))):
+                    os.unlink(os.path.join(tmpdir, 'resource{}'.format(i)))
+            except Exception:
+                print('Failed to process resource {}: {}'.format(i, source_resource))
+                raise
+    for target_resource in target_package['resources']:
+        if target_resource['state'] == 'active' and target_resource['id'] not in target_resource_ids:
+            res = ckan.resource_delete(target_instance_name, target_resource['id'])
+            assert res['success'], 'delete resource {} failed: {}'.format(target_resource['id'], res)
+            stats['resources_deleted'] += 1
+            has_resource_changes = True
+    # new resources are added at the end of the package, reorder only if it doesn't match the source order
+    current_target_resource_ids = [resource['id'] for resource in target_package['resources'] if resource['id'] in target_resource_ids]
+    if current_target_resource_ids + created_target_resource_ids != target_resource_ids:
+        res = ckan.package_resource_reorder(target_instance_name, target_package['id'], target_resource_ids)
+        assert res['success'], 'reorder resources failed: {}'.format(res)
+        has_resource_changes = True
+    return has_resource_changes
+
+
 def _update_existing_package(source_instance_name, source_package, target_instance_name, target_organization_id, target_package_name,
-                             target_existing_package, target_package_title_prefix, stats):
+                             target_existing_package, target_package_title_prefix, stats, use_resource_signatures=True):
     try:
         stats['packages_existing'] += 1
         package = {**target_existing_package}
@@ -88,53 +252,26 @@ def _update_existing_package(source_instance_name, source_package, target_instan
         if not got_extra_description:
             has_package_changes = True
             package.setdefault('extras', []).append({"key": "sync_source_org_description", "value": source_org_description})
-        with _download_active_resources(source_package) as (tmpdir, source_resource_hashes):
-            target_resource_hashes = {}
-            for i, resource in enumerate(package['resources']):
-                if resource['state'] != 'active':
-                    continue
-                target_resource_hashes[i] = resource['hash']
-            has_resource_changes = len(source_resource_hashes) != len(target_resource_hashes)
-            if not has_resource_changes:
-                for i in source_resource_hashes:
-                    if (source_resource_hashes[i] or '') != (target_resource_hashes.get(i) or ''):
-                        has_resource_changes = True
-                    else:
-                        try:
-                            source_resource = source_package['resources'][i]
-                            target_resource = target_existing_package['resources'][i]
-                        except AttributeError:
-                            source_resource = None
-                            target_resource = None
-                        if not source_resource or not target_resource:
-                            has_resource_changes = True
-                        else:
-                            for attr in ['description', 'format', 'name']:
-                                if source_resource.get(attr) != target_resource.get(attr):
-                                    has_resource_changes = True
-            if has_package_changes and not has_resource_changes:
-                print('updating package, no resource changes ({} > {})'.format(source_package['name'], target_package_name))
-                ckan.package_update(target_instance_name, package)
-                stats['packages_existing_only_package_changes'] += 1
-            elif has_resource_changes:
-                print('updating package, with resource changes ({} > {})'.format(source_package['name'], target_package_name))
-                package['private'] = True
-                package['resources'] = []
-                ckan.package_update(target_instance_name, package)
-                _create_resources(source_package, tmpdir, target_instance_name, package['id'], source_resource_hashes)
-                package = ckan.package_show(target_instance_name, target_package_name)
-                package['private'] = False
-                ckan.package_update(target_instance_name, package)
-                stats['packages_existing_has_resource_changes'] += 1
-            else:
-                stats['packages_existing_no_changes'] += 1
+        if has_package_changes:
+            # package is updated before the resources, because package_update overwrites the resources with the given ones
+            print('updating package ({} > {})'.format(source_package['name'], target_package_name))
+            ckan.package_update(target_instance_name, package)
+        has_resource_changes = _sync_resources(source_instance_name, source_package, target_instance_name, target_existing_package, stats,
+                                               use_resource_signatures)
+        if has_resource_changes:
+            print('updated package resources ({} > {})'.format(source_package['name'], target_package_name))
+            stats['packages_existing_has_resource_changes'] += 1
+        elif has_package_changes:
+            stats['packages_existing_only_package_changes'] += 1
+        else:
+            stats['packages_existing_no_changes'] += 1
     except Exception:
         print('exception updating existing package {}: {}'.format(target_package_name, target_existing_package))
         raise
 
 
 def _create_new_package(source_instance_name, source_package, target_instance_name, target_organization_id, target_package_name,
-                        target_package_title_prefix, stats):
+                        target_package_title_prefix, stats, use_resource_signatures=True):
     print("Creating new package ({} > {})".format(source_package['name'], target_package_name))
     _, source_instance_url = ckan.get_instance_api_key_url(source_instance_name)
     source_package_url = source_instance_url.strip('/') + '/dataset/{}'.format(source_package['name'])
@@ -142,7 +279,8 @@ def _create_new_package(source_instance_name, source_package, target_instance_na
     target_package_title = source_package['title']
     if target_package_title_prefix:
         target_package_title = '{} {}'.format(target_package_title_prefix, target_package_title)
-    with _download_active_resources(source_package) as (tmpdir, resource_hashes):
+    resource_signatures = _get_source_resource_signatures(source_instance_name, source_package) if use_resource_signatures else None
+    with _download_active_resources(source_instance_name, source_package) as (tmpdir, resource_hashes):
         res = ckan.package_create(target_instance_name, {
             'name': target_package_name,
             'title': target_package_title,
@@ -157,7 +295,7 @@ def _create_new_package(source_instance_name, source_package, target_instance_na
         })
         assert res['success'], 'create package failed: {}'.format(res)
         target_package_id = res['result']['id']
-        _create_resources(source_package, tmpdir, target_instance_name, target_package_id, resource_hashes)
+        _create_resources(source_package, tmpdir, target_instance_name, target_package_id, resource_hashes, resource_signatures)
         package = ckan.package_show(target_instance_name, target_package_id)
         package['private'] = False
         res = ckan.package_update(target_instance_name, package)
@@ -165,46 +303,158 @@ def _create_new_package(source_instance_name, source_package, target_instance_na
     stats['packages_new_created'] += 1
 
 
+def _iterate_source_packages(source_instance_name, use_package_search, fq=None):
+    # yields tuples of (source_package_name, source_package)
+    # source_package is None if it should be fetched using package_show
+    if use_package_search:
+        for source_package in ckan.package_search_iterate_public(source_instance_name, fq=fq):
+            yield source_package['name'], source_package
+    else:
+        for source_package_name in ckan.package_list_public(source_instance_name):
+            yield source_package_name, None
+
+
+def _get_watermark_key(source_instance_name, target_organization_id, target_package_name_prefix):
+    return 'watermark:{}:{}:{}'.format(source_instance_name, target_organization_id, target_package_name_prefix)
+
+
+def _get_incremental_fq(watermark, full_sync_interval_hours):
+    # returns the package_search fq to get only packages modified since the last sync
+    # or None if a full sync is needed
+    if not watermark or not watermark.get('metadata_modified') or not watermark.get('last_full_sync'):
+        return None
+    last_full_sync = ckan.parse_datetime(watermark['last_full_sync'])
+    if last_full_sync < datetime.datetime.utcnow() - datetime.timedelta(hours=full_sync_interval_hours):
+        return None
+    # metadata_modified is in UTC, truncated to seconds, the range is inclusive so packages modified at the same second are synced again
+    return 'metadata_modified:[{}Z TO *]'.format(watermark['metadata_modified'][:19])
+
+
+def _get_watermark_metadata_modified(sync_start_time, high_water_metadata_modified):
+    # packages are iterated by name, so a package modified during the sync may be missed if its name was already passed
+    # the watermark is capped at the sync start time so that such packages are synced by the next incremental sync
+    return min(sync_start_time.strftime('%Y-%m-%dT%H:%M:%S.%f'), high_water_metadata_modified)
+
+
+def _sync_source_package(sync_params, source_package_item):
+    # syncs a single source package, runs in the pool workers
+    # returns tuple of (stats, source package metadata_modified), each package has its own stats which are aggregated by the operator
+    source_package_name, source_package = source_package_item
+    source_instance_name = sync_params['source_instance_name']
+    target_instance_name = sync_params['target_instance_name']
+    target_package_name_prefix = sync_params['target_package_name_prefix']
+    stats = defaultdict(int)
+    metadata_modified = ''
+    try:
+        if source_package_name.startswith(target_package_name_prefix):
+            stats['source_packages_invalid_prefix'] += 1
+            return stats, metadata_modified
+        if source_package is None:
+            source_package = ckan.package_show_public(source_instance_name, source_package_name)
+        metadata_modified = source_package.get('metadata_modified') or ''
+        if source_package['private'] or source_package['state'] != 'active' or source_package['type'] != 'dataset':
+            stats['source_packages_invalid_attrs'] += 1
+            return stats, metadata_modified
+        stats['source_packages_valid'] += 1
+        target_package_name = '{}{}'.format(target_package_name_prefix, source_package_name)
+        target_existing_package = ckan.package_show(target_instance_name, target_package_name)
+        if target_existing_package and target_existing_package['state'] != 'deleted':
+            _update_existing_package(source_instance_name, source_package, target_instance_name, sync_params['target_organization_id'], target_package_name,
+                                     target_existing_package, sync_params['target_package_title_prefix'], stats, sync_params['use_resource_signatures'])
+        else:
+            _create_new_package(source_instance_name, source_package, target_instance_name, sync_params['target_organization_id'], target_package_name,
+                                sync_params['target_package_title_prefix'], stats, sync_params['use_resource_signatures'])
+    except Exception:
+        traceback.print_exc()
+        print('exception processing source package {}: {}'.format(source_package_name, source_package))
+        stats['source_packages_exceptions'] += 1
+    return stats, metadata_modified
+
+
+def _get_executor(workers, worker_type):
+    if workers <= 1:
+        return None
+    elif worker_type == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    elif worker_type == 'process':
+        # spawn, so that workers don't inherit the parent open connections
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        raise Exception('Unknown worker_type: {}'.format(worker_type))
+
+
 def operator(name, params):
     source_instance_name = params['source_instance_name']
     target_instance_name = params['target_instance_name']
     target_organization_id = params['target_organization_id']
     target_package_name_prefix = params['target_package_name_prefix']
     target_package_title_prefix = params['target_package_title_prefix']
+    # get all source packages metadata using paginated package_search instead of package_list + package_show for each package
+    use_package_search = params.get('use_package_search', True)
+    # sync only source packages modified since the last successful sync, with a periodic full sync
+    # the high-water metadata_modified is stored in an automation group on the target instance
+    incremental = params.get('incremental', False)
+    full_sync_interval_hours = params.get('full_sync_interval_hours', DEFAULT_FULL_SYNC_INTERVAL_HOURS)
+    # skip downloading source resources if hash / size / last modified / etag are the same as recorded on the target resources
+    use_resource_signatures = params.get('use_resource_signatures', True)
+    # number of packages to sync concurrently, worker_type is thread or process
+    # concurrent requests per instance can be limited with CKAN_MAX_CONCURRENCY / CKAN_INSTANCE_<NAME>_MAX_CONCURRENCY env vars
+    # (for process workers the limit applies to each process)
+    workers = int(params.get('workers', 1))
+    worker_type = params.get('worker_type', 'thread')
     print('starting ckan_sync operator')
-    print('source_instance_name={} target_instance_name={} target_organization_id={} target_package_name_prefix={} target_package_title_prefix={}'.format(
-        source_instance_name, target_instance_name, target_organization_id, target_package_name_prefix, target_package_title_prefix))
+    print('source_instance_name={} target_instance_name={} target_organization_id={} target_package_name_prefix={} target_package_title_prefix={} use_package_search={} incremental={} workers={} worker_type={}'.format(
+        source_instance_name, target_instance_name, target_organization_id, target_package_name_prefix, target_package_title_prefix, use_package_search, incremental,
+        workers, worker_type))
     stats = defaultdict(int)
-    for source_package_name in ckan.package_list_public(source_instance_name):
-        source_package = None
-        try:
-            if source_package_name.startswith(target_package_name_prefix):
-                stats['source_packages_invalid_prefix'] += 1
-                continue
-            source_package = ckan.package_show_public(source_instance_name, source_package_name)
-            if source_package['private'] or source_package['state'] != 'active' or source_package['type'] != 'dataset':
-                stats['source_packages_invalid_attrs'] += 1
-                continue
-            stats['source_packages_valid'] += 1
-            target_package_name = '{}{}'.format(target_package_name_prefix, source_package_name)
-            target_existing_package = ckan.package_show(target_instance_name, target_package_name)
-            if target_existing_package and target_existing_package['state'] != 'deleted':
-                _update_existing_package(source_instance_name, source_package, target_instance_name, target_organization_id, target_package_name,
-                                         target_existing_package, target_package_title_prefix, stats)
-            else:
-                _create_new_package(source_instance_name, source_package, target_instance_name, target_organization_id, target_package_name,
-                                    target_package_title_prefix, stats)
-            if stats['source_packages_valid'] % 10 == 0:
+    watermark, fq = None, None
+    if incremental:
+        assert use_package_search, 'incremental sync requires use_package_search'
+        watermark_key = _get_watermark_key(source_instance_name, target_organization_id, target_package_name_prefix)
+        watermark = ckan.automation_group_get(target_instance_name, AUTOMATION_GROUP_NAME, watermark_key)
+        fq = _get_incremental_fq(watermark, full_sync_interval_hours)
+        if fq:
+            print('incremental sync of source packages: {}'.format(fq))
+            stats['incremental_sync'] = 1
+        else:
+            print('full sync of source packages')
+            stats['full_sync'] = 1
+    # recorded before the first package_search page is fetched
+    sync_start_time = datetime.datetime.utcnow()
+    high_water_metadata_modified = (watermark or {}).get('metadata_modified') or ''
+    sync_source_package = functools.partial(_sync_source_package, {
+        'source_instance_name': source_instance_name,
+        'target_instance_name': target_instance_name,
+        'target_organization_id': target_organization_id,
+        'target_package_name_prefix': target_package_name_prefix,
+        'target_package_title_prefix': target_package_title_prefix,
+        'use_resource_signatures': use_resource_signatures,
+    })
+    executor = _get_executor(workers, worker_type)
+    try:
+        for package_stats, metadata_modified in utils.iterate_executor_results(
+            executor, sync_source_package, _iterate_source_packages(source_instance_name, use_package_search, fq=fq),
+            max_pending=workers * 2, ordered=False
+        ):
+            high_water_metadata_modified = max(high_water_metadata_modified, metadata_modified)
+            for key, value in package_stats.items():
+                stats[key] += value
+            if package_stats.get('source_packages_valid') and stats['source_packages_valid'] % 10 == 0:
                 print(dict(stats))
-        except Exception:
-            traceback.print_exc()
-            print('exception processing source package {}: {}'.format(source_package_name, source_package))
-            stats['source_packages_exceptions'] += 1
+    finally:
+        if executor:
+            executor.shutdown()
     print(dict(stats))
+    if incremental and stats['source_packages_exceptions'] == 0 and high_water_metadata_modified:
+        watermark_metadata_modified = _get_watermark_metadata_modified(sync_start_time, high_water_metadata_modified)
+        print('updating watermark: metadata_modified={}'.format(watermark_metadata_modified))
+        ckan.automation_group_set(target_instance_name, AUTOMATION_GROUP_NAME, watermark_key, {
+            'metadata_modified': watermark_metadata_modified,
+            'last_full_sync': watermark['last_full_sync'] if fq else sync_start_time.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        })
     return stats['source_packages_exceptions'] == 0
 
 
 if __name__ == '__main__':
     import sys
-    import json
     exit(0 if operator('_', json.loads(sys.argv[1])) else 1)
@@ -1,64 +1,18 @@
 import os
 import sys
 import json
-import shutil
-import hashlib
 import tempfile
-import requests
+import threading
+import traceback
 import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
-import geopandas
-from osgeo import ogr
-import dataflows as DF
-
-from datacity_ckan_dgp.package_processing_tasks.geojson import projector
+from datacity_ckan_dgp import utils
+from datacity_ckan_dgp.gis import arcgis, feature_store, download, formats
+from datacity_ckan_dgp.gis.arcgis import fetch_gis_json
 from datacity_ckan_dgp import ckan
 
 
-def gis_query_geojson_iterate_all(gis_url):
-    url = gis_url.rstrip('/') + '/query'
-    result_offset = 0
-    result_record_count = 1000
-    while True:
-        params = {
-            'where': '1=1',
-            'outFields': '*',
-            'f': 'geojson',
-            'resultOffset': result_offset,
-            'resultRecordCount': result_record_count
-        }
-        res = requests.get(url, params=params)
-        try:
-            assert res.status_code == 200
-            data = res.json()
-            assert data['type'] == 'FeatureCollection'
-            if not data['features']:
-                break
-            for feature in data['features']:
-                yield feature
-                result_offset += 1
-        except Exception as e:
-            raise Exception(f'failed to fetch geojson from {url} with params {params}\n{res.content}') from e
-
-
-def iterate_gis_jsonlines(tmpdir):
-    with open(os.path.join(tmpdir, 'gis.jsonlines'), 'r') as f:
-        for line in f:
-            if line.strip():
-                try:
-                    yield json.loads(line)
-                except Exception as e:
-                    raise Exception(f'failed to parse json line: {line}') from e
-
-
-def fetch_gis_json(gis_url):
-    gis_json_url = f'{gis_url}?f=pjson'
-    print(f'fetching gis json from {gis_json_url}')
-    res = requests.get(gis_json_url)
-    res.raise_for_status()
-    return res.json()
-
-
 @contextlib.contextmanager
 def tempdir(tmpdir):
     if tmpdir:
@@ -69,214 +23,61 @@ def tempdir(tmpdir):
             yield tmpdir
 
 
-class FailedToConvertFeature(Exception):
-    pass
-
-
-def geojson_feature_to_itm(feature):
-    if feature['type'] != 'Feature':
-        raise FailedToConvertFeature(f'feature is not a Feature: {feature}')
-    geometry = feature.get('geometry') or {}
-    if geometry.get('type') == 'Polygon':
-        new_coordinates = []
-        for ring in feature['geometry']['coordinates']:
-            new_ring = []
-            for coord in ring:
-                new_ring.append([*projector(*coord)])
-            new_coordinates.append(new_ring)
-        feature['geometry']['coordinates'] = new_coordinates
-    elif geometry.get('type') == 'MultiPolygon':
-        new_coordinates = []
-        for polygon in feature['geometry']['coordinates']:
-            new_polygon = []
-            for ring in polygon:
-                new_ring = []
-                for coord in ring:
-                    new_ring.append([*projector(*coord)])
-                new_polygon.append(new_ring)
-            new_coordinates.append(new_polygon)
-        feature['geometry']['coordinates'] = new_coordinates
-    else:
-        raise FailedToConvertFeature(f'unsupported geometry type: {geometry.get("type")}')
-    return feature
-
-
-def features_to_csv(features, fields=None):
-    for feature in features:
-        if not fields:
-            yield feature['properties']
-        else:
-            yield {k: str(feature['properties'].get(k) or '') for k in fields}
-
-
-def geojson_to_kml(geojson_path, kml_path):
-    ogr.RegisterAll()
-    geojson_ds = ogr.Open(geojson_path)
-    kml_driver = ogr.GetDriverByName('KML')
-    kml_ds = kml_driver.CreateDataSource(kml_path)
-    for i in range(geojson_ds.GetLayerCount()):
-        layer = geojson_ds.GetLayerByIndex(i)
-        kml_layer = kml_ds.CreateLayer(layer.GetName(), geom_type=layer.GetGeomType())
-        layer_defn = layer.GetLayerDefn()
-        for j in range(layer_defn.GetFieldCount()):
-            field_defn = layer_defn.GetFieldDefn(j)
-            kml_layer.CreateField(field_defn)
-        for feature in layer:
-            kml_layer.CreateFeature(feature.Clone())
-
-
-def get_geoxml_coordinates_item(root_item):
-    res = '<item type="list">'
-    for item in root_item:
-        if isinstance(item, list):
-            res += get_geoxml_coordinates_item(item)
-        else:
-            res += f'<item type="float">{item}</item>'
-    res += '</item>'
-    return res
-
-
-def geojson_to_geoxml(features, geoxml_path, itm=False):
-    with open(geoxml_path, 'w') as f:
-        f.write('<?xml version="1.0" ?>\n')
-        f.write('<root>\n')
-        f.write('  <type type="str">FeatureCollection</type>\n')
-        f.write('  <features type="list">\n')
-        for feature in features:
-            if itm:
-                feature = geojson_feature_to_itm(feature)
-            f.write('    <item type="dict">\n')
-            if feature['type'] != 'Feature':
-                raise FailedToConvertFeature(f'feature is not a Feature: {feature}')
-            f.write('      <type type="str">Feature</type>\n')
-            geometry = feature.get('geometry') or {}
-            f.write('      <geometry type="dict">\n')
-            if geometry.get('type') not in ['Polygon', 'MultiPolygon']:
-                raise FailedToConvertFeature(f'unsupported geometry type: {geometry.get("type")}')
-            f.write(f'        <type type="str">{geometry.get("type")}</type>\n')
-            f.write('        <coordinates type="list">\n')
-            for item in geometry.get('coordinates', []):
-                f.write(f'          {get_geoxml_coordinates_item(item)}\n')
-            f.write('        </coordinates>\n')
-            f.write('      </geometry>\n')
-            f.write('    </item>\n')
-        f.write('</root>\n')
-
-
-def create_gis_data(gis_url, tmpdir):
-    if os.path.exists(os.path.join(tmpdir, 'gis.json')):
+# number of processes for generating the formats, and number of threads for uploading the resources
+# with a single format worker all the formats are generated in a single pass over the features
+FORMAT_WORKERS = int(os.getenv('GIS_FETCHER_FORMAT_WORKERS', '1'))
+UPLOAD_WORKERS = int(os.getenv('GIS_FETCHER_UPLOAD_WORKERS', '1'))
+# optional comma-separated names from formats.INDEXED_FORMATS (e.g. flatgeobuf,geoparquet,geopackage) which are
+# published as additional resources, formats which the installed GDAL does not support are skipped
+INDEXED_FORMATS = [name.strip() for name in os.getenv('GIS_FETCHER_INDEXED_FORMATS', '').split(',') if name.strip()]
+
+# format groups from formats.FORMAT_GROUP_FILES
+FORMAT_GROUPS = ['geojson_geoxml', 'shapefile', 'csv_xlsx_xml', 'kml', *INDEXED_FORMATS]
+
+RESOURCE_FILES = [
+    ('shapefile', 'SHP', 'shapefile.zip'),
+    ('csv', 'CSV', 'gis.csv'),
+    ('xlsx', 'XLSX', 'gis.xlsx'),
+    ('geojson', 'GeoJSON', 'gis.geojson'),
+    ('geojson', 'GeoJSON-ITM', 'gis.itm.geojson'),
+    ('xml', 'XML', 'gis.xml'),
+    ('kml', 'KML', 'gis.kml'),
+    ('geoxml', 'GeoXML', 'gis.geoxml'),
+    ('geoxml', 'GeoXML-ITM', 'gis.itm.geoxml'),
+    *[
+        (formats.INDEXED_FORMATS[format_name][1], formats.INDEXED_FORMATS[format_name][2], f'gis.{formats.INDEXED_FORMATS[format_name][1]}')
+        for format_name in INDEXED_FORMATS
+    ],
+]
+
+
+def create_gis_data(gis_url, tmpdir, store=None, format_workers=FORMAT_WORKERS):
+    # returns dict of file name: md5 for the files which were hashed while generated
+    # returns None if the formats generation was skipped because nothing changed since the last published run
+    # store is a feature_store.FeatureStore, if set, the features are fetched incrementally into the store
+    if os.path.exists(os.path.join(tmpdir, 'gis.json')) and not store:
         print("WARNING: Using existing gis.json from tmpdir")
+        with open(os.path.join(tmpdir, 'gis.json')) as f:
+            gis_json = json.load(f)
     else:
+        gis_json = fetch_gis_json(gis_url)
         with open(os.path.join(tmpdir, 'gis.json'), 'w') as f:
-            json.dump(fetch_gis_json(gis_url), f, ensure_ascii=False, indent=2)
-    if os.path.exists(os.path.join(tmpdir, 'gis.jsonlines')):
-        print("WARNING: Using existing gis.jsonlines from tmpdir")
+            json.dump(gis_json, f, ensure_ascii=False, indent=2)
+    if store:
+        if feature_store.update_feature_store(store, gis_url, gis_json):
+            store.set_metadata('pending_publish', True)
+        if not store.get_metadata('pending_publish'):
+            return None
+        download.write_features_jsonlines(store.iterate_features(), os.path.join(tmpdir, 'gis.jsonlines'))
     else:
-        with open(os.path.join(tmpdir, 'gis.jsonlines'), 'w') as f:
-            for feature in gis_query_geojson_iterate_all(gis_url):
-                f.write(json.dumps(feature, ensure_ascii=False) + '\n')
-    create_geojson(tmpdir)
-    create_itm_geojson(tmpdir)
-    create_shapefile(tmpdir)
-    feature_properties = create_csv_xlsx(tmpdir)
-    create_xml(feature_properties, tmpdir)
-    create_kml(tmpdir)
-    create_geoxml(tmpdir)
-    create_itm_geoxml(tmpdir)
-
-
-def create_itm_geoxml(tmpdir):
-    print("Create gis.itm.geoxml")
-    try:
-        geojson_to_geoxml(iterate_gis_jsonlines(tmpdir), os.path.join(tmpdir, 'gis.itm.geoxml'), itm=True)
-    except FailedToConvertFeature as e:
-        print(str(e))
-        print('failed to convert feature to geoxml')
-        os.unlink(os.path.join(tmpdir, 'gis.itm.geoxml'))
-
-
-def create_geoxml(tmpdir):
-    print("Create gis.geoxml")
-    try:
-        geojson_to_geoxml(iterate_gis_jsonlines(tmpdir), os.path.join(tmpdir, 'gis.geoxml'))
-    except FailedToConvertFeature as e:
-        print(str(e))
-        print('failed to convert feature to geoxml')
-        os.unlink(os.path.join(tmpdir, 'gis.geoxml'))
-
-
-def create_kml(tmpdir):
-    print("Create gis.kml")
-    geojson_to_kml(os.path.join(tmpdir, 'gis.geojson'), os.path.join(tmpdir, 'gis.kml'))
-
-
-def create_xml(feature_properties, tmpdir):
-    print("Create gis.xml")
-    with open(os.path.join(tmpdir, 'gis.xml'), 'w') as f:
-        f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
-        f.write('<root>\n')
-        for properties in features_to_csv(iterate_gis_jsonlines(tmpdir), fields=feature_properties):
-            f.write('  <item>\n')
-            for k, v in properties.items():
-                v = v.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace(
-                    '\'', '&apos;')
-                f.write(f'    <{k} type="str">{v}</{k}>\n')
-            f.write('  </item>\n')
-        f.write('</root>\n')
-
-
-def create_csv_xlsx(tmpdir):
-    print("Create gis.csv, gis.xlsx")
-    feature_properties = set()
-    for row in features_to_csv(iterate_gis_jsonlines(tmpdir)):
-        feature_properties.update(row.keys())
-    DF.Flow(
-        features_to_csv(iterate_gis_jsonlines(tmpdir), fields=feature_properties),
-        DF.dump_to_path(os.path.join(tmpdir, 'csv')),
-        DF.dump_to_path(os.path.join(tmpdir, 'xlsx'), format='xlsx')
-    ).process()
-    shutil.copyfile(os.path.join(tmpdir, 'csv', 'res_1.csv'), os.path.join(tmpdir, 'gis.csv'))
-    shutil.copyfile(os.path.join(tmpdir, 'xlsx', 'res_1.xlsx'), os.path.join(tmpdir, 'gis.xlsx'))
-    return feature_properties
-
-
-def create_shapefile(tmpdir):
-    print("Create shapefile.zip")
-    geojson_data = geopandas.read_file(os.path.join(tmpdir, 'gis.geojson'))
-    os.makedirs(os.path.join(tmpdir, 'shapefile'), exist_ok=True)
-    geojson_data.to_file(os.path.join(tmpdir, 'shapefile/gis.shp'), driver='ESRI Shapefile', encoding='utf-8')
-    os.system(f'cd {tmpdir} && zip -r shapefile.zip shapefile')
-
-
-def create_itm_geojson(tmpdir):
-    print("Create gis.itm.geojson")
-    try:
-        with open(os.path.join(tmpdir, 'gis.itm.geojson'), 'w') as f:
-            f.write('{"type": "FeatureCollection","features": [\n')
-            for i, feature in enumerate(iterate_gis_jsonlines(tmpdir)):
-                if i > 0:
-                    f.write(',\n')
-                feature = geojson_feature_to_itm(feature)
-                f.write('  ' + json.dumps(feature, ensure_ascii=False))
-            f.write(']}')
-    except FailedToConvertFeature as e:
-        print(str(e))
-        print('failed to convert feature to itm')
-        os.unlink(os.path.join(tmpdir, 'gis.itm.geojson'))
-
-
-def create_geojson(tmpdir):
-    print("Create geojson")
-    with open(os.path.join(tmpdir, 'gis.geojson'), 'w') as f:
-        f.write('{"type": "FeatureCollection","features": [\n')
-        for i, feature in enumerate(iterate_gis_jsonlines(tmpdir)):
-            if i > 0:
-                f.write(',\n')
-            f.write('  ' + json.dumps(feature, ensure_ascii=False))
-        f.write(']}')
-
-
-def update_resource(target_instance_name, package, format_, resource_name, file_path):
+        download.download_features_jsonlines(gis_url, gis_json, os.path.join(tmpdir, 'gis.jsonlines'))
+    schema = download.load_schema(os.path.join(tmpdir, 'gis.jsonlines'))
+    return formats.create_formats(tmpdir, schema, FORMAT_GROUPS, format_workers)
+
+
+def update_resource(target_instance_name, package, format_, resource_name, file_path, file_hash=None):
+    # file_hash is the md5 of the file if it was calculated while the file was generated
+    # returns the resource id, or None if the file does not exist
     print(f'updating resource {resource_name}...')
     if os.path.exists(file_path):
         existing_resource_id = None
@@ -285,27 +86,138 @@ def update_resource(target_instance_name, package, format_, resource_name, file_
             if resource['name'] == resource_name:
                 existing_resource_id = resource['id']
                 existing_resource_hash = resource.get('hash')
-        new_resource_hash = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
+        new_resource_hash = file_hash or utils.hash_file(file_path)['md5']
         if not existing_resource_id:
             print('no existing resource found, creating new resource')
-            res = ckan.resource_create(target_instance_name, {
-                'package_id': package['id'],
-                'format': format_,
-                'name': resource_name,
-                'hash': new_resource_hash
-            }, files=[('upload', open(file_path, 'rb'))])
+            with open(file_path, 'rb') as f:
+                res = ckan.resource_create(target_instance_name, {
+                    'package_id': package['id'],
+                    'format': format_,
+                    'name': resource_name,
+                    'hash': new_resource_hash
+                }, files=[('upload', f)])
             assert res['success'], str(res)
+            return res['result']['id']
         elif existing_resource_hash != new_resource_hash:
             print('existing resource found, but hash is different, updating resource data')
-            res = ckan.resource_update(target_instance_name, {
-                'id': existing_resource_id,
-                'hash': new_resource_hash
-            }, files=[('upload', open(file_path, 'rb'))])
+            with open(file_path, 'rb') as f:
+                res = ckan.resource_update(target_instance_name, {
+                    'id': existing_resource_id,
+                    'hash': new_resource_hash
+                }, files=[('upload', f)])
             assert res['success'], str(res)
         else:
             print('existing resource found, and hash is the same, skipping resource update')
+        return existing_resource_id
     else:
         print(f'file {file_path} does not exist, skipping resource update')
+        return None
+
+
+def update_resources(target_instance_name, package, tmpdir, file_hashes, upload_workers=UPLOAD_WORKERS, resource_name_prefix=''):
+    # resource_name_prefix is used to distinguish the resources of multiple layers in a single package
+
+    def update(resource_file):
+        format_, resource_name, file_name = resource_file
+        return update_resource(
+            target_instance_name, package, format_, f'{resource_name_prefix}{resource_name}', os.path.join(tmpdir, file_name),
+            file_hashes.get(file_name)
+        )
+
+    with ThreadPoolExecutor(max_workers=upload_workers) if upload_workers > 1 else contextlib.nullcontext() as executor:
+        resource_ids = [
+            resource_id for resource_id
+            in utils.iterate_executor_results(executor, update, RESOURCE_FILES, max_pending=len(RESOURCE_FILES))
+            if resource_id
+        ]
+    if upload_workers > 1 and set(resource_ids) - {resource['id'] for resource in package['resources']}:
+        # resources created concurrently may be out of order
+        res = ckan.package_resource_reorder(
+            target_instance_name, package['id'], merge_resource_ids([resource['id'] for resource in package['resources']], resource_ids)
+        )
+        assert res['success'], str(res)
+
+
+def merge_resource_ids(package_resource_ids, layer_resource_ids):
+    # returns the order of all the package resources, the layer resources are placed in order at the position of the
+    # first existing layer resource (or at the end), so the resources of other layers in the same package keep their order
+    other_resource_ids = [resource_id for resource_id in package_resource_ids if resource_id not in layer_resource_ids]
+    layer_index = next((i for i, resource_id in enumerate(package_resource_ids) if resource_id in layer_resource_ids), len(other_resource_ids))
+    return other_resource_ids[:layer_index] + list(layer_resource_ids) + other_resource_ids[layer_index:]
+
+
+def get_or_create_package(target_instance_name, target_package_id, title, target_organization_id):
+    package = ckan.package_show(target_instance_name, target_package_id)
+    if not package:
+        res = ckan.package_create(target_instance_name, {
+            'name': target_package_id,
+            'title': title,
+            'owner_org': target_organization_id
+        })
+        assert res['success'], str(res)
+        package = res['result']
+    return package
+
+
+def fetch_layer(gis_url, tmpdir, params, target_package_id, package_title=None, resource_name_prefix='', package_lock=None):
+    # fetches a single layer and updates its resources in the target package
+    # package_lock is used to serialize the resources update of layers which are published to the same package
+    target_instance_name = params.get('target_instance_name')
+    with feature_store.open_feature_store(gis_url, params.get('state_dir'), params.get('incremental')) as store:
+        file_hashes = create_gis_data(gis_url, tmpdir, store=store, format_workers=params.get('format_workers', FORMAT_WORKERS))
+        if file_hashes is None:
+            print(f'{gis_url}: no changes since the last published run, skipping formats generation and resources update')
+            return
+        with open(os.path.join(tmpdir, 'gis.json'), 'r') as f:
+            gis_json = json.load(f)
+        name = gis_json['name']
+        print(f'gis name={name}')
+        if target_instance_name:
+            with package_lock or contextlib.nullcontext():
+                package = get_or_create_package(target_instance_name, target_package_id, package_title or name, params['target_organization_id'])
+                update_resources(
+                    target_instance_name, package, tmpdir, file_hashes, params.get('upload_workers', UPLOAD_WORKERS),
+                    resource_name_prefix=resource_name_prefix
+                )
+        if store:
+            store.set_metadata('pending_publish', False)
+
+
+def fetch_service_layers(gis_url, tmpdir, params, target_package_id):
+    # fetches all the feature layers of a MapServer / FeatureServer concurrently, all layers share the gis session
+    # multi_layer_mode=package_per_layer: each layer is published to package <target_package_id>_<layer id>
+    # multi_layer_mode=single_package: all layers are published to target_package_id, resource names are prefixed with the layer name
+    multi_layer_mode = params.get('multi_layer_mode', 'package_per_layer')
+    assert multi_layer_mode in ('package_per_layer', 'single_package'), f'unknown multi_layer_mode: {multi_layer_mode}'
+    layer_workers = int(params.get('layer_workers', arcgis.MAX_LAYER_WORKERS))
+    service_json = fetch_gis_json(gis_url)
+    service_name = arcgis.get_service_name(gis_url, service_json)
+    layers = arcgis.get_service_layers(service_json)
+    print(f'fetching {len(layers)} layers of {service_name} (multi_layer_mode={multi_layer_mode} layer_workers={layer_workers})')
+    package_lock = threading.Lock()
+
+    def fetch(layer):
+        layer_url = arcgis.get_layer_url(gis_url, layer)
+        try:
+            with tempdir(os.path.join(tmpdir, f'layer_{layer["id"]}')) as layer_tmpdir:
+                if multi_layer_mode == 'single_package':
+                    fetch_layer(layer_url, layer_tmpdir, params, target_package_id, package_title=service_name,
+                                resource_name_prefix=f'{layer["name"]} ', package_lock=package_lock)
+                else:
+                    fetch_layer(layer_url, layer_tmpdir, params, target_package_id and f'{target_package_id}_{layer["id"]}')
+            return None
+        except Exception:
+            traceback.print_exc()
+            print(f'failed to fetch layer {layer_url}')
+            return layer_url
+
+    with ThreadPoolExecutor(max_workers=layer_workers) if layer_workers > 1 else contextlib.nullcontext() as executor:
+        failed_layer_urls = [
+            layer_url for layer_url
+            in utils.iterate_executor_results(executor, fetch, layers, max_pending=layer_workers * 2, ordered=False)
+            if layer_url
+        ]
+    assert not failed_layer_urls, f'failed to fetch layers: {failed_layer_urls}'
 
 
 def operator(name, params):
@@ -317,43 +229,27 @@ def operator(name, params):
     else:
         target_package_id, target_organization_id = None, None
     tmpdir = params.get('tmpdir')
+    incremental = params.get('incremental')
     with tempdir(tmpdir) as tmpdir:
         print('starting gis_fetcher operator')
         print(f'gis_url={gis_url} target_instance_name={target_instance_name} target_package_id={target_package_id} target_organization_id={target_organization_id}')
-        print(f'tmpdir={tmpdir}')
-        create_gis_data(gis_url, tmpdir)
-        with open(os.path.join(tmpdir, 'gis.json'), 'r') as f:
-            gis_json = json.load(f)
-        name = gis_json['name']
-        print(f'gis name={name}')
-        if target_instance_name:
-            package = ckan.package_show(target_instance_name, target_package_id)
-            if not package:
-                res = ckan.package_create(target_instance_name, {
-                    'name': target_package_id,
-                    'title': name,
-                    'owner_org': target_organization_id
-                })
-                assert res['success'], str(res)
-                package = res['result']
-            for format_, resource_name, file_name in [
-                ('shapefile', 'SHP', 'shapefile.zip'),
-                ('csv', 'CSV', 'gis.csv'),
-                ('xlsx', 'XLSX', 'gis.xlsx'),
-                ('geojson', 'GeoJSON', 'gis.geojson'),
-                ('geojson', 'GeoJSON-ITM', 'gis.itm.geojson'),
-                ('xml', 'XML', 'gis.xml'),
-                ('kml', 'KML', 'gis.kml'),
-                ('geoxml', 'GeoXML', 'gis.geoxml'),
-                ('geoxml', 'GeoXML-ITM', 'gis.itm.geoxml'),
-            ]:
-                update_resource(target_instance_name, package, format_, resource_name, os.path.join(tmpdir, file_name))
+        print(f'tmpdir={tmpdir} incremental={incremental}')
+        if arcgis.is_service_url(gis_url):
+            fetch_service_layers(gis_url, tmpdir, params, target_package_id)
+        else:
+            fetch_layer(gis_url, tmpdir, params, target_package_id)
     print('gis_fetcher operator completed successfully')
 
 
 # test on ckan instance:
 # python3 -m datacity_ckan_dgp.operators.gis_fetcher '{"gis_url": "https://gisserver.haifa.muni.il/arcgiswebadaptor/rest/services/PublicSite/Haifa_Eng_Public/MapServer/13", "target_instance_name": "LOCAL_DEVELOPMENT", "target_package_id": "yeudei_karka", "target_organization_id": "muni", "tmpdir": ".data/gis_fetcher_tmpdir"}'
 
+# test incremental mode, a second run skips the formats generation if the layer was not changed:
+# GIS_FETCHER_STATE_DIR=.data/gis_fetcher_state python3 -m datacity_ckan_dgp.operators.gis_fetcher '{"gis_url": "https://gisserver.haifa.muni.il/arcgiswebadaptor/rest/services/PublicSite/Haifa_Eng_Public/MapServer/13", "incremental": true}'
+
+# test fetching all layers of a MapServer to a single package:
+# python3 -m datacity_ckan_dgp.operators.gis_fetcher '{"gis_url": "https://gisserver.haifa.muni.il/arcgiswebadaptor/rest/services/PublicSite/Haifa_Eng_Public/MapServer", "target_instance_name": "LOCAL_DEVELOPMENT", "target_package_id": "haifa_eng_public", "target_organization_id": "muni", "multi_layer_mode": "single_package"}'
+
 # test locally without ckan instance:
 # python3 -m datacity_ckan_dgp.operators.gis_fetcher '{"gis_url": "https://gisserver.haifa.muni.il/arcgiswebadaptor/rest/services/PublicSite/Haifa_Eng_Public/MapServer/13", "tmpdir": ".data/gis_fetcher_tmpdir"}'
 
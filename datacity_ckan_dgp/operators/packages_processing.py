@@ -3,7 +3,20 @@ from datacity_ckan_dgp import ckan
 from datacity_ckan_dgp.utils.locking import instance_package_lock
 
 
-def operator(name, params, only_package_id=None, with_lock=True):
+def _iterate_packages(instance_name, use_package_search):
+    # yields tuples of (package_id, search_package)
+    # search_package is only used to skip already processed packages, the processing task always fetches the
+    # package using package_show after the package lock is taken
+    if use_package_search:
+        for package in ckan.package_search_iterate(instance_name):
+            yield package['name'], package
+    else:
+        for package_id in ckan.package_list(instance_name):
+            yield package_id, None
+
+
+def operator(name, params, only_package_id=None, with_lock=True, local_files=None):
+    # local_files is an optional dict of resource id to local path, used instead of downloading the resources of only_package_id
     instance_name = params['instance_name']
     skip_package_ids = params.get('skip_package_ids')
     task = params['task']
@@ -20,18 +33,18 @@ def operator(name, params, only_package_id=None, with_lock=True):
         else:
             try:
                 with instance_package_lock(instance_name, only_package_id, with_lock):
-                    process_package(instance_name, only_package_id)
+                    process_package(instance_name, only_package_id, local_files=local_files)
             except:
                 traceback.print_exc()
                 num_errors += 1
     else:
-        for package_id in ckan.package_list(instance_name):
+        for package_id, search_package in _iterate_packages(instance_name, params.get('use_package_search', True)):
             if skip_package_ids and package_id in skip_package_ids:
                 print(f'Skipping package {package_id} as it is in skip_package_ids')
             else:
                 try:
                     with instance_package_lock(instance_name, package_id, with_lock):
-                        process_package(instance_name, package_id)
+                        process_package(instance_name, package_id, search_package=search_package)
                 except:
                     traceback.print_exc()
                     num_errors += 1
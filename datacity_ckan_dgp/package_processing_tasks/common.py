@@ -1,3 +1,4 @@
+import os
 import traceback
 from contextlib import contextmanager
 
@@ -5,18 +6,34 @@ from datacity_ckan_dgp import ckan
 from datacity_ckan_dgp import utils
 
 
-def process_package(instance_name, package_id, task_id, is_resource_valid_for_processing, process_resource):
-    package = ckan.package_show(instance_name, package_id)
+def get_resources_to_process(instance_name, package, task_id, is_resource_valid_for_processing):
+    # yields tuples of (resource, package_extras_processed_res, is_processed)
+    package_extras = {e['key']: e['value'] for e in package.get('extras', [])}
     for resource in package['resources']:
         if is_resource_valid_for_processing(instance_name, package, resource):
             package_extras_processed_res = "processed_res_{}_{}".format(task_id, resource['id'])
-            package_extras = {e['key']: e['value'] for e in package.get('extras', [])}
-            if package_extras.get(package_extras_processed_res) == "yes":
-                print("Already processed {} ({} > {} > {} {})".format(task_id, instance_name, package['name'], resource['name'], resource['id']))
-            else:
-                print("Starting {} processing ({} > {} > {} {})".format(task_id, instance_name, package['name'], resource['name'], resource['id']))
-                process_resource(instance_name, package, resource, package_extras_processed_res)
-                print("OK")
+            yield resource, package_extras_processed_res, package_extras.get(package_extras_processed_res) == "yes"
+
+
+def process_package(instance_name, package_id, task_id, is_resource_valid_for_processing, process_resource, search_package=None, local_files=None):
+    # search_package can be provided from package_search results, it may be stale because it was fetched before the
+    # package lock was taken, so it's only used to skip packages without unprocessed resources, otherwise the package
+    # is fetched again using package_show and the processing is done according to it
+    # local_files is an optional dict of resource id to the local path of the resource data, e.g. from the fetcher
+    # which just uploaded it, these resources are processed from the local file instead of downloading them
+    if search_package is not None and all(
+        is_processed for _, _, is_processed in get_resources_to_process(instance_name, search_package, task_id, is_resource_valid_for_processing)
+    ):
+        print("Already processed {} ({} > {})".format(task_id, instance_name, package_id))
+        return
+    package = ckan.package_show(instance_name, package_id)
+    for resource, package_extras_processed_res, is_processed in get_resources_to_process(instance_name, package, task_id, is_resource_valid_for_processing):
+        if is_processed:
+            print("Already processed {} ({} > {} > {} {})".format(task_id, instance_name, package['name'], resource['name'], resource['id']))
+        else:
+            print("Starting {} processing ({} > {} > {} {})".format(task_id, instance_name, package['name'], resource['name'], resource['id']))
+            process_resource(instance_name, package, resource, package_extras_processed_res, local_filename=(local_files or {}).get(resource['id']))
+            print("OK")
 
 
 def update_package_extras(instance_name, package, package_extras_processed_res):
@@ -26,7 +43,16 @@ def update_package_extras(instance_name, package, package_extras_processed_res):
 
 
 @contextmanager
-def try_download_resource_url(url, max_bytes=None):
+def try_download_resource_url(url, max_bytes=None, local_filename=None):
+    # if local_filename is provided and exists it is used instead of downloading the url
+    if local_filename and os.path.exists(local_filename):
+        if max_bytes and os.path.getsize(local_filename) > max_bytes:
+            print(f"Exceeded max bytes in local resource file {local_filename}")
+            yield True, None
+        else:
+            print(f"Using local resource file {local_filename}")
+            yield False, local_filename
+        return
     with utils.tempdir() as tmpdir:
         exceeded_max_bytes = False
         downloaded_filename = None
@@ -1,18 +1,23 @@
 import os
 import sys
 import math
+import functools
 
-import pyproj
+import numpy as np
 import geojson
 import dataflows as DF
 from geojson import Feature, Point, FeatureCollection
 
 from datacity_ckan_dgp import ckan
 from datacity_ckan_dgp import utils
+from datacity_ckan_dgp.utils import reprojection
 from datacity_ckan_dgp.package_processing_tasks import common
 
 
 GEOJSON_PROCESSING_MAX_GB = float(os.getenv('GEOJSON_PROCESSING_MAX_GB', '1'))
+# optional comma-separated names from gis.formats.INDEXED_FORMATS (e.g. flatgeobuf,geoparquet,geopackage)
+# which are created as additional resources alongside the geojson
+GEOJSON_PROCESSING_INDEXED_FORMATS = [name.strip() for name in os.getenv('GEOJSON_PROCESSING_INDEXED_FORMATS', '').split(',') if name.strip()]
 LAT_LON_FIELD_NAMES = (
     ('lat', 'lon'),
     ('lat', 'long'),
@@ -23,8 +28,8 @@ LAT_LON_FIELD_NAMES = (
 )
 
 
-CRS = '+ellps=GRS80 +k=1.00007 +lat_0=31.73439361111111 +lon_0=35.20451694444445 +no_defs +proj=tmerc +units=m +x_0=219529.584 +y_0=626907.39'
-projector = pyproj.Proj(CRS)
+CRS = reprojection.ITM_CRS
+projector = reprojection.get_projector(CRS)
 
 
 def pop_case_insensitive(row, field, default=None):
@@ -38,7 +43,7 @@ def pop_case_insensitive(row, field, default=None):
     return default
 
 
-def get_lat_lon_values(row, lon_field, lat_field):
+def get_raw_lat_lon_values(row, lon_field, lat_field):
     try:
         lon = float(pop_case_insensitive(row, lon_field))
         lat = float(pop_case_insensitive(row, lat_field))
@@ -46,11 +51,28 @@ def get_lat_lon_values(row, lon_field, lat_field):
         return None, None
     if not lon or not lat or not isinstance(lon, float) or not isinstance(lat, float) or math.isnan(lon) or math.isnan(lat):
         return None, None
-    if lon > 200 and lat > 200:
-        lon, lat = projector(lon, lat, inverse=True)
     return lon, lat
 
 
+def project_lat_lon_values(lon_lat_values):
+    # gets a list of (lon, lat) tuples from get_raw_lat_lon_values
+    # values which look like ITM coordinates are projected to WGS84 in a single call
+    lon_lat_values = list(lon_lat_values)
+    itm_indexes = [i for i, (lon, lat) in enumerate(lon_lat_values) if lon and lat and lon > 200 and lat > 200]
+    if itm_indexes:
+        lons, lats = reprojection.itm_to_wgs84(
+            np.fromiter((lon_lat_values[i][0] for i in itm_indexes), dtype=float, count=len(itm_indexes)),
+            np.fromiter((lon_lat_values[i][1] for i in itm_indexes), dtype=float, count=len(itm_indexes)),
+        )
+        for i, lon, lat in zip(itm_indexes, lons.tolist(), lats.tolist()):
+            lon_lat_values[i] = (lon, lat)
+    return lon_lat_values
+
+
+def get_lat_lon_values(row, lon_field, lat_field):
+    return project_lat_lon_values([get_raw_lat_lon_values(row, lon_field, lat_field)])[0]
+
+
 def get_properties(row):
     properties = {}
     for k, v in row.items():
@@ -62,15 +84,17 @@ def get_properties(row):
     return properties
 
 
-def process_resource(instance_name, package, resource, package_extras_processed_res):
+def process_resource(instance_name, package, resource, package_extras_processed_res, local_filename=None):
     lat_field = resource.get("geo_lat_field")
     lon_field = resource.get("geo_lon_field")
     features = []
-    with common.try_download_resource_url(resource['url'], max_bytes=GEOJSON_PROCESSING_MAX_GB * 1024 * 1024 * 1024) as (exceeded_max_bytes, downloaded_filename):
+    with common.try_download_resource_url(resource['url'], max_bytes=GEOJSON_PROCESSING_MAX_GB * 1024 * 1024 * 1024, local_filename=local_filename) as (exceeded_max_bytes, downloaded_filename):
         if not exceeded_max_bytes:
+            rows_properties, lon_lat_values = [], []
             for row in DF.Flow(DF.load(downloaded_filename or resource['url'], infer_strategy=DF.load.INFER_STRINGS)).results()[0][0]:
-                properties = get_properties(row)
-                lon, lat = get_lat_lon_values(row, lon_field, lat_field)
+                rows_properties.append(get_properties(row))
+                lon_lat_values.append(get_raw_lat_lon_values(row, lon_field, lat_field))
+            for properties, (lon, lat) in zip(rows_properties, project_lat_lon_values(lon_lat_values)):
                 if lon and lat:
                     features.append(Feature(geometry=Point((lon, lat)), properties=properties))
     if not exceeded_max_bytes:
@@ -85,10 +109,30 @@ def process_resource(instance_name, package, resource, package_extras_processed_
                     'format': 'GeoJSON',
                     'name': resource['name'].replace('.csv', '') + '.geojson',
                 }, files=[('upload', f)])
+            if GEOJSON_PROCESSING_INDEXED_FORMATS:
+                create_indexed_formats_resources(instance_name, package, resource, features, tmpdir)
     common.update_package_extras(instance_name, package, package_extras_processed_res)
 
 
-def get_geojson_resource_id_from_package(instance_name, package):
+def create_indexed_formats_resources(instance_name, package, resource, features, tmpdir):
+    # imported here, so that GDAL is only required if indexed formats are enabled
+    from datacity_ckan_dgp.gis import ogr_writers, writers
+    schema = writers.get_features_schema(features)
+    for format_name in GEOJSON_PROCESSING_INDEXED_FORMATS:
+        file_path = ogr_writers.write_indexed_format(features, tmpdir, 'data', format_name, schema)
+        if file_path:
+            _, extension, resource_format, _ = ogr_writers.INDEXED_FORMATS[format_name]
+            with open(file_path, 'rb') as f:
+                ckan.resource_create(instance_name, {
+                    'package_id': package['id'],
+                    'description': resource['description'],
+                    'format': resource_format,
+                    'name': resource['name'].replace('.csv', '') + '.' + extension,
+                }, files=[('upload', f)])
+
+
+def get_geojson_resource_id_from_package(instance_name, package, datastore_infos=None):
+    # datastore_infos is an optional dict of resource id to datastore_info, used as a cache of the datastore_info calls
     valid_csv_resources = []
     valid_resources = []
     for resource in package.get('resources', []):
@@ -96,7 +140,12 @@ def get_geojson_resource_id_from_package(instance_name, package):
         if resource.get('geo_lat_field') and resource.get('geo_lon_field'):
             is_valid_resource = True
         elif resource.get('datastore_active'):
-            datastore_info = ckan.datastore_info(instance_name, resource['id'])
+            if datastore_infos is not None and resource['id'] in datastore_infos:
+                datastore_info = datastore_infos[resource['id']]
+            else:
+                datastore_info = ckan.datastore_info(instance_name, resource['id'])
+                if datastore_infos is not None:
+                    datastore_infos[resource['id']] = datastore_info
             schema_fields = {f.lower().strip(): f for f in datastore_info.get('schema', {})}
             for lat_field, lon_field in LAT_LON_FIELD_NAMES:
                 if lat_field in schema_fields and lon_field in schema_fields:
@@ -115,14 +164,19 @@ def get_geojson_resource_id_from_package(instance_name, package):
         return valid_resources[0]['id']
 
 
-def is_resource_valid_for_processing(instance_name, package, resource):
+def is_resource_valid_for_processing(instance_name, package, resource, datastore_infos=None):
     if '__geojson_resource_id' not in package:
-        package['__geojson_resource_id'] = get_geojson_resource_id_from_package(instance_name, package)
+        package['__geojson_resource_id'] = get_geojson_resource_id_from_package(instance_name, package, datastore_infos)
     return resource['id'] == package['__geojson_resource_id']
 
 
-def process_package(instance_name, package_id):
-    common.process_package(instance_name, package_id, "geojson", is_resource_valid_for_processing, process_resource)
+def process_package(instance_name, package_id, search_package=None, local_files=None):
+    # the datastore info is shared by the search_package check and the fetched package,
+    # so it's fetched once per resource
+    common.process_package(
+        instance_name, package_id, "geojson", functools.partial(is_resource_valid_for_processing, datastore_infos={}),
+        process_resource, search_package=search_package, local_files=local_files
+    )
 
 
 if __name__ == "__main__":
@@ -12,9 +12,9 @@ from datacity_ckan_dgp.package_processing_tasks import common
 XLSX_PROCESSING_MAX_GB = float(os.getenv('XLSX_PROCESSING_MAX_GB', '1'))
 
 
-def process_resource(instance_name, package, resource, package_extras_processed_res):
+def process_resource(instance_name, package, resource, package_extras_processed_res, local_filename=None):
     with utils.tempdir() as tmpdir:
-        with common.try_download_resource_url(resource['url'], max_bytes=XLSX_PROCESSING_MAX_GB*1024*1024*1024) as (exceeded_max_bytes, downloaded_filename):
+        with common.try_download_resource_url(resource['url'], max_bytes=XLSX_PROCESSING_MAX_GB*1024*1024*1024, local_filename=local_filename) as (exceeded_max_bytes, downloaded_filename):
             if not exceeded_max_bytes:
                 DF.Flow(
                     DF.load(downloaded_filename or resource['url'], infer_strategy=DF.load.INFER_STRINGS),
@@ -37,8 +37,8 @@ def is_resource_valid_for_processing(instance_name, package, resource):
     return resource.get('format') == 'CSV'
 
 
-def process_package(instance_name, package_id):
-    common.process_package(instance_name, package_id, "xlsx", is_resource_valid_for_processing, process_resource)
+def process_package(instance_name, package_id, search_package=None, local_files=None):
+    common.process_package(instance_name, package_id, "xlsx", is_resource_valid_for_processing, process_resource, search_package=search_package, local_files=local_files)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,18 @@
+import io
 import os
+import json
+import uuid
 import shutil
 import hashlib
+import zipfile
 import tempfile
 import requests
+from collections import deque
 from contextlib import contextmanager
+from concurrent.futures import wait, FIRST_COMPLETED
 from tempfile import TemporaryDirectory, mkdtemp
+from urllib3.fields import RequestField
+from urllib3.filepost import encode_multipart_formdata
 
 
 @contextmanager
@@ -16,21 +24,135 @@ def safe_open_write(filename, *args, **kwargs):
         shutil.move(temp_filename, filename)
 
 
-def http_stream_download(filename, requests_kwargs, max_bytes=None):
-    m = hashlib.sha256()
-    with requests.get(stream=True, **requests_kwargs) as res:
-        res.raise_for_status()
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with safe_open_write(filename, 'wb') as f:
-            num_bytes = 0
-            for chunk in res.iter_content(chunk_size=8192):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-                    m.update(chunk)
-                    num_bytes += len(chunk)
-                    if max_bytes and num_bytes > max_bytes:
-                        raise StreamDownloadMaxBytesExceeded(f"Downloaded {num_bytes} bytes, which exceeds the limit of {max_bytes} bytes")
-    return m.hexdigest()
+@contextmanager
+def atomic_open_write(filename, *args, **kwargs):
+    # the temp file is in the same directory as filename, so os.replace is atomic and readers never see a partial file
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    os.close(fd)
+    try:
+        with open(temp_filename, *args, **kwargs) as f:
+            yield f
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+
+
+FILE_CHUNK_SIZE = 1024 * 1024
+# directory of a persistent http cache for http_stream_download, if not set, files are always downloaded
+HTTP_CACHE_PATH = os.getenv('HTTP_CACHE_PATH')
+# when the total size of the cached files exceeds this, least recently used files are evicted
+HTTP_CACHE_MAX_BYTES = int(os.getenv('HTTP_CACHE_MAX_BYTES') or 10 * 1024 * 1024 * 1024)
+
+
+def get_http_cache_key(requests_kwargs):
+    return hashlib.sha256(json.dumps({
+        k: requests_kwargs.get(k) for k in ['url', 'params', 'headers']
+    }, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_http_cache_body_path(key, hash_):
+    # the body file name includes its hash, so the metadata always refers to the body it was saved with,
+    # even if another process saves a different response for the same url at the same time
+    return os.path.join(HTTP_CACHE_PATH, f'{key}.{hash_}.body')
+
+
+def load_http_cache(requests_kwargs):
+    # returns the cache metadata and the opened cached body file, or (None, None)
+    # the body is opened before the request, so it can still be read if it's replaced or evicted in the meantime
+    metadata_path = os.path.join(HTTP_CACHE_PATH, f'{get_http_cache_key(requests_kwargs)}.json')
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        body_f = open(get_http_cache_body_path(get_http_cache_key(requests_kwargs), metadata['hash']), 'rb')
+    except FileNotFoundError:
+        return None, None
+    return metadata, body_f
+
+
+def evict_http_cache():
+    body_paths = []
+    for file_name in os.listdir(HTTP_CACHE_PATH):
+        if file_name.endswith('.body') and not file_name.startswith('.'):
+            try:
+                stat = os.stat(os.path.join(HTTP_CACHE_PATH, file_name))
+            except FileNotFoundError:
+                continue
+            body_paths.append((stat.st_mtime, stat.st_size, os.path.join(HTTP_CACHE_PATH, file_name)))
+    total_bytes = sum(size for _, size, _ in body_paths)
+    for _, size, body_path in sorted(body_paths):
+        if total_bytes <= HTTP_CACHE_MAX_BYTES:
+            break
+        # the metadata of an evicted body is ignored by load_http_cache
+        if os.path.exists(body_path):
+            os.unlink(body_path)
+        total_bytes -= size
+
+
+def save_http_cache(requests_kwargs, res, filename, hash_):
+    # only responses with validators can be revalidated with a conditional request
+    key = get_http_cache_key(requests_kwargs)
+    metadata_path, body_path = os.path.join(HTTP_CACHE_PATH, f'{key}.json'), get_http_cache_body_path(key, hash_)
+    etag, last_modified = res.headers.get('ETag'), res.headers.get('Last-Modified')
+    os.makedirs(HTTP_CACHE_PATH, exist_ok=True)
+    if etag or last_modified:
+        with atomic_open_write(body_path, 'wb') as f, open(filename, 'rb') as source_f:
+            shutil.copyfileobj(source_f, f, FILE_CHUNK_SIZE)
+        with atomic_open_write(metadata_path, 'w') as f:
+            json.dump({'url': requests_kwargs['url'], 'etag': etag, 'last_modified': last_modified, 'hash': hash_}, f)
+    elif os.path.exists(metadata_path):
+        os.unlink(metadata_path)
+    for file_name in os.listdir(HTTP_CACHE_PATH):
+        if file_name.startswith(f'{key}.') and file_name.endswith('.body') and os.path.join(HTTP_CACHE_PATH, file_name) != body_path:
+            os.unlink(os.path.join(HTTP_CACHE_PATH, file_name))
+    evict_http_cache()
+
+
+def http_stream_download(filename, requests_kwargs, max_bytes=None, session=None, use_cache=False):
+    # pass a session (e.g. ckan.get_session(instance_name)) to reuse keep-alive connections between downloads
+    # if use_cache and HTTP_CACHE_PATH is set, a conditional request is sent for cached urls, and if the server responds
+    # with 304 the cached file is copied to filename and the cached hash is returned, without downloading the file again
+    cache_metadata, cache_body_f = load_http_cache(requests_kwargs) if use_cache and HTTP_CACHE_PATH else (None, None)
+    try:
+        request_headers = dict(requests_kwargs.get('headers') or {})
+        if cache_metadata:
+            if cache_metadata['etag']:
+                request_headers['If-None-Match'] = cache_metadata['etag']
+            if cache_metadata['last_modified']:
+                request_headers['If-Modified-Since'] = cache_metadata['last_modified']
+        m = hashlib.sha256()
+        with (session or requests).get(stream=True, **{**requests_kwargs, 'headers': request_headers}) as res:
+            if cache_metadata and res.status_code == 304:
+                print(f'not modified, using cached file: {requests_kwargs["url"]}')
+                cache_size = os.fstat(cache_body_f.fileno()).st_size
+                if max_bytes and cache_size > max_bytes:
+                    raise StreamDownloadMaxBytesExceeded(f"Cached file size is {cache_size} bytes, which exceeds the limit of {max_bytes} bytes")
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                with safe_open_write(filename, 'wb') as f:
+                    shutil.copyfileobj(cache_body_f, f, FILE_CHUNK_SIZE)
+                # mark as recently used for the eviction
+                try:
+                    os.utime(cache_body_f.name)
+                except FileNotFoundError:
+                    pass
+                return cache_metadata['hash']
+            res.raise_for_status()
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with safe_open_write(filename, 'wb') as f:
+                num_bytes = 0
+                for chunk in res.iter_content(chunk_size=8192):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+                        m.update(chunk)
+                        num_bytes += len(chunk)
+                        if max_bytes and num_bytes > max_bytes:
+                            raise StreamDownloadMaxBytesExceeded(f"Downloaded {num_bytes} bytes, which exceeds the limit of {max_bytes} bytes")
+            if use_cache and HTTP_CACHE_PATH:
+                save_http_cache(requests_kwargs, res, filename, m.hexdigest())
+        return m.hexdigest()
+    finally:
+        if cache_body_f:
+            cache_body_f.close()
 
 
 class StreamDownloadMaxBytesExceeded(Exception):
@@ -46,3 +168,140 @@ def tempdir(keep=False):
     else:
         with TemporaryDirectory() as tmpdir:
             yield tmpdir
+
+
+def iterate_executor_results(executor, func, iterable, max_pending, ordered=True):
+    # yields func(item) for each item in iterable, calculated concurrently using the executor
+    # at most max_pending items are submitted at once, so the iterable is consumed lazily and results don't pile up in memory
+    # if executor is None, items are processed serially in the current thread
+    if executor is None:
+        for item in iterable:
+            yield func(item)
+    else:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            while len(pending) >= max_pending:
+                if ordered:
+                    yield pending.popleft().result()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield future.result()
+        if ordered:
+            while pending:
+                yield pending.popleft().result()
+        else:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+
+
+def zip_directory(dir_path, zip_path):
+    # same as running `cd <parent dir> && zip -r <zip_path> <dir name>`, files are streamed into the archive
+    base_path = os.path.dirname(os.path.abspath(dir_path))
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(dir_path):
+            dirs.sort()
+            zf.write(root, os.path.relpath(root, base_path))
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                zf.write(file_path, os.path.relpath(file_path, base_path))
+
+
+def hash_file(file_path, algorithms=('md5',)):
+    # computes all the digests in a single chunked pass over the file, returns dict of algorithm: hexdigest
+    hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+            for m in hashes.values():
+                m.update(chunk)
+    return {algorithm: m.hexdigest() for algorithm, m in hashes.items()}
+
+
+class HashingWriter:
+    # wraps a binary file opened for writing and computes the digests of the written data
+    # so the digests are available when the file is closed, without reading it again
+    # if encoding is set, str data is encoded before writing
+
+    def __init__(self, f, algorithms=('md5',), encoding=None):
+        self.f = f
+        self.encoding = encoding
+        self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def write(self, data):
+        if self.encoding and isinstance(data, str):
+            data = data.encode(self.encoding)
+        for m in self.hashes.values():
+            m.update(data)
+        return self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+    def hexdigests(self):
+        return {algorithm: m.hexdigest() for algorithm, m in self.hashes.items()}
+
+
+class MultipartFileStream:
+    # multipart/form-data request body which reads the files from disk while the request is sent
+    # unlike requests files= which reads the files and builds the whole body in memory
+    # the encoding is the same as requests files=, the parts are encoded by urllib3 with a placeholder for each file data
+
+    def __init__(self, data, files):
+        fields, file_objects = [], []
+        for k, v in (data.items() if isinstance(data, dict) else data or []):
+            for value in (v if isinstance(v, (list, tuple)) else [v]):
+                if value is not None:
+                    fields.append((k, value if isinstance(value, bytes) else str(value).encode('utf-8')))
+        placeholder = uuid.uuid4().hex.encode()
+        for k, v in (files.items() if isinstance(files, dict) else files):
+            filename, f = v if isinstance(v, tuple) else (os.path.basename(v.name), v)
+            field = RequestField(name=k, data=placeholder, filename=filename)
+            field.make_multipart()
+            fields.append(field)
+            file_objects.append(f)
+        body, self.content_type = encode_multipart_formdata(fields)
+        body_parts = body.split(placeholder)
+        assert len(body_parts) == len(file_objects) + 1
+        self.parts = [io.BytesIO(body_parts[0])]
+        self.length = len(body_parts[0])
+        for f, body_part in zip(file_objects, body_parts[1:]):
+            self.parts += [f, io.BytesIO(body_part)]
+            self.length += os.fstat(f.fileno()).st_size - f.tell() + len(body_part)
+        self.part_index = 0
+
+    @classmethod
+    def is_streamable(cls, data, files):
+        # only files on disk with known size can be streamed
+        if isinstance(data, (str, bytes)):
+            return False
+        for v in (files.values() if isinstance(files, dict) else files):
+            if isinstance(v, tuple):
+                if len(v) != 2:
+                    return False
+                v = v[1]
+            if not hasattr(v, 'fileno') or not hasattr(v, 'name'):
+                return False
+        return True
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        chunks = []
+        while self.part_index < len(self.parts) and size != 0:
+            chunk = self.parts[self.part_index].read(size)
+            if chunk:
+                chunks.append(chunk)
+                if size > 0:
+                    size -= len(chunk)
+            else:
+                self.part_index += 1
+        return b''.join(chunks)
+
+    def __iter__(self):
+        return iter(lambda: self.read(FILE_CHUNK_SIZE), b'')
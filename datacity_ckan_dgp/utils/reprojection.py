@@ -0,0 +1,69 @@
+import functools
+
+import numpy as np
+import pyproj
+
+
+ITM_CRS = '+ellps=GRS80 +k=1.00007 +lat_0=31.73439361111111 +lon_0=35.20451694444445 +no_defs +proj=tmerc +units=m +x_0=219529.584 +y_0=626907.39'
+
+# nesting depth of the coordinates arrays of each geometry type
+GEOMETRY_COORDINATES_DEPTH = {
+    'Point': 0,
+    'MultiPoint': 1,
+    'LineString': 1,
+    'MultiLineString': 2,
+    'Polygon': 2,
+    'MultiPolygon': 3,
+}
+
+
+class UnsupportedGeometry(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=None)
+def get_projector(crs=ITM_CRS):
+    # pyproj.Proj is a pyproj.Transformer, creating it is expensive so it is created once and reused
+    return pyproj.Proj(crs)
+
+
+def wgs84_to_itm(lons, lats):
+    # lons / lats are numpy arrays, returns tuple of numpy arrays (x, y)
+    return get_projector()(lons, lats)
+
+
+def itm_to_wgs84(xs, ys):
+    # xs / ys are numpy arrays, returns tuple of numpy arrays (lon, lat)
+    return get_projector()(xs, ys, inverse=True)
+
+
+def _iterate_positions(coordinates, depth):
+    if depth == 0:
+        yield coordinates
+    else:
+        for item in coordinates:
+            yield from _iterate_positions(item, depth - 1)
+
+
+def _rebuild_coordinates(coordinates, depth, positions):
+    if depth == 0:
+        return next(positions)
+    else:
+        return [_rebuild_coordinates(item, depth - 1, positions) for item in coordinates]
+
+
+def transform_geometry(geometry, transform=wgs84_to_itm):
+    # returns a new geojson geometry with all the vertices transformed in a single call
+    # additional dimensions (e.g. z) are kept as-is
+    geometry_type = (geometry or {}).get('type')
+    if geometry_type == 'GeometryCollection':
+        return {**geometry, 'geometries': [transform_geometry(g, transform) for g in geometry['geometries']]}
+    if geometry_type not in GEOMETRY_COORDINATES_DEPTH:
+        raise UnsupportedGeometry(f'unsupported geometry type: {geometry_type}')
+    depth = GEOMETRY_COORDINATES_DEPTH[geometry_type]
+    positions = list(_iterate_positions(geometry['coordinates'], depth))
+    xs = np.fromiter((position[0] for position in positions), dtype=float, count=len(positions))
+    ys = np.fromiter((position[1] for position in positions), dtype=float, count=len(positions))
+    xs, ys = transform(xs, ys)
+    new_positions = iter([[x, y, *position[2:]] for x, y, position in zip(xs.tolist(), ys.tolist(), positions)])
+    return {**geometry, 'coordinates': _rebuild_coordinates(geometry['coordinates'], depth, new_positions)}
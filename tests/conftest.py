@@ -1,24 +1,51 @@
+import sys
+
 import pytest
 from unittest.mock import patch
 
+import datacity_ckan_dgp
+import datacity_ckan_dgp.package_processing_tasks
+# imported before the fixtures patch sys.modules, otherwise pyproj is imported again after each fixture, which breaks it
+import datacity_ckan_dgp.utils.reprojection  # noqa: F401
 from .mocks import ckan, package_processing_tasks_common
 
 
+PACKAGE_PROCESSING_TASKS_MODULES = [
+    'datacity_ckan_dgp.package_processing_tasks.geojson',
+    'datacity_ckan_dgp.package_processing_tasks.xlsx',
+]
+
+
+def unload_package_processing_tasks():
+    # the tasks are imported again by the test, so that they use the patched modules
+    # instead of the real modules, which may have been imported by other tests
+    for module_name in PACKAGE_PROCESSING_TASKS_MODULES:
+        sys.modules.pop(module_name, None)
+        # the parent package attribute is used by "from ... import" even if the module was removed from sys.modules
+        parent_module_name, _, attr_name = module_name.rpartition('.')
+        if hasattr(sys.modules[parent_module_name], attr_name):
+            delattr(sys.modules[parent_module_name], attr_name)
+
+
 @pytest.fixture()
 def patch_ckan():
     with patch.dict('sys.modules', {
         'datacity_ckan_dgp.ckan': ckan
-    }):
+    }), patch.object(datacity_ckan_dgp, 'ckan', ckan, create=True):
+        unload_package_processing_tasks()
         ckan.mock_calls = []
         yield ckan
         ckan.mock_calls = []
+    unload_package_processing_tasks()
 
 
 @pytest.fixture()
 def patch_package_processing_tasks_common():
     with patch.dict('sys.modules', {
         'datacity_ckan_dgp.package_processing_tasks.common': package_processing_tasks_common
-    }):
+    }), patch.object(datacity_ckan_dgp.package_processing_tasks, 'common', package_processing_tasks_common, create=True):
+        unload_package_processing_tasks()
         package_processing_tasks_common.mock_calls = []
         yield package_processing_tasks_common
         package_processing_tasks_common.mock_calls = []
+    unload_package_processing_tasks()
@@ -1,5 +1,14 @@
+from contextlib import contextmanager
+
+
 mock_calls = []
 
 
 def update_package_extras(*args, **kwargs):
     mock_calls.append(('update_package_extras', args, kwargs))
+
+
+@contextmanager
+def try_download_resource_url(url, max_bytes=None, local_filename=None):
+    # resources are not downloaded, the processing tasks load the url directly if no local file was provided
+    yield False, local_filename
@@ -0,0 +1,69 @@
+import time
+import asyncio
+import threading
+
+from datacity_ckan_dgp import ckan
+
+
+def test_get_session_shared_per_instance(monkeypatch):
+    monkeypatch.setenv('CKAN_INSTANCE_TEST_SESSIONS_URL', 'http://ckan.test')
+    monkeypatch.setenv('CKAN_INSTANCE_TEST_SESSIONS_POOL_MAXSIZE', '7')
+    monkeypatch.setenv('CKAN_INSTANCE_TEST_SESSIONS_RETRY_TOTAL', '3')
+    ckan.close_sessions()
+    try:
+        session = ckan.get_session('test sessions')
+        assert ckan.get_session('test sessions') is session
+        assert ckan.get_session('http://ckan.test') is session
+        assert ckan.get_session('http://other.ckan.test') is not session
+        adapter = session.get_adapter('http://ckan.test/api/3/action/package_show')
+        assert adapter._pool_maxsize == 7
+        assert adapter.max_retries.total == 3
+        assert 429 in adapter.max_retries.status_forcelist
+        assert 'POST' not in adapter.max_retries.allowed_methods
+    finally:
+        ckan.close_sessions()
+
+
+def test_async_concurrency_limit_per_instance(monkeypatch):
+    monkeypatch.setenv('CKAN_INSTANCE_TEST_ASYNC_URL', 'http://async.ckan.test')
+    monkeypatch.setenv('CKAN_INSTANCE_TEST_ASYNC_ASYNC_MAX_CONCURRENCY', '2')
+    lock = threading.Lock()
+    stats = {'running': 0, 'max_running': 0}
+
+    def mock_api_request(method, instance_name, action_name, auth=True, **kwargs):
+        with lock:
+            stats['running'] += 1
+            stats['max_running'] = max(stats['max_running'], stats['running'])
+        time.sleep(0.05)
+        with lock:
+            stats['running'] -= 1
+        return {'success': True, 'result': {'id': kwargs['params']['id']}}
+
+    async def main():
+        return await asyncio.gather(*[ckan.async_package_show('test async', f'package-{i}') for i in range(6)])
+
+    monkeypatch.setattr(ckan, 'api_request', mock_api_request)
+    ckan.close_sessions()
+    try:
+        assert asyncio.run(main()) == [{'id': f'package-{i}'} for i in range(6)]
+        assert stats['max_running'] == 2
+    finally:
+        ckan.close_sessions()
+
+
+def test_package_search_iterate(monkeypatch):
+    packages = [{'name': f'package-{i}'} for i in range(5)]
+    calls = []
+
+    def mock_api_get(instance_name, action_name, auth=True, **kwargs):
+        params = kwargs['params']
+        calls.append((action_name, auth, params))
+        return {'success': True, 'result': {
+            'count': len(packages),
+            'results': packages[params['start']:params['start'] + params['rows']]
+        }}
+
+    monkeypatch.setattr(ckan, 'api_get', mock_api_get)
+    assert list(ckan.package_search_iterate_public('test', rows=2, fq='organization:muni')) == packages
+    assert [params['start'] for _, _, params in calls] == [0, 2, 4]
+    assert all(action_name == 'package_search' and not auth and params['fq'] == 'organization:muni' for action_name, auth, params in calls)
@@ -0,0 +1,98 @@
+import json
+import time
+import tempfile
+import threading
+
+from datacity_ckan_dgp.generic_fetchers import ckan_dataset_fetcher
+
+
+def test_get_resources_to_update_concurrent_downloads(monkeypatch):
+    lock = threading.Lock()
+    active, max_active = {}, {}
+
+    def mock_http_stream_download(filename, requests_kwargs, max_bytes=None, session=None, use_cache=False):
+        host = requests_kwargs['url'].split('/')[2]
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            max_active[host] = max(max_active.get(host, 0), active[host])
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+        return 'hash-' + filename.split('/')[-1]
+
+    monkeypatch.setattr(ckan_dataset_fetcher, 'http_stream_download', mock_http_stream_download)
+    monkeypatch.setattr(ckan_dataset_fetcher, 'MAX_CONNECTIONS_PER_HOST', 2)
+    monkeypatch.setattr(ckan_dataset_fetcher, '_host_semaphores', {})
+    resources = [
+        {'id': f'r{i}', 'url': f'https://{"e.data.gov.il" if i % 2 else "other.host"}/dataset/x/r{i}.csv', 'name': f'r{i}', 'format': 'CSV'}
+        for i in range(8)
+    ] + [{'id': 'no-url', 'name': 'no-url', 'format': 'CSV'}]
+    resources_to_update = ckan_dataset_fetcher.get_resources_to_update(
+        resources, '/tmp', None, {'r1.csv': {'hash': 'hash-r1'}}, None, download_workers=8
+    )
+    assert [args[0] for args in resources_to_update] == ['r0', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7']
+    assert resources_to_update[0] == ('r0', 'r0', 'CSV', 'hash-r0', '', 'r0.csv')
+    assert max_active == {'data.gov.il': 2, 'other.host': 2}
+
+
+def test_filter_rows():
+    rows = [{'City': ' חיפה ', 'Type': 'a'}, {'City': 'תל אביב', 'Type': 'b'}, {'City': None, 'Other': 'חיפה'}, {'Type': 'a'}]
+    source_filters = [
+        ({'City': 'חיפה'}, [0]),
+        ({'City': 'חיפה', 'Type': 'b'}, []),
+        ([{'City': 'חיפה'}, {'City': 'תל אביב'}, {'Type': 'a', 'City': ''}], [0, 1, 3]),
+        ({'..filtertype': 'multi_key_vals', 'keys': ['City', 'Other'], 'vals': ['חיפה ']}, [0, 2]),
+        ({'City': ''}, [2, 3]),
+    ]
+    for source_filter, expected_indexes in source_filters:
+        filter_row = ckan_dataset_fetcher.filter_rows(source_filter)
+        # the filter is evaluated multiple times to make sure it doesn't modify itself or the source filter
+        for _ in range(2):
+            assert [i for i, row in enumerate(rows) if filter_row(row)] == expected_indexes, source_filter
+    assert 'keys' in source_filters[3][0] and source_filters[3][0]['..filtertype'] == 'multi_key_vals'
+
+
+def test_filter_tabular_columnar_and_dataflows(monkeypatch):
+    monkeypatch.setattr(ckan_dataset_fetcher, 'COLUMNAR_FILTER_CHUNK_ROWS', 2)
+    source_filter = [{'City': 'חיפה'}, {'City': '', 'Type': 'a'}]
+    results = {}
+    filter_tabular_dataflows = ckan_dataset_fetcher.filter_tabular_dataflows
+    for columnar_filter_min_bytes in (1, 0):
+        monkeypatch.setattr(ckan_dataset_fetcher, 'COLUMNAR_FILTER_MIN_BYTES', columnar_filter_min_bytes)
+        if columnar_filter_min_bytes:
+            # the columnar path must not fall back to dataflows
+            monkeypatch.setattr(ckan_dataset_fetcher, 'filter_tabular_dataflows', None)
+        else:
+            monkeypatch.setattr(ckan_dataset_fetcher, 'filter_tabular_dataflows', filter_tabular_dataflows)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f'{tmpdir}/r1', 'w', encoding='utf-8-sig') as f:
+                f.write('City,Type,Name\nחיפה ,a,"x, ""y"""\nתל אביב,b,z\n,a,\nחיפה,b,w\nחיפה,c,v\n')
+            hash_, count_of_rows = ckan_dataset_fetcher.filter_tabular(tmpdir, source_filter, 'r1', 'CSV')
+            with open(f'{tmpdir}/r1-filtered/filtered.csv', 'rb') as f:
+                results[columnar_filter_min_bytes] = (hash_, count_of_rows, f.read().decode())
+    # the filtered data and hash are the same for the columnar (1) and dataflows (0) paths
+    assert results[1] == results[0]
+    assert results[1][1] == 4
+    assert results[1][2] == 'City,Type,Name\r\nחיפה,a,"x, ""y"""\r\n,a,\r\nחיפה,b,w\r\nחיפה,c,v\r\n'
+
+
+def test_filter_geojson():
+    data = {
+        'type': 'FeatureCollection',
+        'crs': {'type': 'name', 'properties': {'name': 'EPSG:4326'}},
+        'features': [
+            {'type': 'Feature', 'properties': {'City': 'חיפה', 'n': 1.5}, 'geometry': {'type': 'Point', 'coordinates': [35.0, 32.8]}},
+            {'type': 'Feature', 'properties': {'City': 'תל אביב', 'n': 2}, 'geometry': None},
+            {'type': 'Feature', 'properties': {'City': ' חיפה', 'n': None}, 'geometry': {'type': 'LineString', 'coordinates': [[35, 32.8], [35.1, 32.9]]}},
+        ],
+        'bbox': [35, 32, 36, 33],
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(f'{tmpdir}/source.geojson', 'w') as f:
+            json.dump(data, f)
+        assert ckan_dataset_fetcher.filter_geojson(f'{tmpdir}/source.geojson', f'{tmpdir}/filtered.geojson', {'City': 'חיפה'}) == 2
+        with open(f'{tmpdir}/filtered.geojson') as f:
+            assert f.read() == json.dumps({**data, 'features': [data['features'][0], data['features'][2]]})
+        assert ckan_dataset_fetcher.filter_geojson(f'{tmpdir}/source.geojson', f'{tmpdir}/filtered.geojson', {'City': 'ירושלים'}) == 0
+        with open(f'{tmpdir}/filtered.geojson') as f:
+            assert json.load(f) == {**data, 'features': []}
@@ -0,0 +1,129 @@
+import datetime
+
+from datacity_ckan_dgp.operators import ckan_sync
+
+
+def test_get_incremental_fq():
+    now = datetime.datetime.utcnow()
+    last_full_sync = (now - datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.%f')
+    assert ckan_sync._get_incremental_fq(None, 24) is None
+    assert ckan_sync._get_incremental_fq({'metadata_modified': '', 'last_full_sync': last_full_sync}, 24) is None
+    assert ckan_sync._get_incremental_fq({
+        'metadata_modified': '2024-05-01T10:20:30.123456', 'last_full_sync': last_full_sync
+    }, 24) == 'metadata_modified:[2024-05-01T10:20:30Z TO *]'
+    assert ckan_sync._get_incremental_fq({
+        'metadata_modified': '2024-05-01T10:20:30.123456', 'last_full_sync': last_full_sync
+    }, 0.5) is None
+
+
+def test_get_watermark_metadata_modified():
+    sync_start_time = datetime.datetime(2024, 5, 1, 10, 0, 0)
+    # a package modified during the sync caps the watermark at the sync start time
+    assert ckan_sync._get_watermark_metadata_modified(sync_start_time, '2024-05-01T10:05:00.000000') == '2024-05-01T10:00:00.000000'
+    assert ckan_sync._get_watermark_metadata_modified(sync_start_time, '2024-05-01T09:00:00.123456') == '2024-05-01T09:00:00.123456'
+
+
+class MockHeadSession:
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def head(self, url, **kwargs):
+        return type('MockResponse', (), {'status_code': 200, 'headers': self.headers})()
+
+
+def test_get_source_resource_signature():
+    upload_resource = {'url': 'http://source/0.csv', 'url_type': 'upload', 'hash': 'abc', 'last_modified': '2024-01-01T00:00:00'}
+    link_resource = {**upload_resource, 'url_type': None}
+    # ckan fields are reliable only for uploaded resources, link resources require the http validators
+    assert ckan_sync._get_source_resource_signature(MockHeadSession({}), 10, upload_resource)
+    assert ckan_sync._get_source_resource_signature(MockHeadSession({}), 10, link_resource) is None
+    assert ckan_sync._get_source_resource_signature(MockHeadSession({'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}), 10, link_resource)
+
+
+def test_sync_resources(monkeypatch):
+    calls = []
+
+    def mock_action(action_name):
+
+        def action(instance_name, data, files=None):
+            calls.append((action_name, data, bool(files)))
+            return {'success': True, 'result': {'id': data.get('id') or 'new-target-resource'}}
+
+        return action
+
+    def mock_http_stream_download(filename, requests_kwargs, max_bytes=None, session=None):
+        with open(filename, 'w') as f:
+            f.write(requests_kwargs['url'])
+        return 'hash:' + requests_kwargs['url']
+
+    session = MockHeadSession({'ETag': '"abc"'})
+    monkeypatch.setenv('CKAN_INSTANCE_SOURCE_URL', 'http://source')
+    monkeypatch.setattr(ckan_sync.ckan, 'get_session', lambda instance_name: session)
+    monkeypatch.setattr(ckan_sync.ckan, 'get_instance_timeout', lambda instance_name: 10)
+    monkeypatch.setattr(ckan_sync.ckan, 'resource_create', mock_action('resource_create'))
+    monkeypatch.setattr(ckan_sync.ckan, 'resource_patch', mock_action('resource_patch'))
+    monkeypatch.setattr(ckan_sync.ckan, 'resource_delete', lambda instance_name, resource_id: mock_action('resource_delete')(instance_name, {'id': resource_id}))
+    monkeypatch.setattr(ckan_sync.ckan, 'package_resource_reorder', lambda instance_name, package_id, resource_ids: mock_action('package_resource_reorder')(instance_name, {'id': package_id, 'order': resource_ids}))
+    monkeypatch.setattr(ckan_sync.utils, 'http_stream_download', mock_http_stream_download)
+    source_resources = [
+        {'id': f'source-{i}', 'state': 'active', 'url': f'http://source/{i}.csv', 'name': f'resource {i}', 'format': 'CSV', 'description': ''}
+        for i in range(3)
+    ]
+    signature = ckan_sync._get_source_resource_signature(session, 10, source_resources[0])
+    target_package = {'id': 'target-package', 'resources': [
+        # unchanged resource, should not be downloaded or updated
+        {**source_resources[0], 'id': 'target-0', 'sync_source_resource_id': 'source-0', 'sync_source_signature': signature, 'hash': 'x'},
+        # changed resource matched by position, should be downloaded and updated
+        {**source_resources[1], 'id': 'target-1', 'hash': 'old-hash'},
+        # removed from source
+        {**source_resources[0], 'id': 'target-removed', 'sync_source_resource_id': 'source-removed'},
+    ]}
+    stats = ckan_sync.defaultdict(int)
+    assert ckan_sync._sync_resources('source', {'resources': source_resources}, 'target', target_package, stats)
+    assert [(action_name, data.get('id'), has_files) for action_name, data, has_files in calls] == [
+        ('resource_patch', 'target-1', True),
+        ('resource_create', None, True),
+        ('resource_delete', 'target-removed', False),
+    ]
+    assert calls[0][1]['hash'] == 'hash:http://source/1.csv'
+    assert calls[0][1]['sync_source_resource_id'] == 'source-1'
+    assert calls[1][1]['package_id'] == 'target-package'
+    assert dict(stats) == {
+        'resources_unchanged_signatures': 1, 'resources_unchanged': 1, 'resources_updated': 1,
+        'resources_created': 1, 'resources_deleted': 1,
+    }
+
+
+def test_sync_resources_clears_stale_signature(monkeypatch):
+    calls = []
+
+    def resource_patch(instance_name, data, files=None):
+        calls.append(data)
+        return {'success': True, 'result': {'id': data['id']}}
+
+    def mock_http_stream_download(filename, requests_kwargs, max_bytes=None, session=None):
+        with open(filename, 'w') as f:
+            f.write(requests_kwargs['url'])
+        return 'hash:' + requests_kwargs['url']
+
+    # link resources without http validators have no signature
+    monkeypatch.setenv('CKAN_INSTANCE_SOURCE_URL', 'http://source')
+    monkeypatch.setattr(ckan_sync.ckan, 'get_session', lambda instance_name: MockHeadSession({}))
+    monkeypatch.setattr(ckan_sync.ckan, 'get_instance_timeout', lambda instance_name: 10)
+    monkeypatch.setattr(ckan_sync.ckan, 'resource_patch', resource_patch)
+    monkeypatch.setattr(ckan_sync.utils, 'http_stream_download', mock_http_stream_download)
+    source_resources = [
+        {'id': f'source-{i}', 'state': 'active', 'url': f'http://source/{i}.csv', 'url_type': None, 'name': f'resource {i}', 'format': 'CSV', 'description': ''}
+        for i in range(2)
+    ]
+    target_package = {'id': 'target-package', 'resources': [
+        # changed resource with a stale signature from a previous sync
+        {**source_resources[0], 'id': 'target-0', 'sync_source_resource_id': 'source-0', 'sync_source_signature': 'etag:"old"', 'hash': 'old-hash'},
+        # unchanged resource which never had a signature, should not be patched
+        {**source_resources[1], 'id': 'target-1', 'sync_source_resource_id': 'source-1', 'hash': 'hash:http://source/1.csv'},
+    ]}
+    stats = ckan_sync.defaultdict(int)
+    assert ckan_sync._sync_resources('source', {'resources': source_resources}, 'target', target_package, stats)
+    assert [(data['id'], data['sync_source_signature']) for data in calls] == [('target-0', '')]
+    assert dict(stats) == {'resources_updated': 1, 'resources_unchanged': 1}
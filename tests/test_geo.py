@@ -1,6 +1,34 @@
+import pytest
+
+from datacity_ckan_dgp.utils import reprojection
 from datacity_ckan_dgp.package_processing_tasks import geojson
 
 
 def test_lat_lon():
     row = {'X_ITM': '182418', 'Y_ITM': 652418}
     assert geojson.get_lat_lon_values(row, 'X_ITM', 'Y_ITM') == (34.81195612163422, 31.963835962756367)
+
+
+def test_project_lat_lon_values():
+    assert geojson.project_lat_lon_values([
+        geojson.get_raw_lat_lon_values({'X_ITM': '182418', 'Y_ITM': 652418}, 'X_ITM', 'Y_ITM'),
+        geojson.get_raw_lat_lon_values({'lon': '34.8', 'lat': '31.9'}, 'lon', 'lat'),
+        geojson.get_raw_lat_lon_values({'lon': '', 'lat': '31.9'}, 'lon', 'lat'),
+    ]) == [geojson.projector(182418, 652418, inverse=True), (34.8, 31.9), (None, None)]
+
+
+def test_transform_geometry():
+    point = [35.2, 31.7]
+    itm_point = list(reprojection.get_projector()(*point))
+    for geometry_type, coordinates, itm_coordinates in [
+        ('Point', point, itm_point),
+        ('MultiPoint', [point, point], [itm_point, itm_point]),
+        ('LineString', [point, point + [5]], [itm_point, itm_point + [5]]),
+        ('MultiLineString', [[point, point]], [[itm_point, itm_point]]),
+        ('Polygon', [[point, point, point]], [[itm_point, itm_point, itm_point]]),
+        ('MultiPolygon', [[[point, point, point]], [[point]]], [[[itm_point, itm_point, itm_point]], [[itm_point]]]),
+    ]:
+        geometry = {'type': geometry_type, 'coordinates': coordinates}
+        assert reprojection.transform_geometry(geometry) == {'type': geometry_type, 'coordinates': itm_coordinates}
+    with pytest.raises(reprojection.UnsupportedGeometry):
+        reprojection.transform_geometry(None)
@@ -0,0 +1,158 @@
+import re
+import json
+
+import pytest
+
+from datacity_ckan_dgp.gis import arcgis, feature_store, download
+
+
+class MockGisSession:
+
+    def __init__(self, num_features, max_features_per_response):
+        self.features = [{'type': 'Feature', 'properties': {'OBJECTID': i + 1}, 'geometry': None} for i in range(num_features)]
+        self.max_features_per_response = max_features_per_response
+        self.requests = []
+
+    def response(self, data):
+        content = json.dumps(data).encode()
+        raw = type('MockRaw', (), {'tell': lambda self: len(content) // 2})()
+        return type('MockResponse', (), {'status_code': 200, 'json': lambda self: data, 'content': content, 'raw': raw})()
+
+    def get(self, url, params):
+        self.requests.append(params)
+        # only supports the where clause used for resuming downloads
+        min_object_id = re.search(r'OBJECTID > (\d+)', params['where'])
+        features = [f for f in self.features if not min_object_id or f['properties']['OBJECTID'] > int(min_object_id.group(1))]
+        if params.get('returnCountOnly'):
+            return self.response({'count': len(features)})
+        if params.get('returnIdsOnly'):
+            return self.response({'objectIds': [f['properties']['OBJECTID'] for f in features]})
+        offset, count = params['resultOffset'], min(params['resultRecordCount'], self.max_features_per_response)
+        return self.response({'type': 'FeatureCollection', 'features': features[offset:offset + count]})
+
+    def post(self, url, data):
+        self.requests.append(data)
+        object_ids = set(int(i) for i in data['objectIds'].split(','))
+        return self.response({'type': 'FeatureCollection', 'features': [f for f in self.features if f['properties']['OBJECTID'] in object_ids]})
+
+
+def test_iterate_features_offset_pages(monkeypatch, capsys):
+    session = MockGisSession(2500, 700)
+    monkeypatch.setattr(arcgis, 'get_session', lambda: session)
+    features = list(arcgis.iterate_features('http://gis/MapServer/1', {'maxRecordCount': 1000, 'objectIdField': 'OBJECTID'}, max_workers=3))
+    assert features == session.features
+    assert all(params.get('orderByFields') == 'OBJECTID' for params in session.requests if 'resultOffset' in params)
+    # the layer totals are printed, and the stats of each page only with GIS_FETCHER_DEBUG
+    stats_lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith(('fetched ', 'page '))]
+    assert len(stats_lines) == 1 and stats_lines[0].startswith('fetched from http://gis/MapServer/1: 2500 features: ')
+    monkeypatch.setattr(arcgis, 'DEBUG', True)
+    pages = list(arcgis.iterate_pages('http://gis/MapServer/1', {'maxRecordCount': 1000, 'objectIdField': 'OBJECTID'}, max_workers=3, with_stats=True))
+    assert [(len(features), page_stats['features']) for features, page_stats in pages] == [(1000, 1000), (1000, 1000), (500, 500)]
+    assert all(page_stats['bytes_on_wire'] > 0 and page_stats['bytes'] > 0 for _, page_stats in pages)
+    assert [line.split(':')[0] for line in capsys.readouterr().out.splitlines() if line.startswith('page ')] == ['page 0', 'page 1', 'page 2']
+
+
+def test_query_geojson_features_geometry_params(monkeypatch, capsys):
+    session = MockGisSession(10, 1000)
+    monkeypatch.setattr(arcgis, 'get_session', lambda: session)
+    monkeypatch.setattr(arcgis, 'GEOMETRY_PRECISION', '6')
+    monkeypatch.setattr(arcgis, 'MAX_ALLOWABLE_OFFSET', '0.00001')
+    assert arcgis.query_geojson_features('http://gis/MapServer/1', {'where': '1=1', 'resultOffset': 0, 'resultRecordCount': 5}) == session.features[:5]
+    assert session.requests[0]['geometryPrecision'] == '6' and session.requests[0]['maxAllowableOffset'] == '0.00001'
+    assert session.requests[0]['outSR'] == 4326
+    assert capsys.readouterr().out == ''
+
+
+def test_iterate_features_object_ids_pages(monkeypatch):
+    session = MockGisSession(2500, 1000)
+    monkeypatch.setattr(arcgis, 'get_session', lambda: session)
+    gis_json = {'maxRecordCount': 1000, 'objectIdField': 'OBJECTID', 'advancedQueryCapabilities': {'supportsPagination': False}}
+    features = list(arcgis.iterate_features('http://gis/MapServer/1', gis_json, max_workers=3))
+    assert features == session.features
+    assert not any('resultOffset' in params for params in session.requests)
+
+
+def test_update_feature_store(monkeypatch, tmp_path):
+    session = MockGisSession(5, 1000)
+    for feature in session.features:
+        feature['properties']['EditDate'] = 1700000000000
+    monkeypatch.setattr(arcgis, 'get_session', lambda: session)
+    gis_url = 'http://gis/MapServer/1'
+    gis_json = {'objectIdField': 'OBJECTID', 'editFieldsInfo': {'editDateField': 'EditDate'}, 'editingInfo': {'lastEditDate': 1}}
+    with feature_store.open_feature_store(gis_url, str(tmp_path)) as store:
+        assert feature_store.update_feature_store(store, gis_url, gis_json)
+        assert list(store.iterate_features()) == session.features
+        session.requests.clear()
+        assert not feature_store.update_feature_store(store, gis_url, gis_json)
+        assert session.requests == [{'where': '1=1', 'returnCountOnly': 'true', 'f': 'json'}]
+        session.features[1]['properties'].update(EditDate=1700000001000, name='edited')
+        del session.features[3]
+        gis_json['editingInfo']['lastEditDate'] = 2
+        session.requests.clear()
+        assert feature_store.update_feature_store(store, gis_url, gis_json)
+        assert list(store.iterate_features()) == session.features
+        assert store.get_max_edit_date() == 1700000001000
+        assert any(params.get('where') == "EditDate >= TIMESTAMP '2023-11-14 22:13:20'" for params in session.requests)
+
+
+def test_download_features_jsonlines_resume(monkeypatch, tmp_path):
+    session = MockGisSession(2500, 1000)
+    monkeypatch.setattr(arcgis, 'get_session', lambda: session)
+    gis_url, gis_json = 'http://gis/MapServer/1', {'maxRecordCount': 1000, 'objectIdField': 'OBJECTID'}
+    file_path = str(tmp_path / 'gis.jsonlines')
+    iterate_pages = arcgis.iterate_pages
+
+    def interrupted_iterate_pages(*args, **kwargs):
+        pages = iterate_pages(*args, **kwargs)
+        yield next(pages)
+        raise Exception('interrupted')
+
+    monkeypatch.setattr(arcgis, 'iterate_pages', interrupted_iterate_pages)
+    with pytest.raises(Exception, match='interrupted'):
+        download.download_features_jsonlines(gis_url, gis_json, file_path)
+    monkeypatch.setattr(arcgis, 'iterate_pages', iterate_pages)
+    assert download.load_checkpoint(file_path)['last_object_id'] == 1000
+    with open(file_path, 'a') as f:
+        f.write('{"partial')
+    session.requests.clear()
+    checkpoint = download.download_features_jsonlines(gis_url, gis_json, file_path)
+    assert checkpoint['complete'] and checkpoint['num_features'] == 2500
+    assert all(page['bytes_on_wire'] > 0 and page['bytes'] > 0 for page in checkpoint['pages'])
+    assert session.requests[0]['where'] == '(1=1) AND OBJECTID > 1000'
+    with open(file_path) as f:
+        assert [json.loads(line) for line in f] == session.features
+    assert download.load_schema(file_path) == {'fields': {'OBJECTID': {'type': 'integer', 'width': 4}}, 'geometry_types': []}
+    session.requests.clear()
+    download.download_features_jsonlines(gis_url, gis_json, file_path)
+    assert session.requests == []
+
+
+def test_service_layers():
+    service_url = 'http://gis/arcgis/rest/services/Public/MapServer'
+    assert arcgis.is_service_url(service_url) and arcgis.is_service_url(service_url + '/')
+    assert not arcgis.is_service_url(service_url + '/13')
+    service_json = {'mapName': 'Public', 'layers': [
+        {'id': 0, 'name': 'group', 'type': 'Group Layer', 'subLayerIds': [1]},
+        {'id': 1, 'name': 'parcels', 'type': 'Feature Layer', 'subLayerIds': None},
+        {'id': 2, 'name': 'ortho', 'type': 'Raster Layer'},
+        {'id': 3, 'name': 'streets'},
+    ]}
+    assert [arcgis.get_layer_url(service_url, layer) for layer in arcgis.get_service_layers(service_json)] == [
+        service_url + '/1', service_url + '/3'
+    ]
+    assert arcgis.get_service_name(service_url, service_json) == 'Public'
+    assert arcgis.get_service_name(service_url, {}) == 'Public'
+
+
+def test_update_resources_reorder_single_package(monkeypatch):
+    from datacity_ckan_dgp.operators import gis_fetcher
+    # another layer's resources (a1, a2) and this layer's existing resource (b1) in the same package
+    package = {'id': 'package', 'resources': [{'id': 'a1'}, {'id': 'b1'}, {'id': 'a2'}]}
+    resource_ids = {'gis.csv': 'b1', 'gis.geojson': 'b2'}
+    reorder_calls = []
+    monkeypatch.setattr(gis_fetcher, 'RESOURCE_FILES', [('csv', 'CSV', 'gis.csv'), ('geojson', 'GeoJSON', 'gis.geojson'), ('kml', 'KML', 'gis.kml')])
+    monkeypatch.setattr(gis_fetcher, 'update_resource', lambda target_instance_name, package, format_, resource_name, file_path, file_hash=None: resource_ids.get(file_path.split('/')[-1]))
+    monkeypatch.setattr(gis_fetcher.ckan, 'package_resource_reorder', lambda instance_name, package_id, order: reorder_calls.append(order) or {'success': True})
+    gis_fetcher.update_resources('instance', package, '/tmp', {}, upload_workers=2, resource_name_prefix='b ')
+    assert reorder_calls == [['a1', 'b1', 'b2', 'a2']]
+    assert gis_fetcher.merge_resource_ids(['a1', 'a2'], ['b1', 'b2']) == ['a1', 'a2', 'b1', 'b2']
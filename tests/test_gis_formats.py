@@ -0,0 +1,87 @@
+import os
+import json
+import tempfile
+
+import pytest
+
+from datacity_ckan_dgp.gis import formats, writers
+
+
+FEATURES = [
+    {'type': 'Feature', 'properties': {'name': 'a', 'area': 1}, 'geometry': {'type': 'Polygon', 'coordinates': [[[35.2, 31.7], [35.3, 31.7], [35.3, 31.8], [35.2, 31.7]]]}},
+    {'type': 'Feature', 'properties': {'name': '<b>', 'area': None}, 'geometry': {'type': 'Point', 'coordinates': [35.2, 31.7]}},
+]
+FORMAT_GROUPS = ['geojson_geoxml', 'csv_xlsx_xml']
+
+
+def write_gis_jsonlines(tmpdir):
+    with open(os.path.join(tmpdir, 'gis.jsonlines'), 'w') as f:
+        for feature in FEATURES:
+            f.write(json.dumps(feature) + '\n')
+    return writers.get_features_schema(FEATURES)
+
+
+def read_files(tmpdir, file_names):
+    files = {}
+    for file_name in file_names:
+        if os.path.exists(os.path.join(tmpdir, file_name)):
+            with open(os.path.join(tmpdir, file_name), 'rb') as f:
+                files[file_name] = f.read()
+    return files
+
+
+def test_create_formats_single_pass_and_process_pool(monkeypatch):
+    file_names = [file_name for format_group in FORMAT_GROUPS for file_name in formats.FORMAT_GROUP_FILES[format_group]]
+    num_passes = []
+    iterate_gis_jsonlines = formats.iterate_gis_jsonlines
+
+    def mock_iterate_gis_jsonlines(tmpdir):
+        num_passes.append(tmpdir)
+        return iterate_gis_jsonlines(tmpdir)
+
+    monkeypatch.setattr(formats, 'iterate_gis_jsonlines', mock_iterate_gis_jsonlines)
+    results = []
+    for format_workers in (1, 2):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_hashes = formats.create_formats(tmpdir, write_gis_jsonlines(tmpdir), FORMAT_GROUPS, format_workers)
+            files = read_files(tmpdir, file_names)
+            # xlsx files include the creation time
+            files['gis.xlsx'] = len(files['gis.xlsx']) > 0
+            results.append((file_hashes, files))
+    # with a single worker all the formats are written in a single pass
+    # the process pool workers don't use the mocked function, so only the single worker pass is counted
+    assert len(num_passes) == 1
+    assert results[0] == results[1]
+    file_hashes, files = results[0]
+    # geoxml supports only polygons, so the geoxml files are deleted without affecting the other files
+    assert sorted(files) == ['gis.csv', 'gis.geojson', 'gis.itm.geojson', 'gis.xlsx', 'gis.xml']
+    assert sorted(file_hashes) == ['gis.geojson', 'gis.itm.geojson', 'gis.xml']
+    assert files['gis.csv'].decode() == 'name,area\r\na,1\r\n<b>,\r\n'
+    assert '<name type="str">&lt;b&gt;</name>' in files['gis.xml'].decode()
+
+
+def test_create_formats_failure_isolation(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        schema = write_gis_jsonlines(tmpdir)
+        # unknown format group fails in the worker process, without affecting the other format group
+        file_hashes = formats.create_formats(tmpdir, schema, ['geojson_geoxml', 'unknown'], format_workers=2)
+        assert sorted(file_hashes) == ['gis.geojson', 'gis.itm.geojson']
+
+    def mock_features_to_csv(features, fields=None):
+        raise Exception('failed to convert row')
+
+    monkeypatch.setattr(formats, 'features_to_csv', mock_features_to_csv)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        schema = write_gis_jsonlines(tmpdir)
+        file_hashes = formats.create_formats(tmpdir, schema, FORMAT_GROUPS)
+        assert sorted(file_hashes) == ['gis.geojson', 'gis.itm.geojson']
+        assert sorted(read_files(tmpdir, formats.FORMAT_GROUP_FILES['csv_xlsx_xml'] + formats.FORMAT_GROUP_FILES['geojson_geoxml'])) == [
+            'gis.geojson', 'gis.itm.geojson'
+        ]
+
+
+def test_features_file_writer_is_abstract():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with pytest.raises(TypeError):
+            writers.FeaturesFileWriter(os.path.join(tmpdir, 'gis.txt'))
+        assert not os.path.exists(os.path.join(tmpdir, 'gis.txt'))
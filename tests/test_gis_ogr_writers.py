@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+import pytest
+
+from datacity_ckan_dgp.gis import writers
+
+ogr = pytest.importorskip('osgeo.ogr')
+from datacity_ckan_dgp.gis import ogr_writers  # noqa: E402
+
+
+FEATURES = [
+    {'type': 'Feature', 'properties': {'name': 'a', 'area': 1, 'height': 1.5}, 'geometry': {'type': 'Polygon', 'coordinates': [[[35.2, 31.7], [35.3, 31.7], [35.3, 31.8], [35.2, 31.7]]]}},
+    {'type': 'Feature', 'properties': {'name': None, 'area': 2, 'height': None}, 'geometry': {'type': 'MultiPolygon', 'coordinates': [[[[35.2, 31.7], [35.3, 31.7], [35.3, 31.8], [35.2, 31.7]]]]}},
+]
+
+
+def test_write_ogr_layer():
+    schema = writers.get_features_schema(FEATURES)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, 'gis.gpkg')
+        ogr_writers.write_ogr_layer(FEATURES, file_path, 'GPKG', schema, srs=ogr_writers.get_wgs84_srs())
+        ds = ogr.Open(file_path)
+        layer = ds.GetLayer(0)
+        assert layer.GetGeomType() == ogr.wkbMultiPolygon
+        assert layer.GetFeatureCount() == 2
+        assert all(feature.GetGeometryRef().GetGeometryType() == ogr.wkbMultiPolygon for feature in layer)
+        layer.ResetReading()
+        rows = [(feature.GetField('name'), feature.GetField('area'), feature.GetField('height')) for feature in layer]
+        assert rows == [('a', 1, 1.5), (None, 2, None)]
+
+
+@pytest.mark.parametrize('geometries, expected_geometry_type', [
+    ([FEATURES[0]['geometry'], FEATURES[1]['geometry']], 'MULTIPOLYGON'),
+    ([{'type': 'LineString', 'coordinates': [[35.2, 31.7], [35.3, 31.8]]},
+      {'type': 'MultiLineString', 'coordinates': [[[35.2, 31.7], [35.3, 31.8]], [[35.4, 31.7], [35.5, 31.8]]]}], 'MULTILINESTRING'),
+    ([{'type': 'MultiPoint', 'coordinates': [[35.2, 31.7], [35.3, 31.8]]}, {'type': 'Point', 'coordinates': [35.2, 31.7]}], 'MULTIPOINT'),
+])
+def test_write_indexed_format_mixed_geometries(geometries, expected_geometry_type):
+    if not ogr_writers.is_driver_available('FlatGeobuf'):
+        pytest.skip('FlatGeobuf driver is not available')
+    features = [{'type': 'Feature', 'properties': {'id': i}, 'geometry': geometry} for i, geometry in enumerate(geometries)]
+    schema = writers.get_features_schema(features)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = ogr_writers.write_indexed_format(features, tmpdir, 'gis', 'flatgeobuf', schema)
+        ds = ogr.Open(file_path)
+        layer = ds.GetLayer(0)
+        assert ogr.GeometryTypeToName(layer.GetGeomType()).upper().replace(' ', '') == expected_geometry_type
+        assert [feature.GetGeometryRef().GetGeometryName() for feature in layer] == [expected_geometry_type] * len(features)
+
+
+def test_write_indexed_format_missing_driver(monkeypatch):
+    monkeypatch.setattr(ogr_writers, 'is_driver_available', lambda driver_name: driver_name != 'FlatGeobuf')
+    schema = writers.get_features_schema(FEATURES)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        assert ogr_writers.write_indexed_format(FEATURES, tmpdir, 'gis', 'flatgeobuf', schema) is None
+        assert os.listdir(tmpdir) == []
+        assert ogr_writers.write_indexed_format(FEATURES, tmpdir, 'gis', 'geopackage', schema) == os.path.join(tmpdir, 'gis.gpkg')
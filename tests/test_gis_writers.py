@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+from datacity_ckan_dgp import utils
+from datacity_ckan_dgp.gis import writers
+
+
+POLYGON_FEATURE = {
+    'type': 'Feature',
+    'properties': {'name': 'a', 'area': 1},
+    'geometry': {'type': 'Polygon', 'coordinates': [[[35.2, 31.7], [35.3, 31.7], [35.3, 31.8], [35.2, 31.7]]]}
+}
+POINT_FEATURE = {
+    'type': 'Feature',
+    'properties': {'name': 'b', 'height': 2},
+    'geometry': {'type': 'Point', 'coordinates': [35.2, 31.7]}
+}
+
+
+def test_write_features_fan_out():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writers.write_features([POLYGON_FEATURE], [
+            writers.GeojsonWriter(os.path.join(tmpdir, 'gis.geojson')),
+            writers.GeojsonWriter(os.path.join(tmpdir, 'gis.itm.geojson'), itm=True),
+            writers.GeoxmlWriter(os.path.join(tmpdir, 'gis.geoxml')),
+        ])
+        with open(os.path.join(tmpdir, 'gis.geojson')) as f:
+            assert f.read() == '{"type": "FeatureCollection","features": [\n  {"type": "Feature", "properties": {"name": "a", "area": 1}, "geometry": {"type": "Polygon", "coordinates": [[[35.2, 31.7], [35.3, 31.7], [35.3, 31.8], [35.2, 31.7]]]}}]}'
+        with open(os.path.join(tmpdir, 'gis.itm.geojson')) as f:
+            assert '"coordinates": [[[' in f.read()
+        # the source feature is not modified by the ITM projection
+        assert POLYGON_FEATURE['geometry']['coordinates'][0][0] == [35.2, 31.7]
+        with open(os.path.join(tmpdir, 'gis.geoxml')) as f:
+            assert '<item type="list"><item type="float">35.2</item><item type="float">31.7</item></item>' in f.read()
+
+
+def test_write_features_failed_writer_isolated():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        writers.write_features([POLYGON_FEATURE, POINT_FEATURE], [
+            writers.GeojsonWriter(os.path.join(tmpdir, 'gis.geojson')),
+            writers.GeoxmlWriter(os.path.join(tmpdir, 'gis.geoxml')),
+        ])
+        assert os.path.exists(os.path.join(tmpdir, 'gis.geojson'))
+        assert not os.path.exists(os.path.join(tmpdir, 'gis.geoxml'))
+
+
+def test_get_features_schema():
+    schema = writers.get_features_schema([
+        POLYGON_FEATURE,
+        POINT_FEATURE,
+        {'type': 'Feature', 'properties': {'name': 'שלום', 'area': 1.5, 'height': None}, 'geometry': None},
+    ])
+    assert schema == {
+        'fields': {
+            'name': {'type': 'string', 'width': 8},
+            'area': {'type': 'real', 'width': 3},
+            'height': {'type': 'integer', 'width': 1},
+        },
+        'geometry_types': ['Polygon', 'Point'],
+    }
+    assert list(writers.get_features_schema([POINT_FEATURE, POLYGON_FEATURE])['fields']) == ['name', 'height', 'area']
+
+
+def test_xml_writer():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        xml_writer = writers.XmlWriter(os.path.join(tmpdir, 'gis.xml'))
+        xml_writer.write({'name': 'a & <b> "c" \'d\''})
+        xml_writer.close()
+        with open(os.path.join(tmpdir, 'gis.xml')) as f:
+            assert f.read() == '<?xml version="1.0" encoding="UTF-8" ?>\n<root>\n  <item>\n    <name type="str">a &amp; &lt;b&gt; &quot;c&quot; &apos;d&apos;</name>\n  </item>\n</root>\n'
+
+
+def test_writers_md5():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        feature_writers = [
+            writers.GeojsonWriter(os.path.join(tmpdir, 'gis.geojson')),
+            writers.GeoxmlWriter(os.path.join(tmpdir, 'gis.geoxml')),
+        ]
+        writers.write_features([POLYGON_FEATURE, POINT_FEATURE], feature_writers)
+        assert writers.get_writers_md5(feature_writers) == {'gis.geojson': utils.hash_file(os.path.join(tmpdir, 'gis.geojson'))['md5']}
@@ -81,3 +81,75 @@ def test_geojson(patch_ckan, patch_package_processing_tasks_common):
     assert patch_package_processing_tasks_common.mock_calls == [('update_package_extras', (
         'mock_instance', {'id': 'mock_package'}, 'package_extras_processed_res'
     ), {})]
+
+
+def test_try_download_resource_url_local_filename():
+    from datacity_ckan_dgp.package_processing_tasks import common
+    local_filename = './tests/data/tma-38.csv'
+    with common.try_download_resource_url('http://invalid.localhost/tma-38.csv', local_filename=local_filename) as (exceeded_max_bytes, downloaded_filename):
+        assert (exceeded_max_bytes, downloaded_filename) == (False, local_filename)
+    with common.try_download_resource_url('http://invalid.localhost/tma-38.csv', max_bytes=10, local_filename=local_filename) as (exceeded_max_bytes, downloaded_filename):
+        assert (exceeded_max_bytes, downloaded_filename) == (True, None)
+
+
+def test_xlsx_local_filename(patch_ckan, patch_package_processing_tasks_common):
+    from datacity_ckan_dgp.package_processing_tasks.xlsx import process_resource
+    resource = {
+        'url': 'http://invalid.localhost/tma-38.csv',
+        'description': 'תמ"א 38',
+        'name': 'tma-38.csv'
+    }
+    process_resource('mock_instance', {'id': 'mock_package'}, resource, 'package_extras_processed_res', local_filename='./tests/data/tma-38.csv')
+    assert len(patch_ckan.mock_calls) == 1
+    assert patch_ckan.mock_calls[0][1][1]['name'] == 'tma-38.xlsx'
+
+
+def test_process_package_search_package_is_not_used_for_processing(monkeypatch):
+    from datacity_ckan_dgp.package_processing_tasks import common
+    search_package = {'name': 'p', 'resources': [{'id': 'r1', 'name': 'r1', 'format': 'CSV'}, {'id': 'r2', 'name': 'r2', 'format': 'CSV'}], 'extras': [
+        {'key': 'processed_res_xlsx_r1', 'value': 'yes'},
+    ]}
+    # the package was processed by another run after the package search
+    package = {**search_package, 'extras': [{'key': 'processed_res_xlsx_r1', 'value': 'yes'}, {'key': 'processed_res_xlsx_r2', 'value': 'yes'}]}
+    package_show_calls, processed_resource_ids = [], []
+
+    def mock_package_show(instance_name, package_id):
+        package_show_calls.append(package_id)
+        return package
+
+    def is_resource_valid_for_processing(instance_name, package, resource):
+        return resource['format'] == 'CSV'
+
+    def process_resource(instance_name, package, resource, package_extras_processed_res, local_filename=None):
+        processed_resource_ids.append(resource['id'])
+
+    monkeypatch.setattr(common.ckan, 'package_show', mock_package_show)
+    common.process_package('mock_instance', 'p', 'xlsx', is_resource_valid_for_processing, process_resource, search_package=search_package)
+    assert package_show_calls == ['p']
+    assert processed_resource_ids == []
+    # packages without unprocessed resources in the search results are skipped without package_show
+    common.process_package('mock_instance', 'p', 'xlsx', is_resource_valid_for_processing, process_resource, search_package=package)
+    assert package_show_calls == ['p']
+
+
+def test_geojson_process_package_datastore_info_once(monkeypatch):
+    from datacity_ckan_dgp.package_processing_tasks import geojson
+    search_package = {'id': 'p', 'name': 'p', 'resources': [
+        {'id': 'r1', 'name': 'r1', 'format': 'CSV', 'datastore_active': True},
+        {'id': 'r2', 'name': 'r2', 'format': 'XLSX', 'datastore_active': True},
+    ]}
+    datastore_info_calls, processed_resource_ids = [], []
+
+    def mock_datastore_info(instance_name, resource_id):
+        datastore_info_calls.append(resource_id)
+        return {'schema': {'Lat': 'text', 'Lon': 'text'}}
+
+    def process_resource(instance_name, package, resource, package_extras_processed_res, local_filename=None):
+        processed_resource_ids.append(resource['id'])
+
+    monkeypatch.setattr(geojson.ckan, 'datastore_info', mock_datastore_info)
+    monkeypatch.setattr(geojson.common.ckan, 'package_show', lambda instance_name, package_id: json.loads(json.dumps(search_package)))
+    monkeypatch.setattr(geojson, 'process_resource', process_resource)
+    geojson.process_package('mock_instance', 'p', search_package=json.loads(json.dumps(search_package)))
+    assert datastore_info_calls == ['r1', 'r2']
+    assert processed_resource_ids == ['r1']
@@ -0,0 +1,147 @@
+import io
+import os
+import hashlib
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from datacity_ckan_dgp import utils
+
+
+def test_iterate_executor_results():
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert list(utils.iterate_executor_results(executor, lambda i: i * 2, range(10), max_pending=4)) == [i * 2 for i in range(10)]
+        assert sorted(utils.iterate_executor_results(executor, lambda i: i * 2, range(10), max_pending=4, ordered=False)) == [i * 2 for i in range(10)]
+    assert list(utils.iterate_executor_results(None, lambda i: i * 2, range(3), max_pending=1)) == [0, 2, 4]
+
+
+def test_zip_directory():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.makedirs(os.path.join(tmpdir, 'shapefile'))
+        for file_name in ['gis.shp', 'gis.dbf']:
+            with open(os.path.join(tmpdir, 'shapefile', file_name), 'w') as f:
+                f.write(file_name)
+        utils.zip_directory(os.path.join(tmpdir, 'shapefile'), os.path.join(tmpdir, 'shapefile.zip'))
+        with zipfile.ZipFile(os.path.join(tmpdir, 'shapefile.zip')) as zf:
+            assert zf.namelist() == ['shapefile/', 'shapefile/gis.dbf', 'shapefile/gis.shp']
+            assert zf.read('shapefile/gis.shp') == b'gis.shp'
+
+
+def test_hash_file_and_hashing_writer():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, 'data.txt')
+        writer = utils.HashingWriter(open(file_path, 'wb'), algorithms=('md5', 'sha256'), encoding='utf-8')
+        writer.write('שלום\n')
+        writer.write(b'world\n')
+        writer.close()
+        assert utils.hash_file(file_path, algorithms=('md5', 'sha256')) == writer.hexdigests() == {
+            'md5': hashlib.md5('שלום\nworld\n'.encode()).hexdigest(),
+            'sha256': hashlib.sha256('שלום\nworld\n'.encode()).hexdigest(),
+        }
+
+
+def test_multipart_file_stream():
+
+    def get_files(f, filename):
+        return {'upload': (filename, f)} if filename else [('upload', f)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, 'data.csv')
+        with open(file_path, 'wb') as f:
+            f.write(b'a,b\n1,2\n' * 1000)
+        data = {'package_id': 'test', 'hash': None, 'size': 8000}
+        for filename in [None, 'renamed.csv']:
+            with open(file_path, 'rb') as f:
+                assert utils.MultipartFileStream.is_streamable(data, get_files(f, filename))
+                stream = utils.MultipartFileStream(data, get_files(f, filename))
+                request = requests.Request('POST', 'http://ckan.test', data=stream, headers={'Content-Type': stream.content_type}).prepare()
+                assert request.headers['Content-Length'] == str(len(stream))
+                body = b''.join(stream)
+            with open(file_path, 'rb') as f:
+                request = requests.Request('POST', 'http://ckan.test', data=data, files=get_files(f, filename)).prepare()
+            boundary = stream.content_type.split('boundary=')[1]
+            request_boundary = request.headers['Content-Type'].split('boundary=')[1]
+            assert len(stream) == len(body)
+            assert body == request.body.replace(request_boundary.encode(), boundary.encode())
+    assert not utils.MultipartFileStream.is_streamable(None, [('upload', io.BytesIO(b'data'))])
+
+
+class MockHttpResponse:
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+
+class MockHttpSession:
+
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, stream, headers):
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.etag:
+            return MockHttpResponse(304, {}, b'')
+        else:
+            return MockHttpResponse(200, {'ETag': self.etag}, self.content)
+
+
+def test_http_stream_download_cache(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(utils, 'HTTP_CACHE_PATH', os.path.join(tmpdir, 'cache'))
+        session = MockHttpSession(b'data', '"v1"')
+        expected_hash = hashlib.sha256(b'data').hexdigest()
+        assert utils.http_stream_download(os.path.join(tmpdir, 'a', 'file'), {'url': 'http://test/file'}, session=session, use_cache=True) == expected_hash
+        assert utils.http_stream_download(os.path.join(tmpdir, 'b', 'file'), {'url': 'http://test/file'}, session=session, use_cache=True) == expected_hash
+        assert session.requests == [{}, {'If-None-Match': '"v1"'}]
+        with open(os.path.join(tmpdir, 'b', 'file'), 'rb') as f:
+            assert f.read() == b'data'
+        session.content, session.etag = b'new data', '"v2"'
+        assert utils.http_stream_download(os.path.join(tmpdir, 'c', 'file'), {'url': 'http://test/file'}, session=session, use_cache=True) == hashlib.sha256(b'new data').hexdigest()
+        assert utils.http_stream_download(os.path.join(tmpdir, 'd', 'file'), {'url': 'http://test/file'}, session=session, use_cache=True) == hashlib.sha256(b'new data').hexdigest()
+        assert session.requests[-1] == {'If-None-Match': '"v2"'}
+        cache_files = sorted(os.listdir(os.path.join(tmpdir, 'cache')))
+        assert len(cache_files) == 2
+        assert cache_files[0].endswith(f'.{hashlib.sha256(b"new data").hexdigest()}.body')
+
+
+def test_http_stream_download_cache_opt_in(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(utils, 'HTTP_CACHE_PATH', os.path.join(tmpdir, 'cache'))
+        session = MockHttpSession(b'data', '"v1"')
+        utils.http_stream_download(os.path.join(tmpdir, 'a', 'file'), {'url': 'http://test/file'}, session=session)
+        utils.http_stream_download(os.path.join(tmpdir, 'b', 'file'), {'url': 'http://test/file'}, session=session)
+        assert session.requests == [{}, {}]
+        assert not os.path.exists(os.path.join(tmpdir, 'cache'))
+
+
+def test_http_stream_download_cache_eviction(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(utils, 'HTTP_CACHE_PATH', os.path.join(tmpdir, 'cache'))
+        monkeypatch.setattr(utils, 'HTTP_CACHE_MAX_BYTES', 10)
+        session = MockHttpSession(b'123456', '"v1"')
+        utils.http_stream_download(os.path.join(tmpdir, 'a', 'file'), {'url': 'http://test/a'}, session=session, use_cache=True)
+        utils.http_stream_download(os.path.join(tmpdir, 'b', 'file'), {'url': 'http://test/b'}, session=session, use_cache=True)
+        assert len([file_name for file_name in os.listdir(os.path.join(tmpdir, 'cache')) if file_name.endswith('.body')]) == 1
+        # the evicted url is downloaded again, the other one is revalidated
+        utils.http_stream_download(os.path.join(tmpdir, 'c', 'file'), {'url': 'http://test/a'}, session=session, use_cache=True)
+        assert session.requests[-1] == {}
+        utils.http_stream_download(os.path.join(tmpdir, 'd', 'file'), {'url': 'http://test/a'}, session=session, use_cache=True)
+        assert session.requests[-1] == {'If-None-Match': '"v1"'}